@@ -0,0 +1,700 @@
+import io
+import os
+import sys
+import json
+import base64
+import math
+import time
+import wave
+import random
+import contextlib
+import shutil
+import struct
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from PIL import Image
+from mutagen.id3 import ID3, TIT2, TPE1, COMM
+from mutagen.wave import WAVE
+import main
+
+## CORPUS
+
+def sample_exif():
+    '''
+    Return an EXIF block with the kind of fields the cleaner must remove.
+    '''
+    exif = Image.Exif()
+    exif[0x010F] = 'Benchmark Camera'  # Make
+    exif[0x0110] = 'Model 1'  # Model
+    exif[0x0131] = 'benchmark.py'  # Software
+    exif[0x013B] = 'Benchmark Author'  # Artist
+    exif[0x0132] = '2024:01:01 00:00:00'  # DateTime
+    return exif
+
+def generate_pixels(width, height, seed):
+    '''
+    Return a deterministic RGB image with some structure, so the encoders
+    do not compress it to nothing.
+    '''
+    rng = random.Random(seed)
+    img = Image.radial_gradient('L').resize((width, height))
+    noise = Image.frombytes('L', (width, height), rng.randbytes(width * height))
+    return Image.merge('RGB', (img, noise, Image.linear_gradient('L').resize((width, height))))
+
+def generate_images(directory, sizes, count, seed):
+    '''
+    Generate JPEG, PNG, GIF, BMP and WebP images with metadata and SVG documents.
+    '''
+    paths = []
+    for width, height in sizes:
+        for index in range(count):
+            img = generate_pixels(width, height, seed + index)
+            name = f'image_{width}x{height}_{index}'
+            exif = sample_exif()
+
+            path = os.path.join(directory, name + '.jpg')
+            img.save(path, exif=exif, comment=b'benchmark comment', quality=90)
+            paths.append(path)
+
+            path = os.path.join(directory, name + '.png')
+            img.save(path, exif=exif, compress_level=1)
+            paths.append(path)
+
+            path = os.path.join(directory, name + '.webp')
+            img.save(path, exif=exif, xmp=b'<x:xmpmeta xmlns:x="adobe:ns:meta/"/>', quality=80)
+            paths.append(path)
+
+            path = os.path.join(directory, name + '.gif')
+            img.convert('P').save(path, comment=b'benchmark comment')
+            paths.append(path)
+
+            path = os.path.join(directory, name + '.bmp')  # No metadata, but always re-encoded
+            img.save(path)
+            paths.append(path)
+
+            path = os.path.join(directory, name + '.svg')
+            with open(path, 'w') as f:
+                f.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}">'
+                        '<metadata><author>Benchmark Author</author></metadata>')
+                rng = random.Random(seed + index)
+                for _ in range(max(1, width * height // 10000)):
+                    f.write(f'<circle cx="{rng.randrange(width)}" cy="{rng.randrange(height)}" r="{rng.randrange(1, 50)}"/>')
+                f.write('</svg>')
+            paths.append(path)
+    return paths
+
+def write_id3(path):
+    '''
+    Add an ID3 tag to an audio file.
+    '''
+    tags = ID3()
+    tags.add(TIT2(encoding=3, text='Benchmark Title'))
+    tags.add(TPE1(encoding=3, text='Benchmark Artist'))
+    tags.add(COMM(encoding=3, lang='eng', desc='', text='benchmark comment'))
+    tags.save(path)
+
+def generate_audio(directory, seconds, count, seed):
+    '''
+    Generate tagged WAV and MP3 files, and OGG files when ffmpeg is available.
+    '''
+    paths = []
+    sample_rate = 44100
+    for index in range(count):
+        frequency = 220 + 110 * index
+        samples = struct.pack(f'<{sample_rate * seconds}h', *(
+            int(8000 * math.sin(2 * math.pi * frequency * n / sample_rate)) for n in range(sample_rate * seconds)
+        ))
+
+        path = os.path.join(directory, f'audio_{index}.wav')
+        with wave.open(path, 'wb') as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(sample_rate)
+            f.writeframes(samples)
+        audio = WAVE(path)
+        audio.add_tags()
+        audio.tags.add(TIT2(encoding=3, text='Benchmark Title'))
+        audio.tags.add(TPE1(encoding=3, text='Benchmark Artist'))
+        audio.save()
+        paths.append(path)
+
+        # MPEG-1 Layer III, 128 kbps, 44.1 kHz frames with silent payload
+        path = os.path.join(directory, f'audio_{index}.mp3')
+        frame = b'\xff\xfb\x90\x00' + bytes(413)
+        with open(path, 'wb') as f:
+            f.write(frame * (seconds * sample_rate // 1152))
+        write_id3(path)
+        paths.append(path)
+
+        if shutil.which('ffmpeg'):
+            path = os.path.join(directory, f'audio_{index}.ogg')
+            if run_ffmpeg(['-f', 'lavfi', '-i', f'sine=frequency={frequency}:duration={seconds}',
+                           '-c:a', 'libvorbis', '-metadata', 'artist=Benchmark Artist', path]):
+                paths.append(path)
+    return paths
+
+def generate_videos(directory, seconds, count, seed):
+    '''
+    Generate small MP4 and MKV files with ffmpeg.
+    '''
+    paths = []
+    if not shutil.which('ffmpeg'):
+        print('ffmpeg not found, skipping the video corpus')
+        return paths
+    for index in range(count):
+        for extension in ('mp4', 'mkv'):
+            path = os.path.join(directory, f'video_{index}.{extension}')
+            if run_ffmpeg(['-f', 'lavfi', '-i', f'testsrc=duration={seconds}:size=320x240:rate=25',
+                           '-f', 'lavfi', '-i', f'sine=frequency={440 + index}:duration={seconds}',
+                           '-metadata', 'title=Benchmark Title', '-metadata', 'artist=Benchmark Artist',
+                           '-metadata', 'comment=benchmark comment', '-shortest', path]):
+                paths.append(path)
+    return paths
+
+def write_pdf(path, pages, rng):
+    '''
+    Write a PDF of scanned-like pages (one grayscale image per page) with
+    a document information dictionary and an XMP metadata stream.
+    '''
+    xmp = b'<x:xmpmeta xmlns:x="adobe:ns:meta/"><dc:creator>Benchmark Artist</dc:creator></x:xmpmeta>'
+    objects = {
+        1: b'<< /Type /Catalog /Pages 2 0 R /Metadata 4 0 R >>',
+        3: b'<< /Title (Benchmark Title) /Author (Benchmark Artist) /Producer (benchmark.py) >>',
+        4: b'<< /Type /Metadata /Subtype /XML /Length %d >>\nstream\n%s\nendstream' % (len(xmp), xmp),
+    }
+    content = b'q 612 0 0 792 0 0 cm /Im0 Do Q'
+    kids = []
+    for page in range(pages):
+        number = 5 + page * 3
+        kids.append(b'%d 0 R' % number)
+        objects[number] = (b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents %d 0 R '
+                           b'/Resources << /XObject << /Im0 %d 0 R >> >> >>' % (number + 1, number + 2))
+        objects[number + 1] = b'<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content)
+        scan = rng.randbytes(128 * 128)
+        objects[number + 2] = (b'<< /Type /XObject /Subtype /Image /Width 128 /Height 128 /ColorSpace /DeviceGray '
+                               b'/BitsPerComponent 8 /Length %d >>\nstream\n%s\nendstream' % (len(scan), scan))
+    objects[2] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (b' '.join(kids), pages)
+
+    with open(path, 'wb') as f:
+        f.write(b'%PDF-1.4\n')
+        offsets = {}
+        for number in sorted(objects):
+            offsets[number] = f.tell()
+            f.write(b'%d 0 obj\n%s\nendobj\n' % (number, objects[number]))
+        xref = f.tell()
+        size = max(objects) + 1
+        f.write(b'xref\n0 %d\n0000000000 65535 f\r\n' % size)
+        f.write(b''.join(b'%010d 00000 n\r\n' % offsets[number] for number in range(1, size)))
+        f.write(b'trailer\n<< /Size %d /Root 1 0 R /Info 3 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (size, xref))
+
+SAMPLE_WORDS = ['metadata', 'benchmark', 'cleaner', 'document', 'author', 'private', 'page', 'table', 'slide', 'chapter']
+
+def set_core_properties(properties):
+    '''
+    Fill the OOXML core properties the cleaner must remove.
+    '''
+    properties.title = 'Benchmark Title'
+    properties.author = 'Benchmark Artist'
+    properties.comments = 'benchmark comment'
+    properties.last_modified_by = 'Benchmark Author'
+    properties.created = datetime(2024, 1, 1)
+
+def write_docx(path, pages, rng):
+    '''
+    Write a DOCX of pages paragraphs with its core properties filled.
+    '''
+    import docx
+    document = docx.Document()
+    set_core_properties(document.core_properties)
+    for _ in range(pages):
+        document.add_paragraph(' '.join(rng.choice(SAMPLE_WORDS) for _ in range(200)))
+    document.save(path)
+
+def write_xlsx(path, pages, rng):
+    '''
+    Write an XLSX of 50 rows per page with its core properties filled.
+    '''
+    import openpyxl
+    workbook = openpyxl.Workbook()
+    workbook.properties.title = 'Benchmark Title'
+    workbook.properties.creator = 'Benchmark Artist'
+    workbook.properties.description = 'benchmark comment'
+    workbook.properties.lastModifiedBy = 'Benchmark Author'
+    sheet = workbook.active
+    for _ in range(pages * 50):
+        sheet.append([rng.randrange(1000000) for _ in range(10)] + [rng.choice(SAMPLE_WORDS)])
+    workbook.save(path)
+
+def write_pptx(path, pages, rng):
+    '''
+    Write a PPTX of one text slide per page with its core properties filled.
+    '''
+    import pptx
+    presentation = pptx.Presentation()
+    set_core_properties(presentation.core_properties)
+    layout = presentation.slide_layouts[1]  # Title and content
+    for page in range(pages):
+        slide = presentation.slides.add_slide(layout)
+        slide.shapes.title.text = f'Slide {page}'
+        slide.placeholders[1].text = ' '.join(rng.choice(SAMPLE_WORDS) for _ in range(50))
+    presentation.save(path)
+
+def write_epub(path, pages, rng):
+    '''
+    Write an EPUB of one chapter per 10 pages with Dublin Core metadata.
+    '''
+    from ebooklib import epub
+    book = epub.EpubBook()
+    book.set_identifier(f'benchmark-{rng.randrange(1 << 32)}')
+    book.set_title('Benchmark Title')
+    book.set_language('en')
+    book.add_author('Benchmark Artist')
+    book.add_metadata('DC', 'description', 'benchmark comment')
+    chapters = []
+    for index in range(max(1, pages // 10)):
+        chapter = epub.EpubHtml(title=f'Chapter {index}', file_name=f'chapter_{index}.xhtml', lang='en')
+        chapter.content = '<html><body>%s</body></html>' % ''.join(
+            '<p>%s</p>' % ' '.join(rng.choice(SAMPLE_WORDS) for _ in range(200)) for _ in range(10))
+        book.add_item(chapter)
+        chapters.append(chapter)
+    book.toc = chapters
+    book.spine = chapters
+    book.add_item(epub.EpubNcx())
+    book.add_item(epub.EpubNav())
+    epub.write_epub(path, book)
+
+DOCUMENT_WRITERS = {
+    'pdf': write_pdf,
+    'docx': write_docx,
+    'xlsx': write_xlsx,
+    'pptx': write_pptx,
+    'epub': write_epub,
+}
+
+def generate_documents(directory, pages, count, seed):
+    '''
+    Generate PDF, DOCX, XLSX, PPTX and EPUB files of the given number of pages.
+    '''
+    rng = random.Random(seed)
+    paths = []
+    for index in range(count):
+        for extension, write in DOCUMENT_WRITERS.items():
+            path = os.path.join(directory, f'document_{index}.{extension}')
+            write(path, pages, rng)
+            paths.append(path)
+    return paths
+
+def run_ffmpeg(arguments):
+    '''
+    Run ffmpeg quietly, return True on success.
+    '''
+    try:
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'error'] + arguments, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return True
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f'ffmpeg failed: {e}')
+        return False
+
+def generate_corpus(directory, sizes, count, seconds, seed, pages=100):
+    '''
+    Generate the whole deterministic corpus in directory.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    return (generate_images(directory, sizes, count, seed)
+            + generate_audio(directory, seconds, count, seed)
+            + generate_videos(directory, seconds, count, seed)
+            + generate_documents(directory, pages, count, seed))
+
+## BENCHMARK
+
+def timed(stages, name, func):
+    '''
+    Run func, adding its duration to stages[name], and return its result.
+    '''
+    start = time.perf_counter()
+    value = func()
+    stages[name] = stages.get(name, 0.0) + time.perf_counter() - start
+    return value
+
+def benchmark_file(path, output_directory):
+    '''
+    Run the extract, serialize and strip stages on one file.
+    Return the per-stage timings and the error that stopped them, if any.
+    '''
+    extension = os.path.splitext(path)[1].lower()
+    output_path = os.path.join(output_directory, 'out' + extension)
+    metadata_path = os.path.join(output_directory, 'out_metadata.json')
+    stages = {}
+    handler = main.get_handler(extension)
+    if handler is None or handler.strip is None:
+        return stages, None
+
+    try:
+        metadata = timed(stages, 'extract', lambda: handler.extract(path))
+        timed(stages, 'serialize', lambda: main.save_metadata_to_file(metadata, metadata_path))
+        timed(stages, 'strip', lambda: handler.strip(path, output_path))
+    except Exception as e:
+        return stages, f'{type(e).__name__}: {e}'
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)  # ffmpeg refuses to overwrite it otherwise
+    return stages, None
+
+def peak_rss_mb():
+    '''
+    Return the peak resident set size of this process and its children in MB.
+    On Linux ru_maxrss survives exec, so a spawned process would report the
+    peak of its parent: the high water mark of its own memory is read instead.
+    '''
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with contextlib.suppress(OSError, StopIteration):
+        with open('/proc/self/status') as f:
+            own = int(next(line for line in f if line.startswith('VmHWM:')).split()[1])
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024  # macOS reports bytes
+    return round(max(own, children) / scale, 1)
+
+def benchmark_format(paths, repeat):
+    '''
+    Benchmark the files of one format repeat times.
+    Run in a fresh process, so the peak RSS is that of the format alone.
+    '''
+    entry = {'files': 0, 'bytes': 0, 'seconds': 0.0, 'stages': {}, 'failures': []}
+    output_directory = tempfile.mkdtemp(prefix='metadata_cleaner_bench_')
+    start = time.perf_counter()
+    try:
+        for _ in range(repeat):
+            for path in paths:
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    stages, error = benchmark_file(path, output_directory)
+                if error is not None:
+                    # A failed file would skew the throughput, it is only listed
+                    entry['failures'].append({'file': os.path.basename(path), 'error': error})
+                    continue
+                entry['files'] += 1
+                entry['bytes'] += os.path.getsize(path)
+                for stage, seconds in stages.items():
+                    entry['stages'][stage] = entry['stages'].get(stage, 0.0) + seconds
+                    entry['seconds'] += seconds
+    finally:
+        shutil.rmtree(output_directory, ignore_errors=True)
+    entry['wall_seconds'] = time.perf_counter() - start
+    entry['peak_rss_mb'] = peak_rss_mb()
+    return entry
+
+def run_benchmark(paths, repeat):
+    '''
+    Benchmark every file repeat times and aggregate the results per format.
+    Each format runs in its own fresh process, not in the one that
+    generated the corpus.
+    '''
+    by_format = {}
+    for path in paths:
+        by_format.setdefault(os.path.splitext(path)[1].lower().lstrip('.'), []).append(path)
+    formats = {}
+    context = multiprocessing.get_context('spawn')
+    for extension, format_paths in by_format.items():
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            formats[extension] = pool.submit(benchmark_format, format_paths, repeat).result()
+    total_seconds = sum(entry.pop('wall_seconds') for entry in formats.values()) or 1e-9
+
+    for entry in formats.values():
+        seconds = entry['seconds'] or 1e-9
+        entry['files_per_second'] = round(entry['files'] / seconds, 2)
+        entry['mb_per_second'] = round(entry['bytes'] / seconds / 1e6, 2)
+        entry['stages'] = {stage: round(value, 6) for stage, value in entry['stages'].items()}
+        entry['seconds'] = round(entry['seconds'], 6)
+
+    total_files = sum(entry['files'] for entry in formats.values())
+    total_bytes = sum(entry['bytes'] for entry in formats.values())
+    return {
+        'created': datetime.now().strftime('%Y%m%d_%H%M%S'),
+        'commit': current_commit(),
+        'files': total_files,
+        'bytes': total_bytes,
+        'failures': sum(len(entry['failures']) for entry in formats.values()),
+        'seconds': round(total_seconds, 6),
+        'files_per_second': round(total_files / total_seconds, 2),
+        'mb_per_second': round(total_bytes / total_seconds / 1e6, 2),
+        'peak_rss_mb': max((entry['peak_rss_mb'] for entry in formats.values()), default=0.0),
+        'formats': formats,
+    }
+
+def current_commit():
+    '''
+    Return the current git commit, if any, to label the baseline.
+    '''
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+## IMPORT TIME
+
+IMPORT_BACKENDS = ['PIL.Image', 'mutagen', 'pymediainfo', 'openpyxl', 'pptx', 'docx', 'ebooklib.epub', 'mobi', 'PyPDF2', 'pypandoc']
+
+def measure_import_time(modules, repeat):
+    '''
+    Return the best cumulative import time of the modules (comma separated)
+    in a fresh interpreter, in seconds, as reported by python -X importtime.
+    '''
+    best = None
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for _ in range(repeat):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {modules}'],
+                                 capture_output=True, text=True, cwd=directory)
+        if process.returncode != 0:
+            return None
+        total = 0
+        for line in process.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if not name.startswith('  '):  # Top-level imports only, nested ones are already included
+                total += int(cumulative)
+        seconds = total / 1e6
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+def run_import_benchmark(repeat):
+    '''
+    Measure the cold start of main.py and the cost of every format backend,
+    which is only paid the first time a file of that type is processed.
+    '''
+    report = {'main': measure_import_time('main', repeat), 'backends': {}}
+    for module in IMPORT_BACKENDS:
+        report['backends'][module] = measure_import_time(module, repeat)
+    installed = [module for module, seconds in report['backends'].items() if seconds is not None]
+    report['eager'] = measure_import_time(', '.join(['main'] + installed), repeat)
+    return report
+
+def print_import_report(report):
+    print(f'import main: {report["main"] * 1000:.1f} ms')
+    for module, seconds in report['backends'].items():
+        print(f'  {module:<14} {"not installed" if seconds is None else f"{seconds * 1000:.1f} ms"} (on first use)')
+    print(f'Importing every backend at startup would take {report["eager"] * 1000:.1f} ms '
+          f'({report["eager"] / report["main"]:.1f}x)')
+
+## SERIALIZER
+
+def legacy_serialize(metadata):
+    '''
+    The serializer used before json_default: rebuild the whole tree with the
+    bytes encoded, then pretty print it.
+    '''
+    def encode_bytes_in_dict(obj):
+        if isinstance(obj, dict):
+            return {k: encode_bytes_in_dict(v) for k, v in obj.items()}
+        elif isinstance(obj, list):
+            return [encode_bytes_in_dict(v) for v in obj]
+        elif isinstance(obj, bytes):
+            return base64.b64encode(obj).decode('utf-8')
+        else:
+            return obj
+    return json.dumps(encode_bytes_in_dict(metadata), indent=4)
+
+def sample_metadata(seed):
+    '''
+    Return metadata shaped like the large dicts of the real backends: a
+    MediaInfo probe of a long video and a PIL info dict with an ICC profile
+    and a thumbnail.
+    '''
+    rng = random.Random(seed)
+    tracks = []
+    for index in range(60):
+        track = {'track_type': 'Text' if index > 2 else 'Video', 'track_id': index}
+        for field in range(150):
+            track[f'field_{field}'] = rng.choice([rng.randrange(1 << 30), f'value {rng.random()}', [rng.random(), rng.random()]])
+        tracks.append(track)
+    return {
+        'tracks': tracks,
+        'icc_profile': rng.randbytes(560 * 1024),
+        'exif': rng.randbytes(64 * 1024),
+        'dpi': [72, 72],
+    }
+
+def run_serializer_benchmark(repeat):
+    '''
+    Time the legacy serializer against dumps_metadata on sample_metadata.
+    Return the best time of each variant in seconds.
+    '''
+    metadata = sample_metadata(0)
+    variants = {'legacy (indent=4)': legacy_serialize}
+    orjson_module = main.orjson
+    main.orjson = None
+    try:
+        variants['json indent'] = lambda data: main.dumps_metadata(data, compact=False)
+        variants['json compact'] = lambda data: main.dumps_metadata(data, compact=True)
+        timings = {name: best_time(func, metadata, repeat) for name, func in variants.items()}
+    finally:
+        main.orjson = orjson_module
+    if orjson_module is not None:
+        timings['orjson indent'] = best_time(lambda data: main.dumps_metadata(data, compact=False), metadata, repeat)
+        timings['orjson compact'] = best_time(lambda data: main.dumps_metadata(data, compact=True), metadata, repeat)
+    return timings
+
+def best_time(func, argument, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(argument)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+def print_serializer_report(timings):
+    legacy = timings['legacy (indent=4)']
+    for name, seconds in timings.items():
+        print(f'{name:<20}{seconds * 1000:>9.2f} ms  {legacy / seconds:>6.1f}x')
+
+## RE-ENCODE
+
+def legacy_reencode(img, output):
+    '''
+    The re-encode fallback used before reencode_image: every pixel goes
+    through a Python list, and only the current frame is kept.
+    '''
+    img_data = list(img.getdata())
+    img_without_metadata = Image.new(img.mode, img.size)
+    img_without_metadata.putdata(img_data)
+    img_without_metadata.save(output, format=img.format)
+
+def run_reencode_benchmark(sizes, repeat, frames=10):
+    '''
+    Time the per-pixel re-encode against reencode_image on GIF and BMP
+    images of each size, and on an animated GIF of the smallest size with
+    a global palette.
+    Return the best time of each variant in seconds per image.
+    '''
+    timings = {}
+    with tempfile.TemporaryDirectory(prefix='metadata_cleaner_reencode_') as directory:
+        images = []
+        for width, height in sizes:
+            img = generate_pixels(width, height, 0)
+            path = os.path.join(directory, f'image_{width}x{height}.gif')
+            img.convert('P').save(path, comment=b'benchmark comment')
+            images.append((f'gif {width}x{height}', path))
+            path = os.path.join(directory, f'image_{width}x{height}.bmp')
+            img.save(path)
+            images.append((f'bmp {width}x{height}', path))
+        width, height = min(sizes)
+        path = os.path.join(directory, f'animation_{width}x{height}.gif')
+        first = generate_pixels(width, height, 0).convert('P')
+        animation = [first] + [generate_pixels(width, height, seed).quantize(palette=first) for seed in range(1, frames)]
+        animation[0].save(path, save_all=True, append_images=animation[1:], duration=100, loop=0,
+                          palette=bytes(first.getpalette()), comment=b'benchmark comment')
+        images.append((f'gif {width}x{height} x{frames} frames', path))
+
+        for name, path in images:
+            for variant, func in (('per-pixel', legacy_reencode), ('bulk', main.reencode_image)):
+                def reencode(path):
+                    with Image.open(path) as img:
+                        func(img, io.BytesIO())
+                timings[(name, variant)] = best_time(reencode, path, repeat)
+    return timings
+
+def print_reencode_report(timings):
+    print(f'{"image":<32}{"per-pixel":>12}{"bulk":>12}')
+    for name in dict.fromkeys(name for name, _ in timings):
+        legacy, bulk = timings[(name, 'per-pixel')], timings[(name, 'bulk')]
+        # The per-pixel path only writes the first frame, so animations are not comparable
+        speedup = '   n/a' if name.endswith('frames') else f'{legacy / bulk:>6.1f}x'
+        print(f'{name:<32}{legacy * 1000:>9.1f} ms{bulk * 1000:>9.1f} ms  {speedup}')
+    print('The per-pixel path only keeps the first frame of animations, the bulk path writes them all.')
+
+## REPORT
+
+def print_report(report):
+    print(f'{report["files"]} files, {report["bytes"] / 1e6:.1f} MB in {report["seconds"]:.2f}s: '
+          f'{report["files_per_second"]} files/s, {report["mb_per_second"]} MB/s, peak RSS {report["peak_rss_mb"]} MB')
+    print(f'{"format":<8}{"files":>7}{"files/s":>10}{"MB/s":>9}{"RSS MB":>9}  stages (s)')
+    for extension, entry in sorted(report['formats'].items()):
+        stages = ', '.join(f'{stage} {seconds:.4f}' for stage, seconds in entry['stages'].items())
+        print(f'{extension:<8}{entry["files"]:>7}{entry["files_per_second"]:>10}{entry["mb_per_second"]:>9}'
+              f'{entry["peak_rss_mb"]:>9}  {stages}')
+    for extension, entry in sorted(report['formats'].items()):
+        for failure in entry['failures']:
+            print(f'Failed: {failure["file"]}: {failure["error"]}')
+
+def compare_reports(baseline, report, threshold):
+    '''
+    Print the throughput change of every format against a baseline.
+    Return True if any format got slower than the threshold allows.
+    '''
+    regression = False
+    print(f'Comparison with baseline {baseline.get("commit")} ({baseline.get("created")}):')
+    for extension, entry in sorted(report['formats'].items()):
+        previous = baseline['formats'].get(extension)
+        if not previous or not previous['files_per_second']:
+            continue
+        change = entry['files_per_second'] / previous['files_per_second'] - 1
+        flag = ''
+        if change < -threshold:
+            flag = '  REGRESSION'
+            regression = True
+        print(f'  {extension:<8}{previous["files_per_second"]:>10} -> {entry["files_per_second"]:<10}{change:+.1%}{flag}')
+    return regression
+
+def parse_size(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the metadata cleaner on a synthetic corpus.')
+    parser.add_argument('--sizes', type=lambda value: [parse_size(size) for size in value.split(',')],
+                        default=[(640, 480), (3000, 2000)], help='Image sizes, e.g. 640x480,3000x2000.')
+    parser.add_argument('--count', type=int, default=2, help='Files generated per format and size.')
+    parser.add_argument('--seconds', type=int, default=3, help='Duration of the audio and video files.')
+    parser.add_argument('--pages', type=int, default=100, help='Pages of the documents.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the corpus generator.')
+    parser.add_argument('--repeat', type=int, default=1, help='How many times the corpus is processed.')
+    parser.add_argument('--corpus-dir', default=None, help='Where to generate the corpus (default: a temporary folder).')
+    parser.add_argument('--save', default=None, help='Save the results as a JSON baseline.')
+    parser.add_argument('--compare', default=None, help='Compare the results with a JSON baseline.')
+    parser.add_argument('--import-time', action='store_true', help='Only measure the import time of main.py and of the format backends.')
+    parser.add_argument('--serializer', action='store_true', help='Only run the metadata serializer microbenchmark.')
+    parser.add_argument('--reencode', action='store_true', help='Only compare the per-pixel and bulk image re-encode paths on images of --sizes.')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Slowdown tolerated before flagging a regression.')
+    return parser.parse_args(argv)
+
+def run(argv=None):
+    args = parse_arguments(argv)
+    if args.serializer:
+        print_serializer_report(run_serializer_benchmark(max(args.repeat, 5)))
+        return 0
+    if args.reencode:
+        print_reencode_report(run_reencode_benchmark(args.sizes, max(args.repeat, 3)))
+        return 0
+    if args.import_time:
+        print_import_report(run_import_benchmark(max(args.repeat, 3)))
+        return 0
+
+    corpus_dir = args.corpus_dir or tempfile.mkdtemp(prefix='metadata_cleaner_corpus_')
+    try:
+        paths = generate_corpus(corpus_dir, args.sizes, args.count, args.seconds, args.seed, args.pages)
+        report = run_benchmark(paths, args.repeat)
+    finally:
+        if args.corpus_dir is None:
+            shutil.rmtree(corpus_dir, ignore_errors=True)
+
+    print_report(report)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f'Baseline saved to: {args.save}')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare_reports(baseline, report, args.threshold):
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(run())
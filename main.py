@@ -1,28 +1,49 @@
 import os
+import io
 import json
+import struct
+import time
+import sqlite3
+import hashlib
+import re
+import zlib
 import shutil
+import argparse
 import zipfile
 import warnings
 import subprocess
+import fnmatch
+import functools
+import collections
+import contextlib
+import mmap
+import multiprocessing
+import threading
+import socket
+import signal
+import itertools
+import heapq
+import asyncio
+import tempfile
 from datetime import datetime
-import mobi
-import docx
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 import base64
-import PyPDF2
-import pypandoc
-from PIL import Image
-from mutagen import File as MutagenFile
-from pymediainfo import MediaInfo
-from openpyxl import load_workbook
-from pptx import Presentation
-from ebooklib import epub
+import math
+import numbers
 import xml.etree.ElementTree as ET
+from urllib.parse import urlsplit, parse_qs
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 ## IMAGE
 
 def remove_svg_metadata(svg_path, output_svg_path):
     '''
     Remove metadata from an SVG file.
+    Raise the error when the file cannot be cleaned.
     '''
     try:
         # Parse the SVG file
@@ -37,24 +58,343 @@ def remove_svg_metadata(svg_path, output_svg_path):
         tree.write(output_svg_path)
     except ET.ParseError as e:
         print(f'Failed to parse SVG file: {e}')
+        raise
     except Exception as e:
         print(f'Failed to remove SVG metadata: {e}')
+        raise
 
-def remove_image_metadata(image_path, output_image_path):
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# JPEG markers that carry metadata: APP1-APP13, APP15 (EXIF, XMP, ICC, IPTC...) and COM.
+# APP0 (JFIF) and APP14 (Adobe colour transform) are needed to decode the image.
+# The segments kept by the policy are listed in JPEG_SEGMENT_FIELDS.
+JPEG_METADATA_MARKERS = set(range(0xE1, 0xEE)) | {0xEF, 0xFE}
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+@contextlib.contextmanager
+def open_binary(file, mode='rb'):
+    '''
+    Open a path in binary mode, or pass an already open binary file object
+    through without closing it, so the format functions work on both.
+    '''
+    if hasattr(file, 'read' if 'r' in mode else 'write'):
+        yield file
+    else:
+        with open(file, mode) as f:
+            yield f
+
+def copy_bytes(src, dst, length):
+    '''
+    Copy length bytes from the src stream to the dst stream without
+    holding more than COPY_BUFFER_SIZE bytes in memory.
+    '''
+    while length > 0:
+        buffer = src.read(min(length, COPY_BUFFER_SIZE))
+        if not buffer:
+            raise ValueError('Unexpected end of file')
+        dst.write(buffer)
+        length -= len(buffer)
+
+def strip_jpeg_segments(src, dst):
+    '''
+    Copy a JPEG stream dropping the metadata segments.
+    The entropy coded data after the first SOS marker is copied as is.
+    '''
+    if src.read(2) != b'\xff\xd8':
+        raise ValueError('Not a JPEG file')
+    dst.write(b'\xff\xd8')
+
+    while True:
+        byte = src.read(1)
+        if byte != b'\xff':
+            raise ValueError('Invalid JPEG marker')
+        marker = src.read(1)
+        while marker == b'\xff':  # Fill bytes
+            marker = src.read(1)
+        if not marker:
+            raise ValueError('Unexpected end of file')
+        code = marker[0]
+
+        if code == 0xD9 or 0xD0 <= code <= 0xD7 or code == 0x01:  # Markers without a payload
+            dst.write(b'\xff' + marker)
+            if code == 0xD9:
+                return
+            continue
+
+        header = src.read(2)
+        if len(header) != 2:
+            raise ValueError('Unexpected end of file')
+        length = struct.unpack('>H', header)[0]
+        if length < 2:
+            raise ValueError('Invalid JPEG segment length')
+
+        if code in JPEG_METADATA_MARKERS:
+            kept_prefixes = policy.jpeg_kept_prefixes.get(code)
+            if not kept_prefixes and not (code == 0xE1 and policy.keep_orientation):
+                src.seek(length - 2, os.SEEK_CUR)
+                continue
+            payload = src.read(length - 2)
+            if len(payload) != length - 2:
+                raise ValueError('Unexpected end of file')
+            if kept_prefixes and payload.startswith(kept_prefixes):
+                dst.write(b'\xff' + marker + header + payload)
+            elif code == 0xE1 and policy.keep_orientation and payload.startswith(b'Exif\x00\x00'):
+                # Only the orientation survives from the EXIF block
+                orientation = read_exif_orientation(memoryview(payload)[6:])
+                if orientation:
+                    exif = b'Exif\x00\x00' + orientation_exif(orientation)
+                    dst.write(b'\xff\xe1' + struct.pack('>H', 2 + len(exif)) + exif)
+            continue
+
+        dst.write(b'\xff' + marker + header)
+        copy_bytes(src, dst, length - 2)
+        if code == 0xDA:  # Start of scan: the rest is image data
+            shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
+            return
+
+def strip_png_chunks(src, dst):
+    '''
+    Copy a PNG stream dropping the textual, EXIF, time and colour profile
+    chunks the policy does not keep. When only the orientation is kept, a
+    dropped eXIf chunk is replaced by one holding nothing else.
+    '''
+    if src.read(8) != PNG_SIGNATURE:
+        raise ValueError('Not a PNG file')
+    dst.write(PNG_SIGNATURE)
+
+    while True:
+        header = src.read(8)
+        if len(header) != 8:
+            raise ValueError('Unexpected end of file')
+        length, chunk_type = struct.unpack('>I4s', header)
+        if chunk_type in policy.png_dropped_chunks:
+            if chunk_type in PNG_TEXT_CHUNKS and policy.keep_png_text:
+                keyword = src.read(min(length, PNG_KEYWORD_SIZE))
+                src.seek(-len(keyword), os.SEEK_CUR)
+                keyword = keyword.split(b'\x00', 1)[0].decode('latin1').lower()
+                if keyword in policy.png_kept_keywords or (keyword not in PNG_TEXT_CATEGORIES and policy.keep_png_other_text):
+                    dst.write(header)
+                    copy_bytes(src, dst, length + 4)
+                    continue
+            if chunk_type == b'eXIf' and policy.keep_orientation:
+                payload = src.read(length)
+                if len(payload) != length:
+                    raise ValueError('Unexpected end of file')
+                orientation = read_exif_orientation(memoryview(payload))
+                if orientation:
+                    exif = orientation_exif(orientation)
+                    dst.write(struct.pack('>I4s', len(exif), b'eXIf') + exif + struct.pack('>I', zlib.crc32(b'eXIf' + exif)))
+                src.seek(4, os.SEEK_CUR)  # CRC
+                continue
+            src.seek(length + 4, os.SEEK_CUR)  # Data and CRC
+            continue
+
+        dst.write(header)
+        copy_bytes(src, dst, length + 4)
+        if chunk_type == b'IEND':
+            return
+
+def strip_webp_chunks(src, dst):
+    '''
+    Copy a WebP stream dropping the EXIF, XMP and colour profile chunks the
+    policy does not keep and clearing the matching flags of the VP8X header.
+    When only the orientation is kept, a dropped EXIF chunk is replaced by
+    one holding nothing else.
+    '''
+    header = src.read(12)
+    if len(header) != 12 or header[:4] != b'RIFF' or header[8:] != b'WEBP':
+        raise ValueError('Not a WebP file')
+    riff_end = 8 + struct.unpack('<I', header[4:8])[0]
+
+    # First pass on the chunk headers only to compute the new RIFF size
+    chunks = []
+    position = 12
+    while position + 8 <= riff_end:
+        src.seek(position)
+        fourcc, size = struct.unpack('<4sI', src.read(8))
+        padded_size = size + (size & 1)
+        chunks.append((fourcc, position, padded_size))
+        position += 8 + padded_size
+
+    kept = []
+    flags_mask = policy.webp_flags_mask
+    for fourcc, position, padded_size in chunks:
+        if fourcc not in policy.webp_dropped_chunks:
+            kept.append((fourcc, position, padded_size))
+        elif fourcc == b'EXIF' and policy.keep_orientation:
+            src.seek(position + 8)
+            payload = src.read(padded_size)
+            # Some writers start the chunk with the JPEG APP1 header
+            orientation = read_exif_orientation(memoryview(payload)[6:] if payload.startswith(b'Exif\x00\x00') else memoryview(payload))
+            if orientation:
+                exif = orientation_exif(orientation)  # Even size, no padding
+                kept.append((fourcc, exif, len(exif)))
+                flags_mask |= WEBP_VP8X_FLAGS[b'EXIF']
+    dst.write(b'RIFF' + struct.pack('<I', 4 + sum(8 + size for _, _, size in kept)) + b'WEBP')
+    for fourcc, position, padded_size in kept:
+        if isinstance(position, bytes):  # Orientation only EXIF
+            dst.write(fourcc + struct.pack('<I', padded_size) + position)
+            continue
+        src.seek(position)
+        if fourcc == b'VP8X':
+            chunk = bytearray(src.read(8 + padded_size))
+            chunk[8] &= flags_mask
+            dst.write(chunk)
+        else:
+            copy_bytes(src, dst, 8 + padded_size)
+
+# Image information needed to display the pixels, kept when re-encoding
+IMAGE_DISPLAY_INFO = ('transparency', 'background', 'loop', 'duration')
+EXIF_ORIENTATION = 0x0112
+IMAGE_FORMATS = {
+    '.jpg': 'jpeg',
+    '.jpeg': 'jpeg',
+    '.png': 'png',
+    '.gif': 'gif',
+    '.bmp': 'bmp',
+    '.webp': 'webp',
+    '.svg': 'svg',
+}
+SEGMENT_STRIPPERS = {
+    'jpeg': strip_jpeg_segments,
+    'png': strip_png_chunks,
+    'webp': strip_webp_chunks,
+}
+
+def read_exif_orientation(data):
+    '''
+    Return the orientation stored in the first IFD of an EXIF block, None
+    if there is none or it is the default one.
+    '''
+    byte_order = {b'II': '<', b'MM': '>'}.get(bytes(data[:2]))
+    if byte_order is None or len(data) < 8:
+        return None
+    offset = struct.unpack_from(byte_order + 'I', data, 4)[0]
+    if offset + 2 > len(data):
+        return None
+    count = struct.unpack_from(byte_order + 'H', data, offset)[0]
+    for entry in range(offset + 2, min(offset + 2 + 12 * count, len(data) - 11), 12):
+        tag, field_type = struct.unpack_from(byte_order + 'HH', data, entry)
+        if tag == EXIF_ORIENTATION and field_type == 3:  # SHORT
+            orientation = struct.unpack_from(byte_order + 'H', data, entry + 8)[0]
+            return orientation if orientation != 1 else None
+    return None
+
+def orientation_exif(orientation):
+    '''
+    Return an EXIF block holding nothing but the orientation.
+    '''
+    # TIFF header, then an IFD with a single SHORT entry and no next IFD
+    return b'MM\x00\x2a' + struct.pack('>IHHHIHHI', 8, 1, EXIF_ORIENTATION, 3, 1, orientation, 0, 0)
+
+def image_format_of(image_path, image_format=None):
+    '''
+    Return the image format, guessed from the extension when not given.
+    '''
+    return image_format or IMAGE_FORMATS.get(os.path.splitext(image_path)[1].lower())
+
+def strip_image_segments(image_path, output_image_path, image_format=None):
+    '''
+    Remove metadata from a JPEG, PNG or WebP file by rewriting the container
+    segments, without decoding the pixels.
+    Return False if the format is not supported or the file is malformed.
+    '''
+    stripper = SEGMENT_STRIPPERS.get(image_format_of(image_path, image_format))
+    if stripper is None:
+        return False
+    with open_binary(image_path) as src, open_binary(output_image_path, 'wb') as dst:
+        src_start, dst_start = src.tell(), dst.tell()
+        try:
+            stripper(src, dst)
+            return True
+        except (ValueError, struct.error) as e:
+            print(f'Failed to strip image segments, falling back to PIL: {e}')
+            src.seek(src_start)
+            dst.seek(dst_start)
+            dst.truncate()
+            return False
+
+def remove_image_metadata(image_path, output_image_path, image_format=None):
     '''
     Remove metadata from an image file.
+    image_format (jpeg, png, gif, bmp, webp, svg) is guessed from the
+    extension when not given. Raise the error when the image cannot be cleaned.
     '''
     try:
-        if image_path[-3:].lower() == 'svg':
+        image_format = image_format_of(image_path, image_format)
+        if image_format == 'svg':
             remove_svg_metadata(image_path, output_image_path)
+        elif strip_image_segments(image_path, output_image_path, image_format):
+            return
         else:
+            from PIL import Image
             with Image.open(image_path) as img:
-                img_data = list(img.getdata())
-                img_without_metadata = Image.new(img.mode, img.size)
-                img_without_metadata.putdata(img_data)
-                img_without_metadata.save(output_image_path)
+                reencode_image(img, output_image_path)
     except Exception as e:
-        print(f'Failed to remove image metadata: {e}')
+        if not exceeded_limit(e):
+            print(f'Failed to remove image metadata: {e}')
+        raise
+
+def copy_pixels(frame):
+    '''
+    Return a new image with only the pixels (and palette) of a frame, moved
+    in one block through the buffer protocol.
+    '''
+    from PIL import Image
+    clean = Image.frombuffer(frame.mode, frame.size, frame.tobytes(), 'raw', frame.mode, 0, 1)
+    if frame.mode in ('P', 'PA'):
+        clean.putpalette(frame.getpalette(frame.palette.mode), frame.palette.mode)
+    return clean
+
+def reencode_image(img, output_image_path):
+    '''
+    Save the pixels of an opened PIL image, every frame of an animation,
+    without its metadata. Only the information needed to display the image
+    is carried over, plus the ICC profile and the EXIF orientation when the
+    policy keeps them.
+    '''
+    frame_count = getattr(img, 'n_frames', 1)
+    # The decoded frames and the copy of the one being moved
+    check_memory_budget((frame_count + 1) * img.width * img.height * len(img.getbands()),
+                        f'Decoding a {img.width}x{img.height} image of {frame_count} frames')
+    save_options = {key: img.info[key] for key in IMAGE_DISPLAY_INFO if key in img.info}
+    if policy.keep_color_profile and img.info.get('icc_profile'):
+        save_options['icc_profile'] = img.info['icc_profile']
+    orientation = img.getexif().get(EXIF_ORIENTATION) if policy.keep_orientation else None
+    if orientation:
+        from PIL import Image
+        exif = Image.Exif()
+        exif[EXIF_ORIENTATION] = orientation
+        save_options['exif'] = exif.tobytes()
+
+    if frame_count == 1:
+        copy_pixels(img).save(output_image_path, format=img.format, **save_options)
+        return
+    load_gif_plugin()
+    frames, durations, disposals = [], [], []
+    for index in range(frame_count):
+        img.seek(index)
+        frames.append(copy_pixels(img))
+        durations.append(img.info.get('duration', 0))
+        disposals.append(getattr(img, 'disposal_method', 0))
+    save_options.pop('duration', None)
+    # The frames are already paletted: optimize would only count their
+    # colours again, which takes most of the time for a 1% smaller file
+    frames[0].save(output_image_path, format=img.format, save_all=True, append_images=frames[1:],
+                   duration=durations, disposal=disposals, optimize=False, **save_options)
+
+@functools.lru_cache(maxsize=None)
+def load_gif_plugin():
+    '''
+    Import the GIF plugin of PIL and make the frames sharing the palette of
+    the first one load paletted, instead of expanded to RGBA and quantized
+    again when saved. LOADING_STRATEGY is global to PIL, so it is set once
+    for the whole process and never changed back, which keeps it the same
+    for every thread.
+    '''
+    from PIL import GifImagePlugin
+    GifImagePlugin.LOADING_STRATEGY = GifImagePlugin.LoadingStrategy.RGB_AFTER_DIFFERENT_PALETTE_ONLY
+    return GifImagePlugin
 
 def extract_svg_metadata(svg_path):
     '''
@@ -86,6 +426,7 @@ def extract_gif_metadata(image_path):
     Extract metadata from a GIF file.
     '''
     try:
+        from PIL import Image
         with Image.open(image_path) as img:
             metadata = img.info
 
@@ -112,30 +453,388 @@ def extract_gif_metadata(image_path):
         print(f'Failed to extract image metadata: {e}')
         return {}
 
-def extract_image_metadata(image_path):
+def extract_image_metadata(image_path, image_format=None):
     '''
     Extract metadata from an image file.
     '''
     try:
-        if image_path[-3:].lower() == 'svg':
+        image_format = image_format_of(image_path, image_format)
+        if image_format == 'svg':
             metadata = extract_svg_metadata(image_path)
-        elif image_path[-3:].lower() == 'gif':
+        elif image_format == 'gif':
             metadata = extract_gif_metadata(image_path)
         else:
+            from PIL import Image
             with Image.open(image_path) as img:
                 metadata = img.info
         return metadata
     except Exception as e:
+        if exceeded_limit(e):
+            raise
         print(f'Failed to extract image metadata: {e}')
         return {}
 
 ## AUDIO
 
+ID3V1_SIZE = 128
+APE_FOOTER_SIZE = 32
+RIFF_METADATA_CHUNKS = {b'id3 ', b'ID3 ', b'bext', b'iXML', b'_PMX'}
+FLAC_METADATA_BLOCKS = {1, 4, 6}  # PADDING, VORBIS_COMMENT, PICTURE
+FICLONE = 0x40049409
+OGG_CRC_POLYNOMIAL = 0x04C11DB7
+OGG_COMMENT_HEADERS = {b'\x01vorbis': (b'\x03vorbis', 3), b'OpusHead': (b'OpusTags', 2)}
+
+def syncsafe_int(data):
+    '''
+    Decode a 28 bit ID3v2 syncsafe integer.
+    '''
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+def id3v2_frames(tag):
+    '''
+    Return the frames of an ID3v2 tag as a dictionary of strings.
+    '''
+    from mutagen.id3 import ID3
+    frames = ID3(io.BytesIO(tag))
+    return {k: str(v) for k, v in frames.items()}
+
+def id3v1_frames(tag):
+    '''
+    Return the fields of an ID3v1 tag with the names of the matching ID3v2 frames.
+    '''
+    def text(data):
+        return data.split(b'\x00', 1)[0].decode('latin1').strip()
+    fields = {
+        'TIT2': text(tag[3:33]),
+        'TPE1': text(tag[33:63]),
+        'TALB': text(tag[63:93]),
+        'TDRC': text(tag[93:97]),
+        'COMM': text(tag[97:127]),
+    }
+    return {key: value for key, value in fields.items() if value}
+
+def leading_id3v2_size(f):
+    '''
+    Return the size of the ID3v2 tag at the current position, 0 if there is none.
+    '''
+    header = f.read(10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0
+    return 10 + syncsafe_int(header[6:10]) + (10 if header[5] & 0x10 else 0)
+
+def parse_mp3_tags(f, size):
+    '''
+    Locate the ID3v2 tags at the start and the APEv2/ID3v1 tags at the end of an MP3 stream.
+    '''
+    metadata = {}
+    start = 0
+    while True:
+        f.seek(start)
+        tag_size = leading_id3v2_size(f)
+        if not tag_size:
+            break
+        f.seek(start)
+        metadata.update(id3v2_frames(f.read(tag_size)))
+        start += tag_size
+
+    end = size
+    if end - start >= ID3V1_SIZE:
+        f.seek(end - ID3V1_SIZE)
+        tag = f.read(ID3V1_SIZE)
+        if tag[:3] == b'TAG':
+            for key, value in id3v1_frames(tag).items():
+                metadata.setdefault(key, value)
+            end -= ID3V1_SIZE
+    if end - start >= APE_FOOTER_SIZE:
+        f.seek(end - APE_FOOTER_SIZE)
+        footer = f.read(APE_FOOTER_SIZE)
+        if footer[:8] == b'APETAGEX':
+            tag_size, items, flags = struct.unpack('<III', footer[12:24])
+            end -= tag_size + (APE_FOOTER_SIZE if flags & 0x80000000 else 0)
+            metadata['APEv2'] = f'{items} items'
+
+    return [(start, end - start)], metadata
+
+def parse_wav_tags(f, size):
+    '''
+    Locate the LIST/INFO, ID3, broadcast and XMP chunks of a RIFF/WAVE stream.
+    '''
+    header = f.read(12)
+    if header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+        raise ValueError('Not a RIFF/WAVE file')
+    metadata = {}
+    kept = []
+    position = 12
+    riff_end = min(size, 8 + struct.unpack('<I', header[4:8])[0])
+    while position + 8 <= riff_end:
+        f.seek(position)
+        chunk_id, chunk_size = struct.unpack('<4sI', f.read(8))
+        padded_size = 8 + chunk_size + (chunk_size & 1)
+        if chunk_id == b'LIST':
+            form = f.read(4)
+            if form == b'INFO':
+                data = f.read(chunk_size - 4)
+                offset = 0
+                while offset + 8 <= len(data):
+                    key, length = struct.unpack('<4sI', data[offset:offset + 8])
+                    value = data[offset + 8:offset + 8 + length].rstrip(b'\x00')
+                    metadata[key.decode('latin1')] = value.decode('utf-8', errors='replace')
+                    offset += 8 + length + (length & 1)
+                position += padded_size
+                continue
+        elif chunk_id in (b'id3 ', b'ID3 '):
+            metadata.update(id3v2_frames(f.read(chunk_size)))
+        if chunk_id in RIFF_METADATA_CHUNKS:
+            metadata.setdefault(chunk_id.decode('latin1').strip(), f'{chunk_size} bytes')
+        else:
+            kept.append((position, min(padded_size, size - position)))
+        position += padded_size
+
+    riff_size = 4 + sum(length for _, length in kept)
+    return [b'RIFF' + struct.pack('<I', riff_size) + b'WAVE'] + kept, metadata
+
+def parse_flac_tags(f, size):
+    '''
+    Locate the Vorbis comment, picture and padding blocks of a FLAC stream,
+    skipping any ID3v2 tag in front of it.
+    '''
+    start = leading_id3v2_size(f)
+    f.seek(start)
+    if f.read(4) != b'fLaC':
+        raise ValueError('Not a FLAC file')
+    metadata = {}
+    blocks = []
+    position = start + 4
+    while True:
+        f.seek(position)
+        header = f.read(4)
+        if len(header) < 4:
+            raise ValueError('Unexpected end of file')
+        last, block_type, length = header[0] & 0x80, header[0] & 0x7F, int.from_bytes(header[1:4], 'big')
+        if block_type == 4:
+            data = f.read(length)
+            vendor_length = struct.unpack('<I', data[:4])[0]
+            offset = 8 + vendor_length
+            for _ in range(struct.unpack('<I', data[4 + vendor_length:offset])[0]):
+                comment_length = struct.unpack('<I', data[offset:offset + 4])[0]
+                key, _, value = data[offset + 4:offset + 4 + comment_length].decode('utf-8', errors='replace').partition('=')
+                metadata[key.lower()] = value
+                offset += 4 + comment_length
+        elif block_type == 6:
+            metadata['pictures'] = metadata.get('pictures', 0) + 1
+        if block_type not in FLAC_METADATA_BLOCKS:
+            blocks.append((block_type, position + 4, length))
+        position += 4 + length
+        if last:
+            break
+
+    pieces = [b'fLaC']
+    for index, (block_type, offset, length) in enumerate(blocks):
+        flag = 0x80 if index == len(blocks) - 1 else 0
+        pieces.append(bytes([flag | block_type]) + length.to_bytes(3, 'big'))
+        pieces.append((offset, length))
+    pieces.append((position, size - position))
+    return pieces, metadata
+
+@functools.lru_cache(maxsize=1)
+def ogg_crc_table():
+    table = []
+    for index in range(256):
+        crc = index << 24
+        for _ in range(8):
+            crc = (crc << 1) ^ OGG_CRC_POLYNOMIAL if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+def ogg_crc(data):
+    '''
+    Return the CRC of an Ogg page: unreflected CRC-32, unlike zlib.crc32.
+    '''
+    table = ogg_crc_table()
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ table[(crc >> 24) ^ byte]
+    return crc
+
+def read_ogg_page(f):
+    '''
+    Read the Ogg page at the current position.
+    Return its header type, serial number, sequence number, lacing values and data.
+    '''
+    header = f.read(27)
+    if len(header) < 27 or header[:4] != b'OggS':
+        raise ValueError('Invalid Ogg page')
+    header_type, serial, sequence, segments = header[5], *struct.unpack('<II', header[14:22]), header[26]
+    lacing = f.read(segments)
+    data = f.read(sum(lacing))
+    if len(lacing) < segments or len(data) < sum(lacing):
+        raise ValueError('Unexpected end of file')
+    return header_type, serial, sequence, lacing, data
+
+def ogg_page(header_type, serial, sequence, lacing, data):
+    page = bytearray(b'OggS\x00' + bytes([header_type]) + bytes(8) + struct.pack('<III', serial, sequence, 0))
+    page += bytes([len(lacing)]) + bytes(lacing) + data
+    page[22:26] = struct.pack('<I', ogg_crc(page))
+    return bytes(page)
+
+def ogg_lacing(packet):
+    return [255] * (len(packet) // 255) + [len(packet) % 255]
+
+def parse_ogg_tags(f, size):
+    '''
+    Locate the comment header of an Ogg Vorbis or Opus stream.
+    The header pages are rewritten with an empty comment header spread over
+    as many pages as before, so the audio pages and their sequence numbers
+    are copied as they are.
+    '''
+    page_start = f.tell()
+    header_type, serial, _, lacing, data = read_ogg_page(f)
+    codec = next((codec for codec in OGG_COMMENT_HEADERS if data.startswith(codec)), None)
+    if not header_type & 0x02 or len(lacing) != 1 or codec is None:
+        raise ValueError('Not an Ogg Vorbis or Opus stream')
+    magic, header_count = OGG_COMMENT_HEADERS[codec]
+    first_page_size = f.tell() - page_start
+
+    # The headers end on a page boundary, the audio starts on a new page
+    packets = [b'']
+    sequences = []
+    while True:
+        header_type, page_serial, sequence, lacing, data = read_ogg_page(f)
+        if page_serial != serial:
+            raise ValueError('Multiplexed Ogg streams are not supported')
+        sequences.append(sequence)
+        offset = 0
+        for value in lacing:
+            packets[-1] += data[offset:offset + value]
+            offset += value
+            if value < 255:
+                packets.append(b'')
+        if len(packets) > header_count - 1:
+            break
+    if packets[-1] or len(packets) != header_count:
+        raise ValueError('Invalid Ogg header pages')
+    headers_end = f.tell()
+
+    comments = packets[0]
+    if comments[:len(magic)] != magic:
+        raise ValueError('Missing Ogg comment header')
+    metadata = {}
+    vendor_length = struct.unpack('<I', comments[len(magic):len(magic) + 4])[0]
+    offset = len(magic) + 8 + vendor_length
+    for _ in range(struct.unpack('<I', comments[offset - 4:offset])[0]):
+        comment_length = struct.unpack('<I', comments[offset:offset + 4])[0]
+        key, _, value = comments[offset + 4:offset + 4 + comment_length].decode('utf-8', errors='replace').partition('=')
+        metadata[key.lower()] = value
+        offset += 4 + comment_length
+
+    # The vendor string names the encoder library and is kept, as mutagen does
+    empty = comments[:len(magic) + 4 + vendor_length] + bytes(4) + (b'\x01' if magic == b'\x03vorbis' else b'')
+    # Large tags took more pages than the empty header has segments: it is
+    # padded with zeros, which decoders ignore after the comments
+    missing = len(sequences) - sum(len(ogg_lacing(packet)) for packet in [empty] + packets[1:-1])
+    empty += bytes(255 * max(missing, 0))
+    lacing = [value for packet in [empty] + packets[1:-1] for value in ogg_lacing(packet)]
+    data = b''.join([empty] + packets[1:-1])
+
+    pieces = [(page_start, first_page_size)]
+    continued = 0
+    for index, sequence in enumerate(sequences):
+        # Fill the pages in turn, leaving at least one segment for each page left
+        pages_left = len(sequences) - index - 1
+        count = min(255, len(lacing) - pages_left)
+        page_lacing, lacing = lacing[:count], lacing[count:]
+        page_size = sum(page_lacing)
+        pieces.append(ogg_page(continued, serial, sequence, page_lacing, data[:page_size]))
+        data = data[page_size:]
+        continued = 0x01 if page_lacing[-1] == 255 else 0
+    if lacing:
+        raise ValueError('Ogg headers larger than the pages they had')
+    pieces.append((headers_end, size - headers_end))
+    return pieces, metadata
+
+AUDIO_TAG_PARSERS = {
+    '.mp3': parse_mp3_tags,
+    '.wav': parse_wav_tags,
+    '.flac': parse_flac_tags,
+    '.ogg': parse_ogg_tags,
+}
+
+@functools.lru_cache(maxsize=32)
+def parse_audio_file(audio_path, size, mtime_ns):
+    parser = AUDIO_TAG_PARSERS[os.path.splitext(audio_path)[1].lower()]
+    with open(audio_path, 'rb') as f:
+        return parser(f, size)
+
+def parse_audio_tags(audio_path):
+    '''
+    Parse the tag blocks of an MP3, WAV, FLAC or Ogg Vorbis/Opus file.
+    Return the pieces of the file without tags, either bytes to write or
+    (offset, length) ranges to copy, and the metadata found in the tags,
+    or None for the formats handled by mutagen.
+    The result is cached so extracting and stripping parse the file once.
+    '''
+    if os.path.splitext(audio_path)[1].lower() not in AUDIO_TAG_PARSERS:
+        return None
+    stat = os.stat(audio_path)
+    return parse_audio_file(audio_path, stat.st_size, stat.st_mtime_ns)
+
+def copy_range(src_fd, dst_fd, offset, length):
+    '''
+    Copy length bytes at offset of src_fd to the current position of dst_fd
+    in the kernel when possible.
+    '''
+    while length > 0:
+        try:
+            copied = os.copy_file_range(src_fd, dst_fd, length, offset)
+        except (AttributeError, OSError):
+            try:
+                copied = os.sendfile(dst_fd, src_fd, offset, length)
+            except (AttributeError, OSError):
+                copied = os.write(dst_fd, os.pread(src_fd, min(length, COPY_BUFFER_SIZE), offset))
+        if copied == 0:
+            raise ValueError('Unexpected end of file')
+        offset += copied
+        length -= copied
+
+def clone_file(src_fd, dst_fd):
+    '''
+    Share the blocks of src_fd with dst_fd on filesystems supporting
+    reflinks (Btrfs, XFS...). Return False when not supported.
+    '''
+    try:
+        import fcntl
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except (ImportError, OSError):
+        return False
+
+def write_audio_pieces(audio_path, output_audio_path, pieces):
+    '''
+    Write the output file from literal bytes and ranges of the input file.
+    '''
+    size = os.path.getsize(audio_path)
+    with open(audio_path, 'rb') as src, open(output_audio_path, 'wb') as dst:
+        if pieces == [(0, size)] and clone_file(src.fileno(), dst.fileno()):
+            return
+        dst.flush()
+        for piece in pieces:
+            if isinstance(piece, bytes):
+                os.write(dst.fileno(), piece)
+            else:
+                copy_range(src.fileno(), dst.fileno(), *piece)
+
 def extract_audio_metadata(audio_path):
     '''
     Extract metadata from an audio file.
     '''
     try:
+        try:
+            parsed = parse_audio_tags(audio_path)
+        except (ValueError, struct.error):
+            parsed = None  # Left to mutagen, as when stripping
+        if parsed is not None:
+            return parsed[1]
+        from mutagen import File as MutagenFile
         audio = MutagenFile(audio_path)
         metadata = {k: str(v) for k, v in audio.tags.items()} if audio.tags else {}
         return metadata
@@ -146,13 +845,41 @@ def extract_audio_metadata(audio_path):
 def remove_audio_metadata(audio_path):
     '''
     Remove metadata from an audio file.
+    Raise the error when the tags cannot be removed.
     '''
     try:
+        from mutagen import File as MutagenFile
         audio = MutagenFile(audio_path)
+        if audio is None:
+            raise ValueError('Unknown audio format')
         audio.delete()
     except Exception as e:
         print(f'Failed to remove audio metadata: {e}')
+        raise
     
+def remove_audio_file_metadata(audio_path, output_audio_path):
+    '''
+    Write a copy of an audio file without metadata.
+    MP3, WAV, FLAC and Ogg Vorbis/Opus files are streamed to the output
+    skipping the tag blocks; other formats (Ogg FLAC or Speex...) are
+    copied and cleaned in place by mutagen.
+    The tag blocks cannot be split, so they are all kept when the policy
+    keeps every field they hold.
+    '''
+    if policy.keep_audio_tags:
+        shutil.copyfile(audio_path, output_audio_path)
+        return
+    try:
+        parsed = parse_audio_tags(audio_path)
+    except (ValueError, struct.error) as e:
+        print(f'Failed to parse audio tags, falling back to mutagen: {e}')
+        parsed = None
+    if parsed is not None:
+        write_audio_pieces(audio_path, output_audio_path, parsed[0])
+        return
+    shutil.copyfile(audio_path, output_audio_path)
+    remove_audio_metadata(output_audio_path)
+
 def copy_file(src_path, dst_path):
     '''
     Copies a file from src_path to dst_path.
@@ -183,13 +910,104 @@ def rename_file(current_path, new_path):
 
 ## VIDEO
 
+# MediaInfo fields removed by a remux, with the policy field they belong to
+VIDEO_METADATA_FIELDS = {
+    **dict.fromkeys(['title', 'movie_name', 'track_name', 'album'], 'title'),
+    **dict.fromkeys(['performer', 'composer', 'director', 'producer', 'publisher', 'copyright', 'encoded_by'], 'author'),
+    **dict.fromkeys(['genre', 'comment', 'description', 'subject', 'keywords', 'lyrics'], 'comment'),
+    **dict.fromkeys(['encoded_date', 'tagged_date', 'recorded_date', 'mastered_date'], 'datetime'),
+    **dict.fromkeys(['writing_application', 'writing_library'], 'software'),
+    'xyz': 'gps',
+}
+VIDEO_METADATA_PREFIXES = ('com_apple_quicktime_', 'com_android_')  # Device fields, and the location
+# MediaInfo fields describing the container and the streams, which a remux
+# keeps. Any other field is taken for metadata and the file is remuxed.
+VIDEO_TECHNICAL_FIELDS = {
+    'track_type', 'count', 'kind_of_stream', 'stream_identifier', 'streamorder', 'track_id', 'id', 'menu_id',
+    'complete_name', 'folder_name', 'internet_media_type', 'commercial_name', 'proportion_of_this_stream',
+    'headersize', 'datasize', 'footersize', 'isstreamable', 'interleave', 'alternate_group',
+    'video_format_list', 'video_format_withhint_list', 'audio_format_list', 'audio_format_withhint_list',
+    'codecs_video', 'audio_codecs', 'text_format_list', 'text_codecs',
+    'width', 'height', 'rotation', 'pixel_aspect_ratio', 'display_aspect_ratio', 'scan_type', 'scan_order',
+    'chroma_subsampling', 'bit_depth', 'matrix_coefficients', 'transfer_characteristics',
+    'compression_mode', 'delay', 'video_delay', 'language', 'default', 'forced', 'buffer_size',
+}
+VIDEO_TECHNICAL_PREFIXES = (
+    'other_',  # Other renderings of a field checked by itself
+    'count_of_', 'file_', 'format', 'codec', 'duration', 'bit_rate', 'overall_bit_rate', 'maximum_', 'minimum_',
+    'nominal_', 'frame_', 'framerate_', 'stream_size', 'source_', 'stored_', 'sampled_', 'bits__', 'color', 'colour',
+    'hdr_format', 'mastering_display', 'channel', 'sampling', 'samples_', 'delay__', 'video_delay_',
+)
+# Written inside the streams by the encoder: a stream copy keeps them anyway
+VIDEO_STREAM_FIELDS = {'writing_library', 'encoded_library', 'encoded_library_name', 'encoded_library_version', 'encoding_settings'}
+FFMPEG_ERROR_TAIL = 2000
+
+ffmpeg_slots = threading.BoundedSemaphore(os.cpu_count() or 1)
+
+def set_ffmpeg_concurrency(jobs):
+    '''
+    Set how many ffmpeg processes can run at the same time.
+    '''
+    global ffmpeg_slots
+    ffmpeg_slots = threading.BoundedSemaphore(max(1, jobs))
+
+@functools.lru_cache(maxsize=32)
+def probe_video_file(video_path, size, mtime_ns):
+    from pymediainfo import MediaInfo
+    return MediaInfo.parse(video_path).to_data()
+
+def probe_video(video_path):
+    '''
+    Parse a video file with MediaInfo. The result is cached by path, size and
+    mtime so extracting and stripping the same file only parse it once.
+    '''
+    stat = os.stat(video_path)
+    return probe_video_file(video_path, stat.st_size, stat.st_mtime_ns)
+
+def video_field(key):
+    '''
+    Return the policy field of a MediaInfo key, None if it is not metadata.
+    '''
+    field = VIDEO_METADATA_FIELDS.get(key)
+    if field is None and key.startswith(VIDEO_METADATA_PREFIXES):
+        field = 'gps' if 'location' in key else 'device'
+    return field
+
+def has_video_metadata(metadata):
+    '''
+    Tell whether a MediaInfo probe shows anything a remux could remove:
+    every field that is neither technical nor kept by the policy counts.
+    '''
+    for track in metadata.get('tracks', []):
+        general = track.get('track_type') == 'General'
+        for key in track:
+            if key in VIDEO_TECHNICAL_FIELDS or key.startswith(VIDEO_TECHNICAL_PREFIXES):
+                continue
+            if not general and key in VIDEO_STREAM_FIELDS:
+                continue
+            if video_field(key) not in policy.kept:
+                return True
+    return False
+
+def kept_video_tags(metadata):
+    '''
+    Return the ffmpeg -metadata arguments restoring the global tags the
+    policy keeps, which -map_metadata -1 removes with the others.
+    '''
+    general = next((track for track in (metadata or {}).get('tracks', []) if track.get('track_type') == 'General'), {})
+    arguments = []
+    for mediainfo_key, ffmpeg_key in policy.video_kept_tags:
+        value = general.get(mediainfo_key)
+        if value is not None:
+            arguments += ['-metadata', f'{ffmpeg_key}={str(value).replace("UTC", "").strip()}']
+    return arguments
+
 def extract_video_metadata(video_path):
     '''
     Extract metadata from a video file.
     '''
     try:
-        media_info = MediaInfo.parse(video_path)
-        metadata = media_info.to_data()
+        metadata = probe_video(video_path)
         return metadata
     except Exception as e:
         print(f'Failed to extract video metadata: {e}')
@@ -198,17 +1016,31 @@ def extract_video_metadata(video_path):
 def remove_video_metadata(video_path, output_video_path):
     '''
     Remove metadata from a video file.
+    The file is only remuxed when the probe shows metadata to remove,
+    otherwise it is copied as is. Raise the error when ffmpeg fails.
     '''
     try:
+        try:
+            metadata = probe_video(video_path)
+        except Exception:
+            metadata = None  # Unknown content, remux to be safe
+        if metadata is not None and not has_video_metadata(metadata):
+            shutil.copyfile(video_path, output_video_path)
+            print(f'No metadata found, copied to {output_video_path}')
+            return
+
         # Use ffmpeg to remove metadata
         command = [
-            'ffmpeg', '-i', video_path, '-map', '0', '-map_metadata', '-1',
-            '-c:v', 'copy', '-c:a', 'copy', output_video_path
+            'ffmpeg', '-nostdin', '-y', '-loglevel', 'error', '-i', video_path,
+            '-map', '0', '-map_metadata', '-1', *kept_video_tags(metadata), '-c', 'copy', output_video_path
         ]
-        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        with ffmpeg_slots:
+            subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=remaining_time())
         print(f'Metadata removed and saved to {output_video_path}')
     except subprocess.CalledProcessError as e:
-        print(f'Failed to remove video metadata: {e}')
+        stderr = e.stderr.decode('utf-8', errors='replace').strip()[-FFMPEG_ERROR_TAIL:]
+        print(f'Failed to remove video metadata: {e}\n{stderr}')
+        raise RuntimeError(f'ffmpeg failed: {stderr or e}') from e
 
 ## DOCUMENTS
 
@@ -228,27 +1060,13 @@ def remove_video_metadata(video_path, output_video_path):
 #     except Exception as e:
 #         print(f'Failed to remove PDF metadata: {e}')
 
-def extract_pdf_metadata(file_path):
-    '''
-    Extract metadata from a PDF file.
-    '''
-    metadata = {}
-    try:
-        with open(file_path, 'rb') as f:
-            reader = PyPDF2.PdfFileReader(f)
-            info = reader.getDocumentInfo()
-            if info:
-                metadata = {key: info[key] for key in info}
-    except Exception as e:
-        print(f'Failed to extract PDF metadata: {e}')
-    return metadata
-
 def extract_docx_metadata(file_path):
     '''
     Extract metadata from a DOCX file.
     '''
     metadata = {}
     try:
+        import docx
         doc = docx.Document(file_path)
         core_props = doc.core_properties
         metadata = {prop: getattr(core_props, prop) for prop in dir(core_props) if not prop.startswith('_')}
@@ -270,15 +1088,20 @@ def extract_docx_metadata(file_path):
 
 def extract_pdf_metadata(file_path):
     '''
-    Extract metadata from a PDF file.
+    Extract metadata from a PDF file: the document information dictionary
+    and the XMP metadata stream of the catalog.
     '''
     metadata = {}
     try:
-        with open(file_path, 'rb') as f:
-            reader = PyPDF2.PdfFileReader(f)
-            info = reader.getDocumentInfo()
+        from PyPDF2 import PdfReader
+        with open_binary(file_path) as f:
+            reader = PdfReader(f, strict=False)
+            info = reader.metadata
             if info:
                 metadata = {key: info[key] for key in info}
+            catalog = reader.trailer['/Root']
+            if '/Metadata' in catalog:
+                metadata['xmp'] = catalog['/Metadata'].get_data().decode('utf-8', 'replace')
     except Exception as e:
         print(f'Failed to extract PDF metadata: {e}')
     return metadata
@@ -289,6 +1112,7 @@ def extract_docx_metadata(file_path):
     '''
     metadata = {}
     try:
+        import docx
         doc = docx.Document(file_path)
         core_props = doc.core_properties
         metadata = {prop: getattr(core_props, prop) for prop in dir(core_props) if not prop.startswith('_')}
@@ -302,6 +1126,7 @@ def extract_xlsx_metadata(file_path):
     '''
     metadata = {}
     try:
+        from openpyxl import load_workbook
         wb = load_workbook(file_path)
         props = wb.properties
         metadata = {prop: getattr(props, prop) for prop in dir(props) if not prop.startswith('_')}
@@ -315,6 +1140,7 @@ def extract_pptx_metadata(file_path):
     '''
     metadata = {}
     try:
+        from pptx import Presentation
         prs = Presentation(file_path)
         props = prs.core_properties
         metadata = {prop: getattr(props, prop) for prop in dir(props) if not prop.startswith('_')}
@@ -322,15 +1148,23 @@ def extract_pptx_metadata(file_path):
         print(f'Failed to extract PPTX metadata: {e}')
     return metadata
 
+TEXT_PREVIEW_LENGTH = 500
+
+def read_text_preview(file_path):
+    '''
+    Return the first TEXT_PREVIEW_LENGTH characters of a UTF-8 text file,
+    reading only the head of the file.
+    '''
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return f.read(TEXT_PREVIEW_LENGTH)  # Sample metadata
+
 def extract_text_metadata(file_path):
     '''
     Extract metadata from a text file.
     '''
     metadata = {}
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        metadata['content'] = content[:500]  # Extracting first 500 characters as sample metadata
+        metadata['content'] = read_text_preview(file_path)
     except Exception as e:
         print(f'Failed to extract text metadata: {e}')
     return metadata
@@ -341,6 +1175,7 @@ def extract_odt_metadata(file_path):
     '''
     metadata = {}
     try:
+        import pypandoc
         output = pypandoc.convert_file(file_path, 'plain')
         metadata['content'] = output[:500]  # Extracting first 500 characters as sample metadata
     except Exception as e:
@@ -353,6 +1188,7 @@ def extract_rtf_metadata(file_path):
     '''
     metadata = {}
     try:
+        import pypandoc
         output = pypandoc.convert_file(file_path, 'plain')
         metadata['content'] = output[:500]  # Extracting first 500 characters as sample metadata
     except Exception as e:
@@ -365,9 +1201,7 @@ def extract_html_metadata(file_path):
     '''
     metadata = {}
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        metadata['content'] = content[:500]  # Extracting first 500 characters as sample metadata
+        metadata['content'] = read_text_preview(file_path)
     except Exception as e:
         print(f'Failed to extract HTML metadata: {e}')
     return metadata
@@ -378,9 +1212,7 @@ def extract_md_metadata(file_path):
     '''
     metadata = {}
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        metadata['content'] = content[:500]  # Extracting first 500 characters as sample metadata
+        metadata['content'] = read_text_preview(file_path)
     except Exception as e:
         print(f'Failed to extract Markdown metadata: {e}')
     return metadata
@@ -391,6 +1223,7 @@ def extract_epub_metadata(file_path):
     '''
     metadata = {}
     try:
+        from ebooklib import epub
         # Read the EPUB file
         # Suppress specific warning
         with warnings.catch_warnings():
@@ -420,6 +1253,7 @@ def extract_mobi_metadata(file_path):
     '''
     metadata = {}
     try:
+        import mobi
         book = mobi.read(file_path)
         metadata['title'] = book.title
         metadata['author'] = book.author
@@ -431,187 +1265,1584 @@ def extract_document_metadata(file_path):
     '''
     Extract metadata from a document based on its file extension.
     '''
-    file_extension = os.path.splitext(file_path)[1].lower()
-    if file_extension == '.pdf':
-        return extract_pdf_metadata(file_path)
-    elif file_extension in ['.doc', '.docx']:
-        return extract_docx_metadata(file_path)
-    elif file_extension in ['.xls', '.xlsx']:
-        return extract_xlsx_metadata(file_path)
-    elif file_extension in ['.ppt', '.pptx']:
-        return extract_pptx_metadata(file_path)
-    elif file_extension == '.txt':
-        return extract_text_metadata(file_path)
-    elif file_extension == '.odt':
-        return extract_odt_metadata(file_path)
-    elif file_extension == '.rtf':
-        return extract_rtf_metadata(file_path)
-    elif file_extension == '.html':
-        return extract_html_metadata(file_path)
-    elif file_extension == '.md':
-        return extract_md_metadata(file_path)
-    elif file_extension == '.epub':
-        return extract_epub_metadata(file_path)
-    elif file_extension == '.mobi':
-        return extract_mobi_metadata(file_path)
-    else:
+    handler = get_handler(os.path.splitext(file_path)[1].lower())
+    if handler is None:
         return {}
+    return handler.extract(file_path)
 
 def remove_document_metadata(file_path, output_file_path):
     '''
     Remove metadata from a document.
     '''
     file_extension = os.path.splitext(file_path)[1].lower()
-    if file_extension == '.pdf':
-        remove_pdf_metadata(file_path, output_file_path)
-    elif file_extension in ['.doc', '.docx']:
-        remove_docx_metadata(file_path, output_file_path)
-    elif file_extension in ['.xls', '.xlsx']:
-        remove_xlsx_metadata(file_path, output_file_path)
-    elif file_extension in ['.ppt', '.pptx']:
-        remove_pptx_metadata(file_path, output_file_path)
-    elif file_extension in ['.epub']:
-        remove_epub_metadata(file_path, output_file_path)
-    else:
+    handler = get_handler(file_extension)
+    if handler is None or handler.strip is None:
         print(f'Unsupported document extension: {file_extension}')
+    else:
+        handler.strip(file_path, output_file_path)
+
+PDF_OBJECT_HEADER = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj\b')
+# Strings and comments, whose content can look like keywords or references,
+# and the dictionary start, which is not a hexadecimal string
+PDF_SKIPPED_SYNTAX = rb'<<|<[^>]*>|\(|%[^\r\n]*'
+PDF_SKIPPED = re.compile(PDF_SKIPPED_SYNTAX)
+PDF_STRING_DELIMITER = re.compile(rb'[()\\]')
+# Keywords and numbers follow whitespace or a delimiter, not the characters of a name
+PDF_OBJECT_BODY_END = re.compile(PDF_SKIPPED_SYNTAX + rb'|(?P<keyword>(?<![^\s>\]})])(?:endobj|stream(?:\r\n|\n|\r)))')
+PDF_STREAM_END = re.compile(rb'\s*endstream\s*endobj')
+PDF_STREAM_LENGTH = re.compile(rb'/Length\s+(\d+)(?:\s+(\d+)\s+R)?')
+PDF_METADATA_REFERENCE = re.compile(rb'/Metadata\s*\d+\s+\d+\s+R')
+PDF_REFERENCE = re.compile(rb'(?<![^\s\[\]<>{}])(\d+)\s+\d+\s+R\b')
+# Objects that describe the layout of the original file and are rebuilt
+PDF_LAYOUT_OBJECT = re.compile(rb'/Type\s*/XRef\b|/Linearized\b')
+
+def map_binary(f):
+    '''
+    Return the content of a binary file object as a buffer, memory mapped
+    when it is a real file so large documents are never read in memory.
+    '''
+    if hasattr(f, 'getbuffer'):
+        return f.getbuffer()
+    if isinstance(f, BufferReader):
+        return f.view
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        f.seek(0)
+        return f.read()
+
+def skip_pdf_string(data, position):
+    '''
+    Return the offset after the literal string whose content starts at
+    position, following nested parentheses and escapes.
+    '''
+    depth = 1
+    while True:
+        match = PDF_STRING_DELIMITER.search(data, position)
+        if match is None:
+            raise ValueError(f'Unterminated string at offset {position}')
+        position = match.end()
+        if match.group(0) == b'\\':
+            position += 1  # The escaped character
+        else:
+            depth += 1 if match.group(0) == b'(' else -1
+            if depth == 0:
+                return position
+
+def pdf_code(body):
+    '''
+    Return a piece of PDF syntax with its strings and comments replaced by
+    spaces, so the patterns only find the keywords and references of the
+    syntax itself. The offsets stay the same.
+    '''
+    code = bytearray(body)
+    position = 0
+    while True:
+        match = PDF_SKIPPED.search(code, position)
+        if match is None:
+            return bytes(code)
+        position = skip_pdf_string(code, match.end()) if match.group(0) == b'(' else match.end()
+        if match.group(0) != b'<<':
+            code[match.start():position] = b' ' * (position - match.start())
+
+def remove_metadata_reference(body):
+    '''
+    Return the body of a catalog with its /Metadata entry replaced by spaces.
+    '''
+    body = bytearray(body)
+    for match in PDF_METADATA_REFERENCE.finditer(pdf_code(body)):
+        body[match.start():match.end()] = b' ' * (match.end() - match.start())
+    return bytes(body)
+
+def pdf_object_span(data, start, reader):
+    '''
+    Return the offsets of the end of the dictionary (or value) and of the
+    end of the indirect object starting at start. The data of streams is
+    skipped using their /Length, never parsed.
+    '''
+    from PyPDF2.generic import IndirectObject
+    header = PDF_OBJECT_HEADER.match(data, start)
+    position = header.end()
+    while True:
+        body_end = PDF_OBJECT_BODY_END.search(data, position)
+        if body_end is None:
+            raise ValueError(f'Unterminated object at offset {start}')
+        if body_end.group('keyword') is not None:
+            break
+        position = skip_pdf_string(data, body_end.end()) if body_end.group(0) == b'(' else body_end.end()
+    if body_end.group(0) == b'endobj':
+        return body_end.start(), body_end.end()
+
+    length = PDF_STREAM_LENGTH.search(pdf_code(data[header.end():body_end.start()]))
+    if length is not None:
+        size = int(length.group(1))
+        if length.group(2) is not None:
+            size = int(reader.get_object(IndirectObject(size, int(length.group(2)), reader)))
+        stream_end = PDF_STREAM_END.match(data, body_end.end() + size)
+        if stream_end is not None:
+            return body_end.start(), stream_end.end()
+    # Missing or wrong /Length, as written by some broken producers
+    stream_end = re.compile(rb'endstream\s*endobj').search(data, body_end.end())
+    if stream_end is None:
+        raise ValueError(f'Unterminated stream at offset {start}')
+    return body_end.start(), stream_end.end()
+
+def object_stream_members(reader, number):
+    '''
+    Return the decoded content of an object stream, the offset of its first
+    object and the (number, start, end) span of each object it holds.
+    '''
+    stream = reader.get_object(number)
+    data = stream.get_data()
+    first = int(stream['/First'])
+    header = [int(value) for value in data[:first].split()]
+    offsets = [first + offset for offset in header[1::2]] + [len(data)]
+    return data, first, [(object_number, offsets[index], offsets[index + 1]) for index, object_number in enumerate(header[0::2])]
+
+def rewrite_object_stream(members, blanked, catalog_number):
+    '''
+    Return the content of an object stream, as given by
+    object_stream_members, where the objects in blanked are replaced by null
+    and the /Metadata entry of the catalog is removed (unless catalog_number
+    is None). Both are padded with spaces so the offsets of the other
+    objects stay the same.
+    '''
+    content, first, spans = members
+    data = bytearray(content)
+    for object_number, start, end in spans:
+        if object_number in blanked:
+            data[start:end] = b'null'.ljust(end - start)
+        elif object_number == catalog_number:
+            data[start:end] = remove_metadata_reference(data[start:end])
+    return bytes(data), first, len(spans)
+
+def strip_pdf_objects(src, dst):
+    '''
+    Copy a PDF without its document information dictionary and its XMP
+    metadata stream. Only the objects reachable from the catalog are copied,
+    byte for byte, streams included, then a new cross-reference section and
+    trailer are written. The objects left behind by incremental updates, an
+    older /Info or XMP stream included, are unreachable and go away.
+    The information entries kept by the policy go to a new dictionary, and
+    the XMP stream stays if the policy keeps it.
+    '''
+    from PyPDF2 import PdfReader
+    from PyPDF2.generic import DictionaryObject, IndirectObject
+    reader = PdfReader(src, strict=False)
+    if reader.is_encrypted:
+        raise ValueError('Encrypted PDF files are not supported')
+    trailer = reader.trailer
+    root = trailer.raw_get('/Root')
+    catalog = root.get_object()
+    info = trailer['/Info'] if '/Info' in trailer else None
+    kept_info = DictionaryObject({key: value for key, value in info.items() if policy.keeps_pdf_info(key)} if info else {})
+    kept_info_body = io.BytesIO()
+    kept_info.write_to_stream(kept_info_body, None)
+    catalog_number = None if policy.keep_pdf_xmp else root.idnum
+    blanked = set()
+    for reference in (trailer.raw_get('/Info') if '/Info' in trailer else None,
+                      catalog.raw_get('/Metadata') if '/Metadata' in catalog and catalog_number else None):
+        if isinstance(reference, IndirectObject):
+            blanked.add(reference.idnum)
+
+    stored = {}  # Number: (generation, offset) of the objects stored as is
+    for generation, entries in sorted(reader.xref.items()):
+        for number, offset in entries.items():
+            if number and number not in blanked:
+                stored[number] = (generation, offset)
+    last_number = max(list(stored) + list(reader.xref_objStm) + list(blanked) + [0])
+
+    data = map_binary(src)
+    try:
+        # Follow the references from the catalog, scanning the dictionaries
+        # but never the stream data
+        spans = {}  # Number: (start, dictionary end, end) of the stored objects
+        members = {}  # Object stream number: object_stream_members
+        reachable = set()
+        pending = [root.idnum] + [int(match.group(1)) for match in PDF_REFERENCE.finditer(pdf_code(kept_info_body.getvalue()))]
+        while pending:
+            number = pending.pop()
+            if number in reachable or number in blanked:
+                continue
+            if number in stored:
+                offset = stored[number][1]
+                header = PDF_OBJECT_HEADER.match(data, offset)
+                if header is None or int(header.group(1)) != number:
+                    raise ValueError(f'Object {number} is not at offset {offset}')
+                dictionary_end, end = pdf_object_span(data, offset, reader)
+                spans[number] = (header.start(1), dictionary_end, end)
+                body = data[header.end():dictionary_end]
+            elif number in reader.xref_objStm:
+                stream_number = reader.xref_objStm[number][0]
+                if stream_number not in members:
+                    members[stream_number] = object_stream_members(reader, stream_number)
+                    pending.append(stream_number)
+                body = next((members[stream_number][0][start:end] for object_number, start, end in members[stream_number][2]
+                             if object_number == number), b'')
+            else:
+                continue  # Free or missing, written as a free entry
+            reachable.add(number)
+            pending.extend(int(match.group(1)) for match in PDF_REFERENCE.finditer(pdf_code(body)))
+
+        compressed = {number: location for number, location in reader.xref_objStm.items() if number in reachable}
+        # Objects of the copied object streams that are unreachable, or
+        # replaced by a later version stored elsewhere, become null
+        stale = {}
+        for stream_number, (_, _, stream_spans) in members.items():
+            member_numbers = {number for number, _, _ in stream_spans}
+            stale[stream_number] = {number for number in member_numbers if compressed.get(number, (None,))[0] != stream_number}
+            if not stale[stream_number] and catalog_number not in member_numbers:
+                del stale[stream_number]
+        objects = sorted((stored[number][1], number) for number in reachable if number in stored)
+
+        with memoryview(data) as view:
+            dst_start = dst.tell()
+            dst.write(reader.pdf_header.encode('latin-1') + b'\n%\xe2\xe3\xcf\xd3\n')
+            offsets = {}
+            for _, number in objects:
+                generation = stored[number][0]
+                start, dictionary_end, end = spans[number]
+                if PDF_LAYOUT_OBJECT.search(pdf_code(data[start:dictionary_end])):
+                    continue
+                offsets[number] = (generation, dst.tell() - dst_start)
+                if number in stale:
+                    content, first, count = rewrite_object_stream(members[number], stale[number], catalog_number)
+                    content = zlib.compress(content)
+                    dst.write(f'{number} {generation} obj\n<< /Type /ObjStm /N {count} /First {first} '
+                              f'/Filter /FlateDecode /Length {len(content)} >>\nstream\n'.encode('latin-1'))
+                    dst.write(content + b'\nendstream\nendobj\n')
+                elif number == catalog_number:
+                    dst.write(remove_metadata_reference(view[start:end]) + b'\n')
+                else:
+                    dst.write(view[start:end])
+                    dst.write(b'\n')
+
+        trailer_entries = f'/Root {root.idnum} {root.generation} R'
+        if kept_info:
+            number = last_number + 1
+            offsets[number] = (0, dst.tell() - dst_start)
+            dst.write(f'{number} 0 obj\n'.encode('latin-1') + kept_info_body.getvalue() + b'\nendobj\n')
+            trailer_entries += f' /Info {number} 0 R'
+        if '/ID' in trailer:
+            identifiers = trailer['/ID']
+            trailer_entries += ' /ID [' + ''.join(f'<{bytes(getattr(value, "original_bytes", value)).hex()}>' for value in identifiers) + ']'
+        write_pdf_cross_references(dst, dst_start, offsets, compressed, trailer_entries)
+    finally:
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+def write_pdf_cross_references(dst, dst_start, offsets, compressed, trailer_entries):
+    '''
+    Write the cross-reference section and the trailer of a rewritten PDF:
+    a classic table, or a cross-reference stream when some objects live in
+    object streams, which a table cannot point to.
+    '''
+    size = max(list(offsets) + list(compressed) + [0]) + 1
+    start = dst.tell() - dst_start
+    if not compressed:
+        lines = [f'xref\n0 {size}\n', '0000000000 65535 f\r\n']
+        for number in range(1, size):
+            if number in offsets:
+                generation, offset = offsets[number]
+                lines.append(f'{offset:010d} {generation:05d} n\r\n')
+            else:
+                lines.append('0000000000 00001 f\r\n')
+        lines.append(f'trailer\n<< /Size {size} {trailer_entries} >>\nstartxref\n{start}\n%%EOF\n')
+        dst.write(''.join(lines).encode('latin-1'))
+        return
+
+    # The cross-reference stream is a new object, with the last number
+    offsets[size] = (0, start)
+    offset_width = 4 if start < 1 << 32 else 8
+    rows = []
+    for number in range(size + 1):
+        if number in offsets:
+            generation, offset = offsets[number]
+            rows.append(b'\x01' + offset.to_bytes(offset_width, 'big') + generation.to_bytes(2, 'big'))
+        elif number in compressed:
+            stream_number, index = compressed[number]
+            rows.append(b'\x02' + stream_number.to_bytes(offset_width, 'big') + index.to_bytes(2, 'big'))
+        else:
+            rows.append(b'\x00' + bytes(offset_width) + (b'\xff\xff' if number == 0 else b'\x00\x01'))
+    content = zlib.compress(b''.join(rows))
+    dst.write(f'{size} 0 obj\n<< /Type /XRef /Size {size + 1} /W [1 {offset_width} 2] {trailer_entries} '
+              f'/Filter /FlateDecode /Length {len(content)} >>\nstream\n'.encode('latin-1'))
+    dst.write(content + f'\nendstream\nendobj\nstartxref\n{start}\n%%EOF\n'.encode('latin-1'))
 
 def remove_pdf_metadata(file_path, output_file_path):
     '''
     Remove metadata from a PDF file.
+    Raise the error when the file cannot be cleaned.
     '''
     try:
-        with open(file_path, 'rb') as f:
-            reader = PyPDF2.PdfFileReader(f)
-            writer = PyPDF2.PdfFileWriter()
-            for i in range(reader.getNumPages()):
-                writer.addPage(reader.getPage(i))
-            writer.addMetadata({})
-            with open(output_file_path, 'wb') as out_f:
-                writer.write(out_f)
+        with open_binary(file_path) as src, open_binary(output_file_path, 'wb') as dst:
+            strip_pdf_objects(src, dst)
         print(f'Metadata removed from PDF: {output_file_path}')
     except Exception as e:
         print(f'Failed to remove PDF metadata: {e}')
+        if isinstance(output_file_path, str) and os.path.exists(output_file_path):
+            os.remove(output_file_path)
+        raise
+
+## ZIP CONTAINERS
+
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+ZIP_CENTRAL_HEADER = struct.Struct('<4s4B4H3L5H2L')
+ZIP_END_OF_CENTRAL_DIRECTORY = struct.Struct('<4s4H2LH')
+ZIP_DATA_DESCRIPTOR_FLAG = 0x08
+
+EMPTY_CORE_PROPERTIES = (
+    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    b'<cp:coreProperties '
+    b'xmlns:cp="http://schemas.openxmlformats.org/package/2006/metadata/core-properties" '
+    b'xmlns:dc="http://purl.org/dc/elements/1.1/" '
+    b'xmlns:dcterms="http://purl.org/dc/terms/" '
+    b'xmlns:dcmitype="http://purl.org/dc/dcmitype/" '
+    b'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"/>'
+)
+EMPTY_CUSTOM_PROPERTIES = (
+    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    b'<Properties '
+    b'xmlns="http://schemas.openxmlformats.org/officeDocument/2006/custom-properties" '
+    b'xmlns:vt="http://schemas.openxmlformats.org/officeDocument/2006/docPropsVTypes"/>'
+)
+DC_NAMESPACE_PATTERN = re.compile(rb'xmlns:([\w.-]+)\s*=\s*["\']http://purl\.org/dc/elements/1\.1/["\']')
+# Elements required by the EPUB specification, the other DC elements are
+# dropped unless the policy keeps them
+OPF_REQUIRED_ELEMENTS = {b'identifier', b'title', b'language'}
+
+def clean_opf(data):
+    '''
+    Remove the Dublin Core metadata the policy does not keep from an OPF
+    package document, leaving the rest of the document untouched.
+    '''
+    for prefix in set(DC_NAMESPACE_PATTERN.findall(data)):
+        prefix = re.escape(prefix)
+        pattern = re.compile(rb'<' + prefix + rb':([\w-]+)\b[^>]*?(/>|>.*?</' + prefix + rb':\1\s*>)\s*', re.DOTALL)
+        data = pattern.sub(lambda match: match.group(0) if match.group(1) in policy.opf_kept_elements else b'', data)
+    return data
+
+def find_opf_path(zip_file):
+    '''
+    Return the path of the OPF package document of an EPUB archive.
+    '''
+    try:
+        container = ET.fromstring(zip_file.read('META-INF/container.xml'))
+        for rootfile in container.iter('{urn:oasis:names:tc:opendocument:xmlns:container}rootfile'):
+            return rootfile.attrib['full-path']
+    except KeyError:
+        pass
+    for name in zip_file.namelist():
+        if name.endswith('.opf'):
+            return name
+    raise ValueError('No OPF package document found')
+
+def dos_date_time(date_time):
+    '''
+    Convert a ZipInfo date_time tuple to the MS-DOS time and date fields.
+    '''
+    dos_time = (date_time[3] << 11) | (date_time[4] << 5) | (date_time[5] // 2)
+    dos_date = ((date_time[0] - 1980) << 9) | (date_time[1] << 5) | date_time[2]
+    return dos_time, dos_date
+
+def write_zip_member(dst, name, flag_bits, compress_type, date_time, crc, compress_size, file_size, extra, version):
+    '''
+    Write a local file header and return the offset where it starts.
+    '''
+    offset = dst.tell()
+    dos_time, dos_date = dos_date_time(date_time)
+    dst.write(ZIP_LOCAL_HEADER.pack(
+        b'PK\x03\x04', version, flag_bits, compress_type, dos_time, dos_date,
+        crc, compress_size, file_size, len(name), len(extra)
+    ))
+    dst.write(name)
+    dst.write(extra)
+    return offset
+
+def rewrite_zip_metadata(file_path, output_file_path, rewriters):
+    '''
+    Copy a ZIP based document (OOXML, EPUB) member by member.
+    Members listed in rewriters are transformed by the matching function and
+    deflated again; every other member is copied byte for byte, without
+    decompressing it. Nothing is extracted to disk.
+    '''
+    with open_binary(file_path) as src, zipfile.ZipFile(src) as zip_file, \
+            open_binary(output_file_path, 'wb') as dst:
+        infos = zip_file.infolist()
+        if any(max(info.header_offset, info.compress_size, info.file_size) >= 0xFFFFFFFF for info in infos) \
+                or len(infos) >= 0xFFFF:
+            raise ValueError('ZIP64 archives are not supported')
+        if callable(rewriters):
+            rewriters = rewriters(zip_file)
+
+        central_directory = []
+        for info in infos:
+            src.seek(info.header_offset)
+            header = ZIP_LOCAL_HEADER.unpack(src.read(ZIP_LOCAL_HEADER.size))
+            if header[0] != b'PK\x03\x04':
+                raise ValueError(f'Bad local header for {info.filename}')
+            name = src.read(header[9])
+            local_extra = src.read(header[10])
+            flag_bits = info.flag_bits & ~ZIP_DATA_DESCRIPTOR_FLAG
+
+            rewriter = rewriters.get(info.filename)
+            if rewriter is None:
+                # The sizes and CRC come from the central directory, so the
+                # data descriptor is not needed anymore
+                compress_type, crc, compress_size, file_size = info.compress_type, info.CRC, info.compress_size, info.file_size
+                offset = write_zip_member(dst, name, flag_bits, compress_type, info.date_time, crc,
+                                          compress_size, file_size, local_extra, info.extract_version)
+                copy_bytes(src, dst, compress_size)
+            else:
+                data = rewriter(zip_file.read(info))
+                compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+                compressed = compressor.compress(data) + compressor.flush()
+                compress_type, crc, compress_size, file_size = zipfile.ZIP_DEFLATED, zlib.crc32(data), len(compressed), len(data)
+                flag_bits &= ~0x01  # Never encrypted once rewritten
+                offset = write_zip_member(dst, name, flag_bits, compress_type, info.date_time, crc,
+                                          compress_size, file_size, b'', max(info.extract_version, 20))
+                dst.write(compressed)
+            central_directory.append((info, name, flag_bits, compress_type, crc, compress_size, file_size, offset))
+
+        central_directory_offset = dst.tell()
+        for info, name, flag_bits, compress_type, crc, compress_size, file_size, offset in central_directory:
+            dos_time, dos_date = dos_date_time(info.date_time)
+            version = info.extract_version if compress_type == info.compress_type else max(info.extract_version, 20)
+            dst.write(ZIP_CENTRAL_HEADER.pack(
+                b'PK\x01\x02', info.create_version, info.create_system, version, info.reserved,
+                flag_bits, compress_type, dos_time, dos_date, crc, compress_size, file_size,
+                len(name), len(info.extra), len(info.comment), 0, info.internal_attr, info.external_attr, offset
+            ))
+            dst.write(name)
+            dst.write(info.extra)
+            dst.write(info.comment)
+        central_directory_size = dst.tell() - central_directory_offset
+        dst.write(ZIP_END_OF_CENTRAL_DIRECTORY.pack(
+            b'PK\x05\x06', 0, 0, len(central_directory), len(central_directory),
+            central_directory_size, central_directory_offset, len(zip_file.comment)
+        ))
+        dst.write(zip_file.comment)
+
+def epub_rewriters(zip_file):
+    '''
+    Return the rewriters for an EPUB archive, which depend on where its OPF is.
+    '''
+    return {find_opf_path(zip_file): clean_opf}
 
 def remove_docx_metadata(file_path, output_file_path):
     '''
     Remove metadata from a DOCX file.
+    Raise the error when the file cannot be cleaned.
     '''
     try:
-        doc = docx.Document(file_path)
-        core_props = doc.core_properties
-        for prop in dir(core_props):
-            if not prop.startswith('_') and not callable(getattr(core_props, prop)):
-                setattr(core_props, prop, None)
-        doc.save(output_file_path)
+        rewrite_zip_metadata(file_path, output_file_path, policy.ooxml_rewriters)
         print(f'Metadata removed from DOCX: {output_file_path}')
     except Exception as e:
         print(f'Failed to remove DOCX metadata: {e}')
+        raise
 
 def remove_pptx_metadata(file_path, output_file_path):
     '''
     Remove metadata from a PPTX file.
+    Raise the error when the file cannot be cleaned.
     '''
     try:
-        prs = Presentation(file_path)
-        props = prs.core_properties
-        for prop in dir(props):
-            if not prop.startswith('_') and not callable(getattr(props, prop)):
-                setattr(props, prop, None)
-        prs.save(output_file_path)
+        rewrite_zip_metadata(file_path, output_file_path, policy.ooxml_rewriters)
         print(f'Metadata removed from PPTX: {output_file_path}')
     except Exception as e:
         print(f'Failed to remove PPTX metadata: {e}')
+        raise
 
 def remove_xlsx_metadata(file_path, output_file_path):
     '''
     Remove metadata from an XLSX file.
+    Raise the error when the file cannot be cleaned.
     '''
     try:
-        wb = load_workbook(file_path)
-        wb.properties = None
-        wb.save(output_file_path)
+        rewrite_zip_metadata(file_path, output_file_path, policy.ooxml_rewriters)
         print(f'Metadata removed from XLSX: {output_file_path}')
     except Exception as e:
         print(f'Failed to remove XLSX metadata: {e}')
+        raise
 
 def remove_epub_metadata(file_path, output_file_path):
     '''
     Remove metadata from an EPUB file.
+    Raise the error when the file cannot be cleaned.
     '''
     try:
-        # Create a temporary directory to work with the EPUB file
-        temp_dir = 'temp_epub'
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        # Extract the EPUB file
-        with zipfile.ZipFile(file_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-        
-        # Load the content.opf file
-        opf_path = os.path.join(temp_dir, 'OEBPS', 'content.opf')
-        if not os.path.isfile(opf_path):
-            opf_path = os.path.join(temp_dir, 'content.opf')  # Handle cases where it's directly in root
-        
-        # Parse and modify the content.opf file
-        tree = ET.parse(opf_path)
-        root = tree.getroot()
-        ns = {'dc': 'http://purl.org/dc/elements/1.1/'}
-        
-        # Collect elements to remove
-        elements_to_remove = root.findall('.//dc:*', ns)
-        
-        for elem in elements_to_remove:
-            parent = elem.find('..')  # Find the parent node of the element
-            if parent is not None:
-                parent.remove(elem)
-        
-        # Save the modified content.opf file
-        tree.write(opf_path, encoding='utf-8', xml_declaration=True)
-        
-        # Create a new EPUB file
-        with zipfile.ZipFile(output_file_path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
-            for foldername, subfolders, filenames in os.walk(temp_dir):
-                for filename in filenames:
-                    filepath = os.path.join(foldername, filename)
-                    arcname = os.path.relpath(filepath, temp_dir)
-                    zip_ref.write(filepath, arcname)
-        
-        # Clean up temporary directory
-        shutil.rmtree(temp_dir)
-            
+        rewrite_zip_metadata(file_path, output_file_path, epub_rewriters)
+        print(f'Metadata removed from EPUB: {output_file_path}')
     except Exception as e:
         print(f'Failed to remove EPUB metadata: {e}')
+        raise
 
-## MAIN
+## SCAN
 
-def save_metadata_to_file(metadata, metadata_file_path):
+# Kinds of sensitive fields reported by the scan, in the order of the summary columns
+SENSITIVE_CATEGORIES = ('gps', 'author', 'device', 'datetime', 'software', 'comment', 'xmp', 'iptc')
+EXIF_IFD_POINTER = 0x8769
+GPS_IFD_POINTER = 0x8825
+EXIF_FIELD_CATEGORIES = {
+    0x010E: ('ImageDescription', 'comment'),
+    0x010F: ('Make', 'device'),
+    0x0110: ('Model', 'device'),
+    0x0131: ('Software', 'software'),
+    0x0132: ('DateTime', 'datetime'),
+    0x013B: ('Artist', 'author'),
+    0x8298: ('Copyright', 'author'),
+    0x9003: ('DateTimeOriginal', 'datetime'),
+    0x9004: ('DateTimeDigitized', 'datetime'),
+    0x927C: ('MakerNote', 'device'),
+    0x9286: ('UserComment', 'comment'),
+    0x9C9C: ('XPComment', 'comment'),
+    0x9C9D: ('XPAuthor', 'author'),
+    0xA430: ('CameraOwnerName', 'author'),
+    0xA431: ('BodySerialNumber', 'device'),
+    0xA435: ('LensSerialNumber', 'device'),
+}
+PNG_TEXT_CATEGORIES = {
+    'author': 'author',
+    'copyright': 'author',
+    'creation time': 'datetime',
+    'software': 'software',
+    'comment': 'comment',
+    'description': 'comment',
+    'title': 'title',
+    'xml:com.adobe.xmp': 'xmp',
+}
+# Audio fields by ID3v2 frame, RIFF INFO chunk or Vorbis comment name
+AUDIO_FIELD_CATEGORIES = {
+    **dict.fromkeys(['TPE1', 'TPE2', 'TPE3', 'TPE4', 'TCOM', 'TEXT', 'TOLY', 'TOPE', 'TOWN', 'TCOP', 'TPUB'], 'author'),
+    **dict.fromkeys(['TDRC', 'TDEN', 'TDOR', 'TDRL', 'TDTG', 'TYER', 'TDAT', 'TIME', 'TORY'], 'datetime'),
+    **dict.fromkeys(['TENC', 'TSSE', 'PRIV'], 'software'),
+    **dict.fromkeys(['COMM', 'USLT', 'TXXX', 'APEV2'], 'comment'),
+    **dict.fromkeys(['IART', 'IENG', 'ICOP', 'BEXT'], 'author'),
+    'ICRD': 'datetime', 'ISFT': 'software', 'ICMT': 'comment', 'ISBJ': 'comment', 'IXML': 'device', '_PMX': 'xmp',
+    **dict.fromkeys(['ARTIST', 'PERFORMER', 'COMPOSER', 'COPYRIGHT', 'ORGANIZATION'], 'author'),
+    'DATE': 'datetime', 'ENCODER': 'software', 'ENCODED-BY': 'software', 'COMMENT': 'comment', 'DESCRIPTION': 'comment',
+    'LOCATION': 'gps',
+}
+# Office core.xml and app.xml elements, and EPUB Dublin Core elements, by local name
+DOCUMENT_FIELD_CATEGORIES = {
+    **dict.fromkeys(['creator', 'lastModifiedBy', 'contributor', 'publisher', 'rights', 'Company', 'Manager'], 'author'),
+    **dict.fromkeys(['created', 'modified', 'lastPrinted', 'date'], 'datetime'),
+    **dict.fromkeys(['Application', 'AppVersion', 'Template'], 'software'),
+    **dict.fromkeys(['description', 'keywords', 'subject'], 'comment'),
+}
+PDF_FIELD_CATEGORIES = {
+    '/Author': 'author',
+    '/Creator': 'software',
+    '/Producer': 'software',
+    '/CreationDate': 'datetime',
+    '/ModDate': 'datetime',
+    '/Subject': 'comment',
+    '/Keywords': 'comment',
+}
+
+def parse_exif_fields(data):
     '''
-    Save metadata to a file.
+    Return the sensitive fields of an EXIF block (a TIFF header followed by
+    its IFDs), following the EXIF and GPS sub-IFDs of the first image.
     '''
-    try:
-        # Encode the bytes objects in the metadata dictionary
-        metadata = encode_bytes_in_dict(metadata)
-        
-        # Save the metadata to a file as JSON
-        with open(metadata_file_path, 'w') as f:
-            json.dump(metadata, f, indent=4)
+    byte_order = {b'II': '<', b'MM': '>'}.get(bytes(data[:2]))
+    if byte_order is None or len(data) < 8:
+        raise ValueError('Invalid EXIF header')
+    fields = {}
+    offsets = [struct.unpack_from(byte_order + 'I', data, 4)[0]]
+    seen = set()
+    while offsets:
+        offset = offsets.pop()
+        if offset in seen or offset + 2 > len(data):
+            continue
+        seen.add(offset)
+        count = struct.unpack_from(byte_order + 'H', data, offset)[0]
+        for entry in range(offset + 2, min(offset + 2 + 12 * count, len(data) - 11), 12):
+            tag, _, _, value = struct.unpack_from(byte_order + 'HHII', data, entry)
+            if tag == EXIF_IFD_POINTER:
+                offsets.append(value)
+            elif tag == GPS_IFD_POINTER:
+                # Some cameras write an empty GPS IFD
+                if value + 2 <= len(data) and struct.unpack_from(byte_order + 'H', data, value)[0]:
+                    fields['GPSInfo'] = 'gps'
+            elif tag in EXIF_FIELD_CATEGORIES:
+                name, category = EXIF_FIELD_CATEGORIES[tag]
+                fields[name] = category
+    return fields
+
+def scan_jpeg_fields(image_path):
+    '''
+    Return the sensitive fields of a JPEG file, reading the segments before
+    the image data only.
+    '''
+    fields = {}
+    with open(image_path, 'rb') as f:
+        if f.read(2) != b'\xff\xd8':
+            raise ValueError('Not a JPEG file')
+        while True:
+            marker = f.read(2)
+            if len(marker) != 2 or marker[0] != 0xFF:
+                raise ValueError('Invalid JPEG marker')
+            code = marker[1]
+            while code == 0xFF:  # Fill bytes
+                code = f.read(1)[0]
+            if code == 0xD9 or 0xD0 <= code <= 0xD7 or code == 0x01:
+                if code == 0xD9:
+                    return fields
+                continue
+            length = struct.unpack('>H', f.read(2))[0]
+            if code == 0xDA:  # Start of scan: no metadata segments after it
+                return fields
+            if code == 0xE1:
+                payload = f.read(length - 2)
+                if payload.startswith(b'Exif\x00\x00'):
+                    fields.update(parse_exif_fields(memoryview(payload)[6:]))
+                elif payload.startswith(b'http://ns.adobe.com/xap/1.0/'):
+                    fields['XMP'] = 'xmp'
+                continue
+            if code == 0xED:
+                fields['IPTC'] = 'iptc'
+            elif code == 0xFE:
+                fields['Comment'] = 'comment'
+            f.seek(length - 2, os.SEEK_CUR)
+
+def scan_png_fields(image_path):
+    '''
+    Return the sensitive fields of a PNG file, reading the chunk headers and
+    the metadata chunks only.
+    '''
+    fields = {}
+    with open(image_path, 'rb') as f:
+        if f.read(8) != PNG_SIGNATURE:
+            raise ValueError('Not a PNG file')
+        while True:
+            header = f.read(8)
+            if len(header) != 8:
+                raise ValueError('Unexpected end of file')
+            length, chunk_type = struct.unpack('>I4s', header)
+            if chunk_type == b'IEND':
+                return fields
+            if chunk_type in (b'tEXt', b'iTXt', b'zTXt'):
+                keyword = f.read(min(length, 80)).split(b'\x00', 1)[0].decode('latin1')
+                fields[keyword] = PNG_TEXT_CATEGORIES.get(keyword.lower(), 'comment')
+                f.seek(length - min(length, 80) + 4, os.SEEK_CUR)
+            elif chunk_type == b'eXIf':
+                fields.update(parse_exif_fields(f.read(length)))
+                f.seek(4, os.SEEK_CUR)
+            else:
+                if chunk_type == b'tIME':
+                    fields['tIME'] = 'datetime'
+                f.seek(length + 4, os.SEEK_CUR)
+
+def scan_webp_fields(image_path):
+    '''
+    Return the sensitive fields of a WebP file from its EXIF and XMP chunks.
+    '''
+    fields = {}
+    with open(image_path, 'rb') as f:
+        header = f.read(12)
+        if len(header) != 12 or header[:4] != b'RIFF' or header[8:] != b'WEBP':
+            raise ValueError('Not a WebP file')
+        riff_end = 8 + struct.unpack('<I', header[4:8])[0]
+        position = 12
+        while position + 8 <= riff_end:
+            f.seek(position)
+            chunk = f.read(8)
+            if len(chunk) != 8:
+                break
+            fourcc, size = struct.unpack('<4sI', chunk)
+            if fourcc == b'EXIF':
+                data = f.read(size)
+                fields.update(parse_exif_fields(data[6:] if data.startswith(b'Exif\x00\x00') else data))
+            elif fourcc == b'XMP ':
+                fields['XMP'] = 'xmp'
+            position += 8 + size + (size & 1)
+    return fields
+
+def scan_audio_fields(audio_path):
+    '''
+    Return the sensitive fields of an audio file from its tag blocks.
+    '''
+    try:
+        parsed = parse_audio_tags(audio_path)
+    except (ValueError, struct.error):
+        parsed = None  # Ogg FLAC or Speex streams are left to mutagen
+    if parsed is not None:
+        names = parsed[1]
+    else:
+        from mutagen import File as MutagenFile
+        audio = MutagenFile(audio_path)
+        names = audio.tags.keys() if audio is not None and audio.tags else []
+    fields = {}
+    for name in names:
+        category = AUDIO_FIELD_CATEGORIES.get(name.split(':', 1)[0].strip().upper())
+        if category:
+            fields[name] = category
+    return fields
+
+def document_fields(data):
+    '''
+    Return the non empty elements of an XML properties document that are
+    listed in DOCUMENT_FIELD_CATEGORIES.
+    '''
+    fields = {}
+    for element in ET.fromstring(data).iter():
+        name = element.tag.rsplit('}', 1)[-1]
+        if name in DOCUMENT_FIELD_CATEGORIES and (element.text or '').strip():
+            fields[name] = DOCUMENT_FIELD_CATEGORIES[name]
+    return fields
+
+def scan_office_fields(file_path):
+    '''
+    Return the sensitive fields of a DOCX, XLSX or PPTX file, reading the
+    properties parts straight out of the ZIP directory.
+    '''
+    fields = {}
+    with zipfile.ZipFile(file_path) as zip_file:
+        names = set(zip_file.namelist())
+        for name in ('docProps/core.xml', 'docProps/app.xml'):
+            if name in names:
+                fields.update(document_fields(zip_file.read(name)))
+        if 'docProps/custom.xml' in names and b'<property' in zip_file.read('docProps/custom.xml'):
+            fields['CustomProperties'] = 'comment'
+    return fields
+
+def scan_epub_fields(file_path):
+    '''
+    Return the sensitive fields of an EPUB file from the metadata of its
+    OPF package document.
+    '''
+    with zipfile.ZipFile(file_path) as zip_file:
+        package = ET.fromstring(zip_file.read(find_opf_path(zip_file)))
+    fields = {}
+    for metadata in package.iter('{http://www.idpf.org/2007/opf}metadata'):
+        for element in metadata:
+            name = element.tag.rsplit('}', 1)[-1]
+            if name == 'meta' and element.get('property') == 'dcterms:modified':
+                fields['modified'] = 'datetime'
+            elif element.tag.startswith('{http://purl.org/dc/elements/1.1/}') and name in DOCUMENT_FIELD_CATEGORIES and (element.text or '').strip():
+                fields[name] = DOCUMENT_FIELD_CATEGORIES[name]
+    return fields
+
+def scan_pdf_fields(file_path):
+    '''
+    Return the sensitive fields of a PDF file: the entries of the document
+    information dictionary referenced by the trailer and the XMP stream of
+    the catalog. Only the cross-reference data and these two objects are read.
+    '''
+    from PyPDF2 import PdfReader
+    fields = {}
+    with open(file_path, 'rb') as f:
+        reader = PdfReader(f, strict=False)
+        info = reader.trailer.get('/Info')
+        info = info.get_object() if info is not None else None
+        for key, category in PDF_FIELD_CATEGORIES.items():
+            if info and info.get(key):
+                fields[key.lstrip('/')] = category
+        if '/Metadata' in reader.trailer['/Root']:
+            fields['XMP'] = 'xmp'
+    return fields
+
+def scan_file(file_name):
+    '''
+    Find the sensitive fields of a file of the clean folder without cleaning it.
+    Return a result with the fields found and their categories.
+    '''
+    result = new_result(file_name, 'scanned')
+    file_path = './clean/' + file_name
+    file_extension = os.path.splitext(file_name)[1].lower()
+    try:
+        handler, mismatch = resolve_handler(file_path, file_extension)
+        result['mismatch'] = mismatch
+        if handler is None or handler.scan is None:
+            result['status'] = 'unsupported'
+            return result
+        result['handler'] = handler.name
+        result['fields'] = run_stage(result['stages'], 'scan', handler.scan, file_path, reads=file_path)
+        result['sensitive'] = [category for category in SENSITIVE_CATEGORIES if category in result['fields'].values()]
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = str(e)
+    return result
+
+def run_scan(files, workers=None, max_in_flight=None):
+    '''
+    Scan the files with a thread pool: the scanners mostly wait for small
+    reads, so threads keep the disk busy without the cost of processes.
+    Return the list of per-file results.
+    '''
+    workers = workers or (os.cpu_count() or 1) * 4
+    max_in_flight = max_in_flight or workers * 4
+    results = []
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for file_name in files:
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                results.extend(future.result() for future in done)
+            pending.add(pool.submit(scan_file, file_name))
+        results.extend(future.result() for future in wait(pending)[0])
+    return results
+
+def print_scan_summary(results):
+    '''
+    Print how many files of each format carry each kind of sensitive field.
+    '''
+    table = {}
+    for result in results:
+        row = table.setdefault(result['format'] or '(none)', collections.Counter())
+        row['files'] += 1
+        row[result['status']] += 1
+        if result.get('sensitive'):
+            row['flagged'] += 1
+            row.update(result['sensitive'])
+    columns = ('files', 'flagged') + SENSITIVE_CATEGORIES + ('unsupported', 'error')
+    total = sum(table.values(), collections.Counter())
+    print(f'{"format":<10}' + ''.join(f'{column:>12}' for column in columns))
+    for file_format, row in sorted(table.items()) + [('total', total)]:
+        print(f'{file_format:<10}' + ''.join(f'{row[column]:>12}' for column in columns))
+    for result in results:
+        if result['status'] == 'error':
+            print(f'  {result["file"]}: {result["error"]}')
+
+## SETTINGS
+
+# Process wide settings, applied in the main process and in every worker
+settings = {
+    'compact_metadata': False,
+    'memory_limit': None,  # Bytes the batch may use for the files in flight, None for no limit
+    'keep': [],  # Fields kept by the strippers, see POLICY_FIELDS
+    'time_limit': None,  # Seconds a file may take in the batch, scaled per format, None for no limit
+    'worker_memory': None,  # Address space of each batch worker process in bytes, None for no limit
+}
+BYTE_SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+def configure(new_settings):
+    '''
+    Update the process wide settings. Used as initializer of the worker processes.
+    '''
+    global policy
+    settings.update(new_settings)
+    if 'keep' in new_settings:
+        policy = StripPolicy(settings['keep'])
+
+def parse_byte_size(value):
+    '''
+    Parse a size such as 4096, 512M or 3G (powers of 1024).
+    '''
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*', value, re.IGNORECASE)
+    if match is None:
+        raise argparse.ArgumentTypeError(f'invalid size: {value!r}')
+    return int(float(match.group(1)) * BYTE_SIZE_UNITS[match.group(2).upper()])
+
+def check_memory_budget(needed, what):
+    '''
+    Raise MemoryError when an operation would need more memory than the
+    configured limit, instead of letting the container get killed.
+    '''
+    memory_limit = settings['memory_limit']
+    if memory_limit is not None and needed > memory_limit:
+        raise MemoryError(f'{what} needs about {needed // 1024 ** 2} MB, over the memory limit of {memory_limit // 1024 ** 2} MB')
+
+## LIMITS
+
+DEFAULT_TIME_LIMIT = 300
+LIMIT_GRACE_SECONDS = 30  # Time given to a worker to stop by itself before it is killed
+WATCHDOG_SECONDS = 1
+QUARANTINE_PATH = './results/quarantine.jsonl'
+
+class FileTimeout(BaseException):
+    '''
+    Raised in a worker when a file runs over its time limit. It is not an
+    Exception so the handlers, which catch those, let it through.
+    '''
+
+job_limits = threading.local()
+
+def file_time_limit(file_name):
+    '''
+    Return the seconds a file may take, the time limit scaled by the time
+    factor of its handler, or None without a time limit.
+    '''
+    if settings['time_limit'] is None:
+        return None
+    handler = get_handler(os.path.splitext(file_name)[1].lower())
+    return settings['time_limit'] * (handler.time_factor if handler else 1)
+
+def remaining_time():
+    '''
+    Return the seconds left to the file processed by this thread, None
+    without a time limit. Given as timeout to the subprocesses.
+    '''
+    deadline = getattr(job_limits, 'deadline', None)
+    return None if deadline is None else max(0.0, deadline - time.monotonic())
+
+@contextlib.contextmanager
+def time_limit(seconds):
+    '''
+    Bound the time of the block. In the main thread of a worker process an
+    alarm interrupts it with FileTimeout. Threads cannot be interrupted, so
+    only the subprocesses they start are bounded, through remaining_time.
+    '''
+    if seconds is None:
+        yield
+        return
+    job_limits.deadline = time.monotonic() + seconds
+    alarm = threading.current_thread() is threading.main_thread() and hasattr(signal, 'setitimer')
+    if alarm:
+        def expire(signum, frame):
+            raise FileTimeout(f'Timed out after {seconds:g}s')
+        previous_handler = signal.signal(signal.SIGALRM, expire)
+        signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        if alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+        job_limits.deadline = None
+
+def exceeded_limit(e):
+    '''
+    Return the limit, time or memory, that an exception shows a file went
+    over, None for other errors.
+    '''
+    if isinstance(e, (FileTimeout, subprocess.TimeoutExpired)):
+        return 'time'
+    if isinstance(e, MemoryError):
+        return 'memory'
+    return None
+
+job_starts = None  # Queue the worker reports the jobs it starts to, see timed_job
+
+def init_worker(new_settings, starts=None):
+    '''
+    Initializer of the batch worker processes: apply the settings and cap
+    the address space of the worker at the worker memory, so a file that
+    needs more fails with MemoryError instead of exhausting the host.
+    '''
+    global job_starts
+    job_starts = starts
+    configure(new_settings)
+    if settings['worker_memory'] is not None:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (settings['worker_memory'], settings['worker_memory']))
+
+def quarantined_result(file_name, limit, error):
+    result = new_result(file_name, 'quarantined')
+    result['limit'] = limit
+    result['error'] = error
+    return result
+
+def load_quarantine(quarantine_path=QUARANTINE_PATH):
+    '''
+    Return the quarantined files, mapped to their record.
+    '''
+    quarantine = {}
+    try:
+        with open(quarantine_path, encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                quarantine[record['file']] = record
+    except FileNotFoundError:
+        pass
+    return quarantine
+
+def is_quarantined(file_name, quarantine):
+    '''
+    Tell whether a file is quarantined and did not change since.
+    '''
+    record = quarantine.get(file_name)
+    if record is None:
+        return False
+    try:
+        stat = os.stat('./clean/' + file_name)
+    except OSError:
+        return False
+    return (stat.st_size, stat.st_mtime_ns) == (record['size'], record['mtime_ns'])
+
+def skip_quarantined(files, quarantine):
+    '''
+    Yield the files that are not quarantined, or changed since they were.
+    '''
+    for file_name in files:
+        if is_quarantined(file_name, quarantine):
+            print(f'Quarantined, skipping: {file_name}')
+            continue
+        yield file_name
+
+def update_quarantine(results, quarantine_path=QUARANTINE_PATH):
+    '''
+    Add the files of a run that went over a limit to the quarantine, and
+    take out the quarantined files that were processed again successfully.
+    Return the number of files added.
+    '''
+    quarantine = load_quarantine(quarantine_path)
+    added = removed = 0
+    for result in results:
+        if result['status'] != 'quarantined':
+            removed += quarantine.pop(result['file'], None) is not None
+            continue
+        try:
+            stat = os.stat('./clean/' + result['file'])
+        except OSError:
+            continue
+        quarantine[result['file']] = {
+            'file': result['file'],
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'limit': result['limit'],
+            'error': result['error'],
+            'quarantined': datetime.now().isoformat(timespec='seconds'),
+        }
+        added += 1
+    if not added and not removed:
+        return 0
+    os.makedirs(os.path.dirname(quarantine_path), exist_ok=True)
+    partial_quarantine_path = partial_path(quarantine_path)
+    with open(partial_quarantine_path, 'w', encoding='utf-8') as f:
+        for record in quarantine.values():
+            f.write(json.dumps(record) + '\n')
+    os.replace(partial_quarantine_path, quarantine_path)
+    return added
+
+## POLICY
+
+# Fields a policy can keep, everything else is removed
+POLICY_FIELDS = SENSITIVE_CATEGORIES + ('title', 'orientation', 'color_profile')
+EXIF_FIELDS = frozenset({'gps', 'author', 'device', 'datetime', 'software', 'comment', 'orientation'})
+# The fields carried by each metadata container: a container that cannot be
+# split is only kept when the policy keeps all of its fields.
+# JPEG segments by marker and payload prefix; unknown APPn segments are always removed
+JPEG_SEGMENT_FIELDS = {
+    (0xE1, b'Exif\x00\x00'): EXIF_FIELDS,
+    (0xE1, b'http://ns.adobe.com/xap/1.0/'): {'xmp'},
+    (0xE1, b'http://ns.adobe.com/xmp/extension/'): {'xmp'},
+    (0xE2, b'ICC_PROFILE\x00'): {'color_profile'},
+    (0xED, b'Photoshop 3.0\x00'): {'iptc'},
+    (0xFE, b''): {'comment'},
+}
+PNG_CHUNK_FIELDS = {b'eXIf': EXIF_FIELDS, b'tIME': {'datetime'}, b'iCCP': {'color_profile'}}
+PNG_TEXT_CHUNKS = {b'tEXt', b'iTXt', b'zTXt'}
+PNG_KEYWORD_SIZE = 80
+WEBP_CHUNK_FIELDS = {b'EXIF': EXIF_FIELDS, b'XMP ': {'xmp'}, b'ICCP': {'color_profile'}}
+WEBP_VP8X_FLAGS = {b'EXIF': 0x08, b'XMP ': 0x04, b'ICCP': 0x20}
+AUDIO_TAG_FIELDS = frozenset({'title', 'author', 'datetime', 'software', 'comment'})
+# Elements of the OOXML properties parts and Dublin Core elements of the OPF
+CORE_PROPERTY_FIELDS = {
+    b'creator': 'author', b'lastModifiedBy': 'author',
+    b'created': 'datetime', b'modified': 'datetime', b'lastPrinted': 'datetime',
+    b'title': 'title',
+    b'subject': 'comment', b'description': 'comment', b'keywords': 'comment', b'category': 'comment',
+    b'contentStatus': 'comment', b'identifier': 'comment', b'language': 'comment',
+    b'revision': 'software', b'version': 'software',
+}
+APP_PROPERTY_FIELDS = {
+    b'Template': 'software', b'Application': 'software', b'AppVersion': 'software',
+    b'Manager': 'author', b'Company': 'author',
+    b'HyperlinkBase': 'comment', b'TotalTime': 'datetime',
+}
+OPF_ELEMENT_FIELDS = {
+    b'creator': 'author', b'contributor': 'author', b'publisher': 'author', b'rights': 'author',
+    b'date': 'datetime',
+    b'description': 'comment', b'subject': 'comment', b'coverage': 'comment', b'format': 'comment',
+    b'relation': 'comment', b'source': 'comment', b'type': 'comment',
+}
+# Entries of the PDF document information dictionary, the others are comments
+PDF_INFO_FIELDS = {'/Title': 'title', **PDF_FIELD_CATEGORIES}
+# MediaInfo fields of the general track written back by ffmpeg when kept
+VIDEO_KEPT_TAGS = {
+    'title': [('title', 'title'), ('movie_name', 'title'), ('album', 'album')],
+    'author': [('performer', 'artist'), ('composer', 'composer'), ('copyright', 'copyright'), ('publisher', 'publisher')],
+    'comment': [('comment', 'comment'), ('description', 'description'), ('keywords', 'keywords'), ('genre', 'genre')],
+    'datetime': [('recorded_date', 'date'), ('encoded_date', 'creation_time')],
+    'gps': [('xyz', 'location')],
+}
+
+def xml_elements_pattern(names):
+    '''
+    Return a pattern matching the XML elements with one of these local
+    names, whatever their namespace prefix.
+    '''
+    alternatives = b'|'.join(re.escape(name) for name in sorted(names))
+    return re.compile(rb'<((?:[\w.-]+:)?(?:' + alternatives + rb'))\b[^>]*?(?:/>|>.*?</\1\s*>)\s*', re.DOTALL)
+
+def load_policy(path):
+    '''
+    Read a policy file, a JSON object with the fields to keep and,
+    optionally, the fields to drop (every field not kept is dropped anyway):
+    {"keep": ["orientation", "color_profile"], "drop": ["gps", "author"]}
+    Return the list of kept fields.
+    '''
+    try:
+        with open(path) as f:
+            policy = json.load(f)
+        keep, drop = set(policy.get('keep', [])), set(policy.get('drop', []))
+    except (OSError, ValueError, AttributeError, TypeError) as e:
+        raise argparse.ArgumentTypeError(f'invalid policy file {path}: {e}')
+    unknown = (keep | drop) - set(POLICY_FIELDS)
+    if unknown:
+        raise argparse.ArgumentTypeError(f'unknown fields in {path}: {", ".join(sorted(unknown))} (known: {", ".join(POLICY_FIELDS)})')
+    if keep & drop:
+        raise argparse.ArgumentTypeError(f'fields both kept and dropped in {path}: {", ".join(sorted(keep & drop))}')
+    return sorted(keep)
+
+class StripPolicy:
+    '''
+    The fields kept by the strippers, compiled once into lookup tables for
+    every format so the strippers never interpret the policy per file.
+    '''
+    def __init__(self, keep=()):
+        kept = self.kept = frozenset(keep)
+        self.keep_orientation = 'orientation' in kept
+        self.keep_color_profile = 'color_profile' in kept
+
+        prefixes = {}
+        for (code, prefix), fields in JPEG_SEGMENT_FIELDS.items():
+            if fields <= kept:
+                prefixes.setdefault(code, []).append(prefix)
+        self.jpeg_kept_prefixes = {code: tuple(values) for code, values in prefixes.items()}
+        self.png_dropped_chunks = frozenset(chunk for chunk, fields in PNG_CHUNK_FIELDS.items() if not fields <= kept) | PNG_TEXT_CHUNKS
+        self.png_kept_keywords = frozenset(keyword for keyword, field in PNG_TEXT_CATEGORIES.items() if field in kept)
+        self.keep_png_other_text = 'comment' in kept  # Unknown keywords are comments
+        self.keep_png_text = bool(self.png_kept_keywords) or self.keep_png_other_text
+        self.webp_dropped_chunks = frozenset(chunk for chunk, fields in WEBP_CHUNK_FIELDS.items() if not fields <= kept)
+        self.webp_flags_mask = 0xFF & ~sum(WEBP_VP8X_FLAGS[chunk] for chunk in self.webp_dropped_chunks)
+        self.keep_audio_tags = AUDIO_TAG_FIELDS <= kept
+
+        self.ooxml_rewriters = {}
+        dropped = [name for name, field in CORE_PROPERTY_FIELDS.items() if field not in kept]
+        if len(dropped) == len(CORE_PROPERTY_FIELDS):
+            self.ooxml_rewriters['docProps/core.xml'] = lambda data: EMPTY_CORE_PROPERTIES
+        elif dropped:
+            self.ooxml_rewriters['docProps/core.xml'] = functools.partial(xml_elements_pattern(dropped).sub, b'')
+        dropped = [name for name, field in APP_PROPERTY_FIELDS.items() if field not in kept]
+        if dropped:
+            self.ooxml_rewriters['docProps/app.xml'] = functools.partial(xml_elements_pattern(dropped).sub, b'')
+        if 'comment' not in kept:
+            self.ooxml_rewriters['docProps/custom.xml'] = lambda data: EMPTY_CUSTOM_PROPERTIES
+        self.opf_kept_elements = OPF_REQUIRED_ELEMENTS | {name for name, field in OPF_ELEMENT_FIELDS.items() if field in kept}
+
+        self.pdf_kept_info = frozenset(key for key, field in PDF_INFO_FIELDS.items() if field in kept)
+        self.keep_pdf_other_info = 'comment' in kept
+        self.keep_pdf_xmp = 'xmp' in kept
+        self.video_kept_tags = [tag for field in POLICY_FIELDS if field in kept for tag in VIDEO_KEPT_TAGS.get(field, [])]
+
+    def keeps_pdf_info(self, key):
+        return key in self.pdf_kept_info or (key not in PDF_INFO_FIELDS and self.keep_pdf_other_info)
+
+policy = StripPolicy()
+
+## HANDLERS
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.svg'] # , '.tiff', '.heic', '.raw']
+AUDIO_EXTENSIONS = ['.mp3', '.wav', '.ogg', '.flac'] # , '.m4a', '.aac', '.wma', '.alac', '.aiff']
+VIDEO_EXTENSIONS = ['.mp4', '.mkv', '.avi', '.mov', '.webm'] #, '.mpeg', '.mpg', '.3gp', '.wmv', '.flv']
+DOCUMENT_EXTENSIONS = ['.pdf', '.epub', '.mobi', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx', '.txt', '.odt', '.rtf', '.html', '.md']
+HANDLER_ENTRY_POINT_GROUP = 'metadata_cleaner.handlers'
+SNIFF_SIZE = 128
+SPECIFIC_SIGNATURE_SIZE = 4
+
+class FormatHandler:
+    '''
+    The functions used to extract and remove the metadata of a file format.
+    magic is a list of (offset, signature) pairs identifying the content,
+    strip can be None for formats whose metadata can only be extracted,
+    io_bound tells the batch to run the handler in the thread pool and
+    streams tells that extract and strip also accept binary file objects
+    instead of paths, which lets the in-memory API skip temporary files.
+    memory_factor estimates the peak memory needed to process a file as a
+    multiple of its size, for the memory budget of the batch.
+    time_factor scales the time limit of the batch for the format.
+    scan returns the sensitive fields of a file, as a dictionary of field
+    names to SENSITIVE_CATEGORIES, reading as little of it as possible.
+    '''
+    def __init__(self, name, extensions, extract, strip=None, magic=(), io_bound=False, streams=False, memory_factor=1.0, time_factor=1.0, scan=None):
+        self.name = name
+        self.extensions = [extension.lower() for extension in extensions]
+        self.extract = extract
+        self.strip = strip
+        self.magic = list(magic)
+        self.io_bound = io_bound
+        self.streams = streams
+        self.memory_factor = memory_factor
+        self.time_factor = time_factor
+        self.scan = scan
+
+    def __repr__(self):
+        return f'FormatHandler({self.name!r})'
+
+handlers = {}
+magic_signatures = []
+plugins_loaded = False
+
+def register_handler(handler):
+    '''
+    Register a handler for its extensions and magic signatures, replacing
+    any handler previously registered for the same extensions.
+    '''
+    for extension in handler.extensions:
+        handlers[extension] = handler
+    for offset, signature in handler.magic:
+        magic_signatures.append((offset, signature, handler))
+    return handler
+
+def load_plugin_handlers():
+    '''
+    Register the handlers published by other packages under the
+    metadata_cleaner.handlers entry point group. An entry point can point to
+    a FormatHandler, or to a callable returning one or a list of them.
+    '''
+    global plugins_loaded
+    plugins_loaded = True
+    from importlib.metadata import entry_points
+    for entry_point in entry_points(group=HANDLER_ENTRY_POINT_GROUP):
+        try:
+            plugin = entry_point.load()
+            if not isinstance(plugin, FormatHandler) and callable(plugin):
+                plugin = plugin()
+            for handler in (plugin if isinstance(plugin, (list, tuple)) else [plugin]):
+                register_handler(handler)
+        except Exception as e:
+            print(f'Failed to load handler plugin {entry_point.name}: {e}')
+
+def get_handler(file_extension):
+    '''
+    Return the handler for an extension (with the dot, lower case), or None.
+    '''
+    if not plugins_loaded:
+        load_plugin_handlers()
+    return handlers.get(file_extension)
+
+def is_specific_signature(signature):
+    '''
+    Tell whether a magic signature is unlikely to start a file of another
+    format by chance: short printable ones like BM or ID3 can begin any text.
+    '''
+    return len(signature) >= SPECIFIC_SIGNATURE_SIZE or not signature.isascii()
+
+def sniff_handlers(header):
+    '''
+    Return the (handler, signature) pairs whose magic signature matches the
+    header, the longest signature of each handler, the longest first.
+    '''
+    if not plugins_loaded:
+        load_plugin_handlers()
+    matches = {}
+    for offset, signature, handler in magic_signatures:
+        if header.startswith(signature, offset) and len(signature) > len(matches.get(handler, b'')):
+            matches[handler] = signature
+    return sorted(matches.items(), key=lambda item: -len(item[1]))
+
+def resolve_handler(file_path, file_extension, header=None):
+    '''
+    Pick the handler of a file from its first SNIFF_SIZE bytes and its extension.
+    Text formats, whose handlers have no magic signature, are trusted by
+    extension. Otherwise the content only overrides a known extension when
+    its signature is specific, and files whose content does not match a
+    handler with magic signatures are rejected here, before any backend is
+    loaded. The first bytes are read from file_path unless header is given.
+    Return the handler (or None) and a description of the disagreement
+    between extension and content (or None).
+    '''
+    handler = get_handler(file_extension)
+    if handler is not None and not handler.magic:
+        return handler, None
+    if header is None:
+        with open(file_path, 'rb') as f:
+            header = f.read(SNIFF_SIZE)
+    matches = sniff_handlers(header)
+    if matches and any(candidate is handler and len(signature) == len(matches[0][1]) for candidate, signature in matches):
+        return handler, None
+    if handler is not None:
+        matches = [(candidate, signature) for candidate, signature in matches if is_specific_signature(signature)]
+    if not matches:
+        if handler is not None:
+            return None, f'content does not match the {file_extension} extension'
+        return None, None
+    content_handler = matches[0][0]
+    return content_handler, f'extension {file_extension or "(none)"} but content is {content_handler.name}'
+
+def register_image_handler(image_format, extensions, magic=(), memory_factor=1.0, scan=None):
+    '''
+    Register the handler of an image format, which forces the format so a
+    misnamed file is still handled according to its content.
+    '''
+    register_handler(FormatHandler(
+        image_format, extensions,
+        functools.partial(extract_image_metadata, image_format=image_format),
+        functools.partial(remove_image_metadata, image_format=image_format),
+        magic=magic, streams=True, memory_factor=memory_factor, scan=scan,
+    ))
+
+# Memory factors: the segment strippers, the ZIP and PDF rewriters and the
+# audio copy stream the file, while GIF and BMP are decoded by PIL and the
+# Office and EPUB libraries load the whole package
+register_image_handler('jpeg', ['.jpg', '.jpeg'], magic=[(0, b'\xff\xd8\xff')], scan=scan_jpeg_fields)
+register_image_handler('png', ['.png'], magic=[(0, PNG_SIGNATURE)], scan=scan_png_fields)
+register_image_handler('gif', ['.gif'], magic=[(0, b'GIF87a'), (0, b'GIF89a')], memory_factor=8)
+register_image_handler('bmp', ['.bmp'], magic=[(0, b'BM')], memory_factor=2)
+register_image_handler('webp', ['.webp'], magic=[(8, b'WEBP')], scan=scan_webp_fields)
+register_image_handler('svg', ['.svg'], memory_factor=10)  # Text, recognised by its extension
+register_handler(FormatHandler(
+    'audio', AUDIO_EXTENSIONS, extract_audio_metadata, remove_audio_file_metadata,
+    magic=[(0, b'ID3'), (0, b'\xff\xfb'), (0, b'\xff\xfa'), (0, b'\xff\xf3'), (0, b'\xff\xf2'), (0, b'\xff\xe3'), (8, b'WAVE'), (0, b'OggS'), (0, b'fLaC')],
+    scan=scan_audio_fields,
+))
+register_handler(FormatHandler(
+    'video', VIDEO_EXTENSIONS, extract_video_metadata, remove_video_metadata,
+    magic=[(4, b'ftyp'), (4, b'moov'), (4, b'mdat'), (4, b'wide'), (4, b'free'), (0, b'\x1a\x45\xdf\xa3'), (8, b'AVI ')],
+    io_bound=True, time_factor=10,  # Remuxing copies the whole file
+))
+register_handler(FormatHandler('pdf', ['.pdf'], extract_pdf_metadata, remove_pdf_metadata, magic=[(0, b'%PDF-')], streams=True, scan=scan_pdf_fields))
+register_handler(FormatHandler(
+    'docx', ['.docx'], extract_docx_metadata, remove_docx_metadata,
+    magic=[(0, b'PK\x03\x04')], streams=True, memory_factor=4, scan=scan_office_fields,
+))
+register_handler(FormatHandler(
+    'xlsx', ['.xlsx'], extract_xlsx_metadata, remove_xlsx_metadata,
+    magic=[(0, b'PK\x03\x04')], streams=True, memory_factor=30, scan=scan_office_fields,
+))
+register_handler(FormatHandler(
+    'pptx', ['.pptx'], extract_pptx_metadata, remove_pptx_metadata,
+    magic=[(0, b'PK\x03\x04')], streams=True, memory_factor=4, scan=scan_office_fields,
+))
+register_handler(FormatHandler(
+    'epub', ['.epub'], extract_epub_metadata, remove_epub_metadata,
+    magic=[(30, b'mimetypeapplication/epub+zip')], memory_factor=4, scan=scan_epub_fields,
+))
+register_handler(FormatHandler('mobi', ['.mobi'], extract_mobi_metadata, magic=[(60, b'BOOKMOBI')], memory_factor=4))
+register_handler(FormatHandler('text', ['.txt'], extract_text_metadata, memory_factor=0))
+register_handler(FormatHandler(
+    'odt', ['.odt'], extract_odt_metadata,
+    magic=[(30, b'mimetypeapplication/vnd.oasis.opendocument.text')],
+))
+register_handler(FormatHandler('rtf', ['.rtf'], extract_rtf_metadata, magic=[(0, b'{\\rtf')]))
+register_handler(FormatHandler('html', ['.html'], extract_html_metadata, memory_factor=0))
+register_handler(FormatHandler('markdown', ['.md'], extract_md_metadata, memory_factor=0))
+# .doc, .xls and .ppt are binary OLE files that python-docx, openpyxl and
+# python-pptx cannot open, so they are not registered.
+
+## LIBRARY
+
+SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+class BufferReader(io.RawIOBase):
+    '''
+    Seekable read-only binary stream over a buffer (bytearray, memoryview,
+    mmap...) that only copies the bytes being read.
+    '''
+    def __init__(self, buffer):
+        self.view = memoryview(buffer).cast('B')
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        end = len(self.view) if size is None or size < 0 else min(self.position + size, len(self.view))
+        data = self.view[self.position:end].tobytes()
+        self.position = max(end, self.position)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, buffer):
+        data = self.view[self.position:self.position + len(buffer)]
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.position, os.SEEK_END: len(self.view)}[whence]
+        self.position = max(base + offset, 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+def open_buffer(data):
+    '''
+    Return a seekable binary stream over data, which can be bytes, a
+    bytearray, a memoryview or a binary file object, without copying it.
+    File objects that cannot seek are spooled first.
+    '''
+    if hasattr(data, 'read'):
+        if data.seekable():
+            return data
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        shutil.copyfileobj(data, spool, COPY_BUFFER_SIZE)
+        spool.seek(0)
+        return spool
+    if isinstance(data, bytes):
+        return io.BytesIO(data)  # Shares the bytes object instead of copying it
+    return BufferReader(data)
+
+def resolve_buffer_handler(src, file_name):
+    '''
+    Pick the handler of a stream from its first bytes and the extension of
+    file_name. Raise ValueError when no handler supports it.
+    '''
+    file_extension = os.path.splitext(file_name or '')[1].lower()
+    src.seek(0)
+    header = src.read(SNIFF_SIZE)
+    src.seek(0)
+    handler, mismatch = resolve_handler(None, file_extension, header)
+    if handler is None:
+        raise ValueError(mismatch or f'Unsupported file type: {file_extension or "(none)"}')
+    if file_extension not in handler.extensions:
+        file_extension = handler.extensions[0]
+    return handler, file_extension
+
+def run_spooled(handler, src, dst, file_extension):
+    '''
+    Run a handler that only works on paths, through a temporary folder.
+    Return the metadata; the cleaned file is copied to dst unless it is None.
+    '''
+    with tempfile.TemporaryDirectory(prefix='metadata_cleaner_') as folder:
+        input_path = os.path.join(folder, 'input' + file_extension)
+        with open(input_path, 'wb') as f:
+            shutil.copyfileobj(src, f, COPY_BUFFER_SIZE)
+        metadata = handler.extract(input_path)
+        if dst is not None:
+            output_path = os.path.join(folder, 'output' + file_extension)
+            handler.strip(input_path, output_path)
+            if os.path.isfile(output_path):
+                with open(output_path, 'rb') as f:
+                    shutil.copyfileobj(f, dst, COPY_BUFFER_SIZE)
+    return metadata
+
+def extract_buffer_metadata(data, file_name=None):
+    '''
+    Return the metadata of a file held in memory: bytes, a bytearray, a
+    memoryview or a binary file object. file_name is only used for its
+    extension, which text formats need.
+    Raise ValueError when the content is not supported.
+    '''
+    src = open_buffer(data)
+    handler, file_extension = resolve_buffer_handler(src, file_name)
+    if handler.streams:
+        return handler.extract(src)
+    return run_spooled(handler, src, None, file_extension)
+
+def clean_buffer(data, file_name=None, dst=None):
+    '''
+    Remove the metadata of a file held in memory: bytes, a bytearray, a
+    memoryview or a binary file object. file_name is only used for its
+    extension, which text formats need.
+    The cleaned file is written to dst, an empty binary file object, or
+    returned as bytes when dst is not given. Formats handled on disk only
+    (audio, video, EPUB and text) go through a temporary folder.
+    Return the cleaned file (None for formats whose metadata can only be
+    extracted) and the metadata dictionary.
+    Raise ValueError when the content is not supported or cleaning failed,
+    in which case nothing is left in dst.
+    '''
+    src = open_buffer(data)
+    handler, file_extension = resolve_buffer_handler(src, file_name)
+    output = io.BytesIO() if dst is None else dst
+    output_start = output.tell()
+    try:
+        if handler.streams:
+            metadata = handler.extract(src)
+            if handler.strip is None:
+                return None, metadata
+            src.seek(0)
+            handler.strip(src, output)
+        else:
+            metadata = run_spooled(handler, src, output if handler.strip else None, file_extension)
+            if handler.strip is None:
+                return None, metadata
+    except Exception as e:
+        if exceeded_limit(e):
+            raise
+        # Never leave part of a file that looks cleaned in dst
+        if output.seekable():
+            output.seek(output_start)
+            output.truncate()
+        raise ValueError(f'Failed to remove the {handler.name} metadata: {e}') from e
+    if output.tell() == output_start:
+        raise ValueError(f'Failed to remove the {handler.name} metadata')
+    return (output.getvalue() if dst is None else dst), metadata
+
+## MAIN
+
+def json_default(obj):
+    '''
+    Convert the values the json module cannot serialize: bytes become base64
+    strings, dates ISO 8601 strings, numbers such as PIL's IFDRational plain
+    numbers, and anything else (PyPDF2 indirect objects...) its string form.
+    Only called for those values, so the rest of the tree is not copied.
+    '''
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(obj).decode('ascii')
+    if hasattr(obj, 'isoformat'):
+        return obj.isoformat()
+    if isinstance(obj, numbers.Integral):
+        return int(obj)
+    if isinstance(obj, numbers.Number):
+        try:
+            value = float(obj)
+            return value if math.isfinite(value) else str(obj)
+        except (TypeError, ValueError, ZeroDivisionError):
+            return str(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    return str(obj)
+
+def dumps_metadata(metadata, compact=True):
+    '''
+    Serialize metadata to JSON, compact or indented by 2 spaces.
+    orjson is used when installed; the json module writes the same layout.
+    '''
+    if orjson is not None:
+        try:
+            option = orjson.OPT_NON_STR_KEYS | (0 if compact else orjson.OPT_INDENT_2)
+            return orjson.dumps(metadata, default=json_default, option=option).decode('utf-8')
+        except TypeError:
+            pass  # e.g. integers above 64 bits, left to the json module
+    if compact:
+        return json.dumps(metadata, default=json_default, separators=(',', ':'))
+    return json.dumps(metadata, default=json_default, indent=2)
+
+def partial_path(file_path):
+    '''
+    Return the temporary path an output is written to before being renamed
+    to file_path. The extension is kept since some writers (ffmpeg, PIL)
+    pick the format from it.
+    '''
+    root, extension = os.path.splitext(file_path)
+    return f'{root}.partial{extension}'
+
+def remove_partial(file_path):
+    try:
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
+
+def save_metadata_to_file(metadata, metadata_file_path):
+    '''
+    Save metadata to a file.
+    '''
+    try:
+        # Serialize first so a failure never leaves a truncated file
+        content = dumps_metadata(metadata, settings['compact_metadata'])
+        temporary_path = partial_path(metadata_file_path)
+        with open(temporary_path, 'w') as f:
+            f.write(content)
+        os.replace(temporary_path, metadata_file_path)
     except Exception as e:
         print(f'Failed to save metadata to file: {e}')
 
-def encode_bytes_in_dict(obj):
+def serialize_metadata(metadata):
     '''
-    Encode bytes objects in a dictionary to base64 strings.
+    Return the metadata as a compact JSON string.
     '''
-    if isinstance(obj, dict):
-        return {k: encode_bytes_in_dict(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [encode_bytes_in_dict(v) for v in obj]
-    elif isinstance(obj, bytes):
-        return base64.b64encode(obj).decode('utf-8')
-    else:
-        return obj
+    return dumps_metadata(metadata)
 
 def results_configurator(file_name):
     '''
@@ -620,7 +2851,9 @@ def results_configurator(file_name):
     results_directory = './results/'
     current_datetime = datetime.now()
     formatted_datetime = current_datetime.strftime('%Y%m%d_%H%M%S')
-    folder_name = results_directory + formatted_datetime + '_' + file_name.replace('.','_')
+    # Files in subfolders of clean keep the same subfolders under results
+    directory, base_name = os.path.split(file_name)
+    folder_name = os.path.join(results_directory, directory, formatted_datetime + '_' + base_name.replace('.','_'))
     os.makedirs(folder_name, exist_ok=True)
 
     return folder_name
@@ -636,43 +2869,1833 @@ def list_files_in_current_folder():
         print(f'Error occurred while listing files: {e}')
         return []
 
-def process_file(file_path, folder_name):
+def matches_patterns(relative_path, include=None, exclude=None):
+    '''
+    Tell whether a path relative to the input folder passes the include and
+    exclude glob patterns.
+    '''
+    relative_path = relative_path.replace(os.sep, '/')
+    if exclude and any(fnmatch.fnmatchcase(relative_path, pattern) for pattern in exclude):
+        return False
+    return not include or any(fnmatch.fnmatchcase(relative_path, pattern) for pattern in include)
+
+def discover_files(root, include=None, exclude=None):
+    '''
+    Yield the paths, relative to root, of the files in root and its
+    subfolders as they are found. Folders matching an exclude pattern
+    (e.g. 'tmp/*') are not entered.
+    '''
+    folders = ['']
+    while folders:
+        relative_folder = folders.pop()
+        try:
+            with os.scandir(os.path.join(root, relative_folder)) as entries:
+                for entry in entries:
+                    relative_path = os.path.join(relative_folder, entry.name)
+                    if entry.is_dir(follow_symlinks=False):
+                        if matches_patterns(relative_path + '/', exclude=exclude):
+                            folders.append(relative_path)
+                    elif entry.is_file() and matches_patterns(relative_path, include, exclude):
+                        yield relative_path
+        except OSError as e:
+            print(f'Error occurred while listing files: {e}')
+
+def new_result(file_name, status='ok'):
+    '''
+    Return the dictionary describing the outcome of a file.
+    '''
+    return {
+        'file': file_name,
+        'format': os.path.splitext(file_name)[1].lower().lstrip('.'),
+        'status': status,
+        'metadata_file': None,
+        'output_file': None,
+        'error': None,
+        'handler': None,
+        'mismatch': None,
+        'stages': {},
+    }
+
+def file_size(file_path):
+    '''
+    Return the size of the file, 0 if it does not exist.
+    '''
+    try:
+        return os.path.getsize(file_path) if file_path else 0
+    except OSError:
+        return 0
+
+def run_stage(stages, name, func, *args, reads=None, writes=None):
+    '''
+    Run a stage of the processing of a file, recording its wall time, CPU
+    time, the size of the files it reads and writes and its exception if any.
+    '''
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    error = None
+    try:
+        return func(*args)
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        stages[name] = {
+            'wall': round(time.perf_counter() - wall_start, 6),
+            'cpu': round(time.thread_time() - cpu_start, 6),
+            'bytes_read': file_size(reads),
+            'bytes_written': file_size(writes),
+            'error': error,
+        }
+        if error is None and writes and not os.path.exists(writes):
+            stages[name]['error'] = 'No output written'
+
+def process_file(file_path, folder_name, output_file_path=None):
     '''
     Analyze the file and remove any metadata.
+    When output_file_path is given (run layout), the metadata is not saved
+    next to it but returned serialized in the 'metadata_json' key of the
+    result, for the run metadata sink.
+    Return a dictionary describing the outcome for the file.
     '''
+    result = new_result(file_path)
+    stages = result['stages']
     file_extension = os.path.splitext(file_path)[1].lower()
-    new_file_path = folder_name + '/' + file_path
     file_path = './clean/' + file_path
-    metadata_file_path = f'{new_file_path}_metadata.json'
-    output_file_path = f'{new_file_path}_no_metadata{file_extension}'
+    if output_file_path is None:
+        new_file_path = os.path.join(folder_name, os.path.basename(file_path))
+        metadata_file_path = f'{new_file_path}_metadata.json'
+        output_file_path = f'{new_file_path}_no_metadata{file_extension}'
+    else:
+        metadata_file_path = None
     
     try:
-        if file_extension.lower() in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp', '.svg']: # , '.tiff', '.heic', '.raw']:
-            metadata = extract_image_metadata(file_path)
-            save_metadata_to_file(metadata, metadata_file_path)
-            remove_image_metadata(file_path, output_file_path)
-        elif file_extension.lower() in ['.mp3', '.wav', '.ogg']: # , '.m4a', '.aac', '.wma', '.alac', '.aiff', '.flac']:
-            copy_file(file_path, folder_name)
-            rename_file(new_file_path, output_file_path)
-            metadata = extract_audio_metadata(output_file_path)
-            save_metadata_to_file(metadata, metadata_file_path)
-            remove_audio_metadata(output_file_path)
-        elif file_extension.lower() in ['.mp4', '.mkv', '.avi', '.mov', '.webm']: #, '.mpeg', '.mpg', '.3gp', '.wmv', '.flv']:
-            metadata = extract_video_metadata(file_path)
-            save_metadata_to_file(metadata, metadata_file_path)
-            remove_video_metadata(file_path, output_file_path)
-        # elif file_extension.lower() in ['.pdf', '.epub', '.mobi', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx', '.txt', '.odt', '.rtf', '.html', '.md']:
-        #     metadata = extract_document_metadata(file_path)
-        #     save_metadata_to_file(metadata, metadata_file_path)
-        #     remove_document_metadata(file_path, output_file_path)
-        else:
+        handler, mismatch = resolve_handler(file_path, file_extension)
+        if mismatch:
+            print(f'Warning: {file_path}: {mismatch}')
+            result['mismatch'] = mismatch
+        if handler is None:
             print(f'Unsupported file type: {file_extension}')
-            return
-        
-        print(f'Metadata saved to: {metadata_file_path}')
+            result['status'] = 'unsupported'
+            return result
+        result['handler'] = handler.name
+
+        metadata = run_stage(stages, 'extract', handler.extract, file_path, reads=file_path)
+        if metadata_file_path:
+            run_stage(stages, 'serialize', save_metadata_to_file, metadata, metadata_file_path, writes=metadata_file_path)
+        else:
+            result['metadata_json'] = run_stage(stages, 'serialize', serialize_metadata, metadata)
+        if handler.strip is None:
+            print(f'Metadata removal is not supported for {file_extension} files')
+            result['status'] = 'extracted'
+            result['metadata_file'] = metadata_file_path
+            return result
+        # The output only gets its final name once complete, so a crash can
+        # never leave a truncated file that looks cleaned
+        partial_output_path = partial_path(output_file_path)
+        try:
+            run_stage(stages, 'strip', handler.strip, file_path, partial_output_path, reads=file_path, writes=partial_output_path)
+        except BaseException:
+            remove_partial(partial_output_path)
+            raise
+
+        result['metadata_file'] = metadata_file_path
+        failed = [f'{name}: {stage["error"]}' for name, stage in stages.items() if stage['error']]
+        if failed:
+            remove_partial(partial_output_path)
+            result['status'] = 'error'
+            result['error'] = '; '.join(failed)
+            return result
+        os.replace(partial_output_path, output_file_path)
+        result['output_file'] = output_file_path
+        if metadata_file_path:
+            print(f'Metadata saved to: {metadata_file_path}')
         print(f'File without metadata saved to: {output_file_path}\n')
+    except (Exception, FileTimeout) as e:
+        limit = exceeded_limit(e)
+        result['error'] = str(e) or type(e).__name__
+        if limit is None:
+            print(f'An error occurred while processing the file: {result["error"]}')
+            result['status'] = 'error'
+        else:
+            print(f'Quarantining {file_path}, over its {limit} limit: {result["error"]}')
+            result['status'] = 'quarantined'
+            result['limit'] = limit
+
+    return result
+
+## CACHE
+
+CACHE_PATH = './results/cache.sqlite3'
+HASH_BUFFER_SIZE = 1024 * 1024
+
+cache_connections = {}
+
+def hash_file(file_path):
+    '''
+    Return the BLAKE2b digest of the file content as a hex string.
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_BUFFER_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def policy_cache_path(keep):
+    '''
+    Return the cache for the results of a policy, since outputs that kept
+    other fields cannot be reused.
+    '''
+    if not keep:
+        return CACHE_PATH
+    digest = hashlib.blake2b(','.join(sorted(keep)).encode(), digest_size=4).hexdigest()
+    root, extension = os.path.splitext(CACHE_PATH)
+    return f'{root}.{digest}{extension}'
+
+def open_cache(cache_path):
+    '''
+    Open (and create if needed) the result cache database.
+    Connections are kept per process, since every worker uses its own.
+    '''
+    connection = cache_connections.get(cache_path)
+    if connection is None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        connection = sqlite3.connect(cache_path, timeout=60)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'hash TEXT NOT NULL, extension TEXT NOT NULL, size INTEGER NOT NULL, '
+            'path TEXT NOT NULL, mtime_ns INTEGER NOT NULL, '
+            'metadata_file TEXT NOT NULL, output_file TEXT NOT NULL, '
+            'output_bytes INTEGER NOT NULL, last_used REAL NOT NULL, '
+            'PRIMARY KEY (hash, extension, size))'
+        )
+        connection.execute('CREATE INDEX IF NOT EXISTS entries_path ON entries (path)')
+        connection.commit()
+        cache_connections[cache_path] = connection
+    return connection
+
+def cache_lookup(connection, file_path):
+    '''
+    Look up a previous result for the file.
+    The path, size and mtime are checked first so unchanged files are not
+    even hashed; otherwise the content hash is used, which also catches
+    renamed or touched copies.
+    Return the cached row (or None) and the file key to store a new result.
+    '''
+    stat = os.stat(file_path)
+    extension = os.path.splitext(file_path)[1].lower()
+    row = connection.execute(
+        'SELECT hash, metadata_file, output_file FROM entries '
+        'WHERE path = ? AND size = ? AND mtime_ns = ? AND extension = ?',
+        (file_path, stat.st_size, stat.st_mtime_ns, extension)
+    ).fetchone()
+    file_hash = row[0] if row else hash_file(file_path)
+    if row is None:
+        row = connection.execute(
+            'SELECT hash, metadata_file, output_file FROM entries '
+            'WHERE hash = ? AND extension = ? AND size = ?',
+            (file_hash, extension, stat.st_size)
+        ).fetchone()
+
+    key = (file_hash, extension, stat.st_size, file_path, stat.st_mtime_ns)
+    if row is None:
+        return None, key
+    if not (os.path.isfile(row[1]) and os.path.isfile(row[2])):
+        # The earlier results were removed, so the entry is stale
+        connection.execute('DELETE FROM entries WHERE hash = ? AND extension = ? AND size = ?', key[:3])
+        connection.commit()
+        return None, key
+
+    connection.execute(
+        'UPDATE entries SET path = ?, mtime_ns = ?, last_used = ? WHERE hash = ? AND extension = ? AND size = ?',
+        (file_path, stat.st_mtime_ns, time.time()) + key[:3]
+    )
+    connection.commit()
+    return row, key
+
+def cache_store(connection, key, result):
+    '''
+    Remember the outputs of a successfully processed file.
+    '''
+    output_bytes = os.path.getsize(result['metadata_file']) + os.path.getsize(result['output_file'])
+    file_hash, extension, size, file_path, mtime_ns = key
+    connection.execute(
+        'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (file_hash, extension, size, file_path, mtime_ns,
+         result['metadata_file'], result['output_file'], output_bytes, time.time())
+    )
+    connection.commit()
+
+def evict_cache(cache_path, max_bytes):
+    '''
+    Delete the least recently used results until the cached outputs fit
+    in max_bytes. Return the number of evicted entries.
+    '''
+    connection = open_cache(cache_path)
+    total = connection.execute('SELECT COALESCE(SUM(output_bytes), 0) FROM entries').fetchone()[0]
+    evicted = 0
+    rows = connection.execute(
+        'SELECT hash, extension, size, metadata_file, output_file, output_bytes FROM entries ORDER BY last_used'
+    ).fetchall()
+    for file_hash, extension, size, metadata_file, output_file, output_bytes in rows:
+        if total <= max_bytes:
+            break
+        for path in (metadata_file, output_file):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        try:
+            os.rmdir(os.path.dirname(output_file))
+        except OSError:
+            pass  # The folder still holds other files
+        connection.execute('DELETE FROM entries WHERE hash = ? AND extension = ? AND size = ?', (file_hash, extension, size))
+        total -= output_bytes
+        evicted += 1
+    connection.commit()
+    return evicted
+
+## DEDUP
+
+DEDUP_REMEMBERED_RESULTS = 10000
+DEDUP_INDEX_SIZE = 100000  # Sizes and hashes remembered, beyond that the least recently seen are forgotten
+
+class Deduplicator:
+    '''
+    Find the files of a batch having the same content as an earlier one.
+    Files are grouped by size first, so only files sharing their size with
+    another one are ever hashed. The hashing is left to the caller (it reads
+    whole files, so the batch runs it in its thread pool).
+    The sizes and hashes are kept in LRU order and capped at index_size
+    entries each, so memory does not grow with the tree. A duplicate of a
+    forgotten file is processed again.
+    '''
+
+    def __init__(self, index_size=DEDUP_INDEX_SIZE):
+        self.index_size = index_size
+        self.by_size = collections.OrderedDict()
+        self.by_hash = collections.OrderedDict()
+
+    def remember(self, index, key, file_name):
+        '''
+        Return the file remembered under key, file_name if there was none.
+        '''
+        first = index.setdefault(key, file_name)
+        index.move_to_end(key)
+        if len(index) > self.index_size:
+            index.popitem(last=False)
+        return first
+
+    def group(self, file_name):
+        '''
+        Return the size of file_name and the files to hash, it last, to tell
+        whether it is a duplicate. None are when it is the first of its size.
+        '''
+        try:
+            size = os.path.getsize('./clean/' + file_name)
+        except OSError as e:
+            print(f'Failed to compare {file_name} with the other files: {e}')
+            return None, []
+        first = self.remember(self.by_size, size, file_name)
+        if first == file_name:
+            return size, []
+        if first is None:
+            return size, [file_name]
+        # The first file of this size is only hashed now that it has company
+        self.by_size[size] = None
+        return size, [first, file_name]
+
+    def hash_files(self, file_names):
+        return [(file_name, hash_file('./clean/' + file_name)) for file_name in file_names]
+
+    def representative(self, size, hashes):
+        '''
+        Return the earlier file with the same content as the last of the
+        hashed files, or None if it is the first of its kind.
+        '''
+        for file_name, file_hash in hashes:
+            representative = self.remember(self.by_hash, (size, file_hash), file_name)
+        return None if representative == file_name else representative
+
+def link_file(src_path, dst_path):
+    '''
+    Give dst_path the content of src_path, with a hard link when possible,
+    else a reflink, else a copy. Return the method used.
+    '''
+    try:
+        os.link(src_path, dst_path)
+        return 'hardlink'
+    except FileExistsError:
+        os.remove(dst_path)
+        os.link(src_path, dst_path)
+        return 'hardlink'
+    except OSError:
+        pass
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        if clone_file(src.fileno(), dst.fileno()):
+            return 'reflink'
+        copy_range(src.fileno(), dst.fileno(), 0, os.fstat(src.fileno()).st_size)
+    return 'copy'
+
+def link_duplicate(file_name, representative, run_folder=None):
+    '''
+    Give a duplicate file the outputs of its representative, the result of
+    an identical file processed earlier in the batch. With a run_folder (run
+    layout) the cleaned file is linked into the mirrored tree of the run,
+    otherwise both the cleaned file and the metadata file are linked into
+    a new results folder.
+    Return the result of the duplicate, carrying the time and bytes saved.
+    '''
+    result = new_result(file_name, representative['status'])
+    for key in ('error', 'handler', 'hash', 'limit'):
+        if key in representative:
+            result[key] = representative[key]
+    result['duplicate_of'] = representative['file']
+    result['saved_seconds'] = round(sum(stage['wall'] for stage in representative['stages'].values()), 6)
+    result['saved_bytes'] = file_size('./clean/' + file_name)
+    if representative['status'] not in ('ok', 'extracted', 'cached'):
+        return result
+
+    def link_outputs():
+        file_extension = os.path.splitext(file_name)[1].lower()
+        if run_folder is not None:
+            outputs = {'output_file': os.path.join(run_folder, RUN_FILES_FOLDER, file_name)}
+            os.makedirs(os.path.dirname(outputs['output_file']), exist_ok=True)
+        else:
+            new_file_path = os.path.join(results_configurator(file_name), os.path.basename(file_name))
+            outputs = {
+                'metadata_file': f'{new_file_path}_metadata.json',
+                'output_file': f'{new_file_path}_no_metadata{file_extension}',
+            }
+        for key, path in outputs.items():
+            if representative[key]:
+                link_file(representative[key], path)
+                result[key] = path
+
+    try:
+        run_stage(result['stages'], 'link', link_outputs)
+        linked = result['output_file'] or result['metadata_file']
+        print(f'Duplicate of {representative["file"]}, ' + (f'linked: {linked}' if linked else 'reusing its metadata'))
+    except Exception as e:
+        print(f'Failed to link the outputs of {file_name}: {e}')
+        result['status'] = 'error'
+        result['error'] = str(e)
+    return result
+
+## BATCH
+
+def process_job(file_name, cache_path=None, run_folder=None):
+    '''
+    Process a single file of the batch, creating its results folder first.
+    With a run_folder (run layout) the cleaned file goes to the mirrored
+    tree of the run instead, and the result carries the content hash and
+    the serialized metadata for the sink.
+    When a cache is given, unchanged files reuse their earlier results.
+    Runs inside the worker pools, so it must stay a top-level function.
+    '''
+    if run_folder is not None:
+        output_file_path = os.path.join(run_folder, RUN_FILES_FOLDER, file_name)
+        os.makedirs(os.path.dirname(output_file_path), exist_ok=True)
+        with time_limit(file_time_limit(file_name)):
+            result = process_file(file_name, None, output_file_path)
+        if result['status'] in ('ok', 'extracted'):
+            result['hash'] = hash_file('./clean/' + file_name)
+        return result
+
+    if cache_path is None:
+        folder_name = results_configurator(file_name)
+        with time_limit(file_time_limit(file_name)):
+            return process_file(file_name, folder_name)
+
+    connection = open_cache(cache_path)
+    row, key = cache_lookup(connection, './clean/' + file_name)
+    if row is not None:
+        print(f'Unchanged file, reusing: {row[2]}')
+        result = new_result(file_name, 'cached')
+        result['metadata_file'] = row[1]
+        result['output_file'] = row[2]
+        return result
+
+    folder_name = results_configurator(file_name)
+    with time_limit(file_time_limit(file_name)):
+        result = process_file(file_name, folder_name)
+    if result['status'] == 'ok' and os.path.isfile(result['output_file']):
+        cache_store(connection, key, result)
+    return result
+
+def timed_job(job_id, *args):
+    '''
+    Run process_job in a batch worker process after reporting the job, the
+    worker and the time to the batch. The pool hands jobs to its workers
+    ahead of time, so only the worker knows when a job really started.
+    '''
+    job_starts.put((job_id, os.getpid(), time.time()))
+    return process_job(*args)
+
+def is_io_bound(file_name):
+    '''
+    Tell whether the file is handled by external tools (ffmpeg, mediainfo)
+    and should therefore go to the thread pool instead of the process pool.
+    '''
+    handler = get_handler(os.path.splitext(file_name)[1].lower())
+    return handler is not None and handler.io_bound
+
+def estimate_memory(file_name):
+    '''
+    Estimate the memory needed to process a file of the clean folder from
+    its size and the memory factor of its handler.
+    '''
+    handler = get_handler(os.path.splitext(file_name)[1].lower())
+    return int(file_size('./clean/' + file_name) * (handler.memory_factor if handler else 1))
+
+def collect_result(future, file_name):
+    '''
+    Return the result of a finished job, turning worker crashes into error results.
+    '''
+    try:
+        return future.result()
+    except FileTimeout as e:
+        # The alarm went off outside of the error handling of process_file
+        return quarantined_result(file_name, 'time', str(e))
     except Exception as e:
-        print(f'An error occurred while processing the file: {e}')
+        print(f'An error occurred while processing {file_name}: {e}')
+        result = new_result(file_name, 'error')
+        result['error'] = str(e)
+        return result
+
+def run_batch(files, workers=None, io_workers=None, max_in_flight=None, cache_path=None, run_folder=None, sink=None, journal=None, dedup=True, queue=None, max_tasks_per_child=None, report=None):
+    '''
+    Process the files with a process pool for the CPU bound formats and a
+    thread pool for the subprocess bound ones. At most max_in_flight jobs are
+    submitted at any time so memory stays bounded on large batches.
+    With a memory limit, the estimated memory of the jobs in flight stays
+    under it: files that do not fit wait (while smaller ones go ahead) and
+    a file larger than the limit runs alone.
+    With a time limit, the worker of a file still running LIMIT_GRACE_SECONDS
+    after its limit is killed. A process pool cannot lose a single worker,
+    so the pool is replaced and its other files are submitted again.
+    When a worker dies by itself, the files that may have been running (or
+    were already in the pool when a worker died before) are retried one at
+    a time at the end, the others are submitted again. A file that kills
+    its worker alone is quarantined. With max_tasks_per_child, the process
+    pool is replaced once it ran that many files per worker, so what leaks
+    in the workers does not build up.
+    With a run_folder, the metadata of every file is added to the sink.
+    The progress of every file is recorded in the journal if given, and
+    the outcome of every file in the work queue the files come from.
+    Such files may be None while the queue has nothing to hand out yet.
+    With dedup, only the first of identical files is processed, the others
+    get links to its outputs once it is done. The files sharing their size
+    with an earlier one are hashed in the thread pool, the others go ahead.
+    The results are added to the report as they come instead of being kept.
+    Return the report, a RunReport without a file when none is given.
+    '''
+    workers = workers or os.cpu_count() or 1
+    io_workers = io_workers or workers * 2
+    max_in_flight = max_in_flight or (workers + io_workers) * 2
+    memory_limit = settings['memory_limit']
+    time_limited = settings['time_limit'] is not None
+
+    report = report if report is not None else RunReport()
+    pending = {}
+    estimates = {}
+    deferred = collections.deque()
+    # Jobs of the process pools with the time after which their worker is killed,
+    # their pool, and the worker running them with the time it started them
+    cpu_jobs = {}
+    job_pools = {}
+    started = {}
+    pool_jobs = 0
+    # With a time limit, the queue every process pool reports the started jobs to
+    start_queues = {}
+    job_ids = itertools.count()
+    job_futures = {}
+    job_ids_of = {}
+    # How often files were in the process pool when a worker died, the files
+    # retried alone at the end, and the one running alone
+    crashes = collections.Counter()
+    isolated = collections.deque()
+    alone = None
+    deduplicator = Deduplicator() if dedup else None
+    # Files processed or waiting to be, with the duplicates waiting for them
+    waiting = {}
+    # Hashing jobs of the deduplicator, with the file and its size
+    hashing = {}
+    # Recent results with their metadata, to link the duplicates found later
+    finished = collections.OrderedDict()
+
+    def new_cpu_pool():
+        # Not ProcessPoolExecutor(max_tasks_per_child), which can hang on Python 3.11
+        nonlocal pool_jobs
+        pool_jobs = 0
+        # A queue per pool: a killed worker can leave the lock of its queue taken
+        starts = multiprocessing.SimpleQueue() if time_limited else None
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(dict(settings), starts))
+        if starts is not None:
+            start_queues[pool] = starts
+        return pool
+
+    def forget_job(future):
+        estimates.pop(future, None)
+        cpu_jobs.pop(future, None)
+        job_pools.pop(future, None)
+        started.pop(future, None)
+        job_futures.pop(job_ids_of.pop(future, None), None)
+
+    def add_result(result, metadata_json):
+        if sink is not None and metadata_json is not None and result['status'] in ('ok', 'extracted'):
+            sink.add(result, metadata_json)
+        if journal is not None:
+            journal.finish_file(result)
+        if queue is not None:
+            queue.finish_file(result)
+        report.add(result)
+
+    def add_duplicate(file_name, representative, metadata_json):
+        if journal is not None:
+            journal.start_file(file_name)
+        add_result(link_duplicate(file_name, representative, run_folder), metadata_json)
+
+    def finish(file_name, result):
+        metadata_json = result.pop('metadata_json', None)
+        add_result(result, metadata_json)
+        if deduplicator is not None:
+            for duplicate in waiting.pop(file_name, ()):
+                add_duplicate(duplicate, result, metadata_json)
+            finished[file_name] = (result, metadata_json)
+            if len(finished) > DEDUP_REMEMBERED_RESULTS:
+                finished.popitem(last=False)
+
+    def flush():
+        # Files are only marked done in the journal once their metadata left the sink batch
+        if journal is not None:
+            journal.flush(outcomes=sink is None or not sink.batch)
+
+    def retry_isolated():
+        # One at a time, so a worker that dies again points at its file
+        nonlocal alone
+        while isolated:
+            alone = isolated.popleft()
+            print(f'Retrying {alone} alone, a worker died while it was in flight')
+            submit(alone, 0)
+            while pending:
+                wait_for_slot()
+
+    def replace_cpu_pool(pool, overdue=()):
+        # Every job of a broken pool fails. The pool runs them in submission order,
+        # so when a worker died by itself, the oldest ones were running: they are
+        # retried alone at the end and the others are submitted again. Jobs whose
+        # worker was killed for being overdue are quarantined.
+        nonlocal cpu_pool
+        jobs = [future for future in cpu_jobs if job_pools[future] is pool]
+        wait(jobs)
+        pool.shutdown(wait=False)
+        if pool is cpu_pool:
+            cpu_pool = new_cpu_pool()
+        # The jobs that completed before the pool broke are collected as usual
+        broken = [future for future in jobs if isinstance(future.exception(), BrokenProcessPool)]
+        running = set() if overdue else set(broken[:workers + 1])
+        if pool in start_queues:
+            start_queues.pop(pool).close()
+        for future in broken:
+            estimate = estimates[future]
+            limit = cpu_jobs[future]
+            forget_job(future)
+            file_name = pending.pop(future)
+            if not overdue:
+                crashes[file_name] += 1
+            if future in overdue:
+                print(f'Killed the worker processing {file_name}, over its time limit')
+                finish(file_name, quarantined_result(file_name, 'time', f'Killed after {limit:g}s'))
+            elif file_name == alone:
+                finish(file_name, quarantined_result(file_name, 'crash', f'The worker died: {future.exception()}'))
+            elif future in running or crashes[file_name] > 1:
+                isolated.append(file_name)
+            else:
+                deferred.appendleft((file_name, estimate))
+        flush()
+
+    def collect(done):
+        for future in done:
+            if future in hashing:
+                file_name, size = hashing.pop(future)
+                try:
+                    representative = deduplicator.representative(size, future.result())
+                except OSError as e:
+                    print(f'Failed to compare {file_name} with the other files: {e}')
+                    representative = None
+                dispatch(file_name, representative)
+                continue
+            if future not in pending:
+                continue  # Already handled with the rest of its broken pool
+            if isinstance(future.exception(), BrokenProcessPool):
+                replace_cpu_pool(job_pools[future])
+                continue
+            forget_job(future)
+            file_name = pending.pop(future)
+            finish(file_name, collect_result(future, file_name))
+        flush()
+
+    def kill_overdue():
+        for pool, starts in list(start_queues.items()):
+            while not starts.empty():
+                job_id, pid, since = starts.get()
+                if job_id in job_futures:
+                    started[job_futures[job_id]] = (pid, since)
+            if pool is not cpu_pool and not any(job_pool is pool for job_pool in job_pools.values()):
+                # A pool retired with max_tasks_per_child that finished its jobs
+                start_queues.pop(pool).close()
+        now = time.time()
+        overdue = {future for future, (pid, since) in started.items() if now - since > cpu_jobs[future] and not future.done()}
+        # Killing a worker breaks its pool, which stops the other workers
+        for future in overdue:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(started[future][0], getattr(signal, 'SIGKILL', signal.SIGTERM))
+        for pool in {job_pools[future] for future in overdue}:
+            replace_cpu_pool(pool, overdue)
+
+    def fits(estimate):
+        return memory_limit is None or not pending or sum(estimates.values()) + estimate <= memory_limit
+
+    def submit(file_name, estimate):
+        nonlocal cpu_pool, pool_jobs
+        if journal is not None:
+            journal.start_file(file_name)
+        if is_io_bound(file_name):
+            future = io_pool.submit(process_job, file_name, cache_path, run_folder)
+        else:
+            if max_tasks_per_child and pool_jobs >= max_tasks_per_child * workers:
+                # The retired pool finishes its jobs, then its workers exit
+                cpu_pool.shutdown(wait=False)
+                cpu_pool = new_cpu_pool()
+            job = (timed_job, next(job_ids)) if time_limited else (process_job,)
+            try:
+                future = cpu_pool.submit(*job, file_name, cache_path, run_folder)
+            except BrokenProcessPool:
+                replace_cpu_pool(cpu_pool)
+                future = cpu_pool.submit(*job, file_name, cache_path, run_folder)
+            if time_limited:
+                job_futures[job[1]] = future
+                job_ids_of[future] = job[1]
+            pool_jobs += 1
+            cpu_jobs[future] = file_time_limit(file_name) + LIMIT_GRACE_SECONDS if time_limited else None
+            job_pools[future] = cpu_pool
+        pending[future] = file_name
+        estimates[future] = estimate
+
+    def dispatch(file_name, representative=None):
+        if representative in finished:
+            add_duplicate(file_name, *finished[representative])
+            return
+        if representative in waiting:
+            waiting[representative].append(file_name)
+            return
+        # A representative too old to be remembered is processed again
+        if deduplicator is not None:
+            waiting[file_name] = []
+        estimate = estimate_memory(file_name) if memory_limit is not None else 0
+        if fits(estimate) and len(pending) < max_in_flight:
+            submit(file_name, estimate)
+        else:
+            deferred.append((file_name, estimate))
+
+    def submit_deferred():
+        while deferred and len(pending) < max_in_flight and fits(deferred[0][1]):
+            submit(*deferred.popleft())
+
+    def wait_for_slot(timeout=None):
+        if pending or hashing:
+            if time_limited:
+                timeout = min(timeout or WATCHDOG_SECONDS, WATCHDOG_SECONDS)
+            collect(wait([*pending, *hashing], timeout=timeout, return_when=FIRST_COMPLETED)[0])
+            if time_limited:
+                kill_overdue()
+        submit_deferred()
+
+    cpu_pool = new_cpu_pool()
+    try:
+        with ThreadPoolExecutor(max_workers=io_workers) as io_pool:
+            for file_name in files:
+                if file_name is None:
+                    # The workers of the queue hold the remaining files: write out
+                    # what this one finished, as the others may be waiting for it too
+                    if sink is not None:
+                        sink.flush()
+                    flush()
+                    if pending or hashing:
+                        wait_for_slot(QUEUE_POLL_SECONDS)
+                    elif isolated:
+                        retry_isolated()
+                    else:
+                        time.sleep(QUEUE_POLL_SECONDS)
+                    continue
+                while len(pending) + len(hashing) >= max_in_flight or len(deferred) >= max_in_flight:
+                    wait_for_slot()
+                size, group = deduplicator.group(file_name) if deduplicator is not None else (None, [])
+                if group:
+                    hashing[io_pool.submit(deduplicator.hash_files, group)] = (file_name, size)
+                else:
+                    dispatch(file_name)
+
+            while pending or deferred or hashing:
+                wait_for_slot()
+            retry_isolated()
+    finally:
+        cpu_pool.shutdown()
+        for starts in start_queues.values():
+            starts.close()
+
+    return report
+
+## SINK
+
+RUN_FILES_FOLDER = 'files'
+SINK_FORMATS = ['jsonl', 'sqlite']
+SINK_BATCH_SIZE = 1000
+
+class MetadataSink:
+    '''
+    Append-only store of the metadata of a whole run, as JSON Lines or as a
+    SQLite database, written in batches.
+    Every record holds the path of the file relative to the input folder,
+    its content hash, the path of the cleaned file and the metadata.
+    '''
+    def __init__(self, sink_path, sink_format='jsonl', batch_size=SINK_BATCH_SIZE):
+        self.sink_path = sink_path
+        self.sink_format = sink_format
+        self.batch_size = batch_size
+        self.batch = []
+        if sink_format == 'sqlite':
+            self.connection = sqlite3.connect(sink_path)
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS records ('
+                'path TEXT PRIMARY KEY, hash TEXT, output TEXT, metadata TEXT NOT NULL)'
+            )
+            self.connection.execute('CREATE INDEX IF NOT EXISTS records_hash ON records (hash)')
+        else:
+            self.file = open(sink_path, 'a', encoding='utf-8')
+
+    def add(self, result, metadata_json):
+        self.batch.append((result['file'], result.get('hash'), result['output_file'], metadata_json))
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        if self.sink_format == 'sqlite':
+            self.connection.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?)', self.batch)
+            self.connection.commit()
+        else:
+            # The metadata is already JSON, so it is inserted as is
+            self.file.write(''.join(
+                f'{{"path": {json.dumps(path)}, "hash": {json.dumps(file_hash)}, '
+                f'"output": {json.dumps(output)}, "metadata": {metadata_json}}}\n'
+                for path, file_hash, output, metadata_json in self.batch
+            ))
+            self.file.flush()
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        if self.sink_format == 'sqlite':
+            self.connection.close()
+        else:
+            self.file.close()
+
+def query_sink(sink_path, value):
+    '''
+    Yield the records of a metadata sink whose path or content hash is value.
+    '''
+    if sink_path.endswith('.sqlite3'):
+        connection = sqlite3.connect(sink_path)
+        try:
+            rows = connection.execute(
+                'SELECT path, hash, output, metadata FROM records WHERE path = ? OR hash = ?', (value, value)
+            ).fetchall()
+        finally:
+            connection.close()
+        for path, file_hash, output, metadata in rows:
+            yield {'path': path, 'hash': file_hash, 'output': output, 'metadata': json.loads(metadata)}
+    else:
+        with open(sink_path, encoding='utf-8') as f:
+            for line in f:
+                record = json.loads(line)
+                if value in (record['path'], record['hash']):
+                    yield record
+
+def run_folder_configurator():
+    '''
+    Create the folder holding the cleaned files and the metadata of a run.
+    '''
+    formatted_datetime = datetime.now().strftime('%Y%m%d_%H%M%S')
+    run_folder = os.path.join('./results', formatted_datetime)
+    suffix = 0
+    while True:
+        try:
+            os.makedirs(run_folder)
+            break
+        except FileExistsError:
+            suffix += 1
+            run_folder = os.path.join('./results', f'{formatted_datetime}_{suffix}')
+    os.makedirs(os.path.join(run_folder, RUN_FILES_FOLDER))
+    return run_folder
+
+## JOURNAL
+
+JOURNAL_PATH = './results/journal.sqlite3'
+
+class Journal:
+    '''
+    Write-ahead record of the progress of a run, so that a run that died
+    halfway can be resumed with --resume.
+    Files the run has not reached yet are pending; a file is recorded as
+    in_progress when it is submitted, then as done or failed with its
+    outputs once its result is collected. Both are written by flush, once
+    per scheduling round: a file that is not recorded as done is processed
+    again by --resume anyway.
+    '''
+    def __init__(self, journal_path=JOURNAL_PATH):
+        os.makedirs(os.path.dirname(journal_path), exist_ok=True)
+        self.connection = sqlite3.connect(journal_path, timeout=60)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS runs ('
+            'id INTEGER PRIMARY KEY, started TEXT NOT NULL, layout TEXT NOT NULL, '
+            'run_folder TEXT, sink TEXT, finished INTEGER NOT NULL DEFAULT 0)'
+        )
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'run_id INTEGER NOT NULL, path TEXT NOT NULL, state TEXT NOT NULL, '
+            'attempts INTEGER NOT NULL DEFAULT 0, metadata_file TEXT, output_file TEXT, error TEXT, '
+            'PRIMARY KEY (run_id, path))'
+        )
+        self.connection.commit()
+        self.run_id = None
+        self.started = []
+        self.batch = []
+
+    def start_run(self, layout, run_folder=None, sink_format=None):
+        '''
+        Record a new run. Only the last run can be resumed, so the runs
+        that did not finish are given up.
+        '''
+        self.connection.execute('DELETE FROM files WHERE run_id IN (SELECT id FROM runs WHERE finished = 0)')
+        self.connection.execute('UPDATE runs SET finished = 1 WHERE finished = 0')
+        cursor = self.connection.execute(
+            'INSERT INTO runs (started, layout, run_folder, sink) VALUES (?, ?, ?, ?)',
+            (datetime.now().isoformat(timespec='seconds'), layout, run_folder, sink_format)
+        )
+        self.connection.commit()
+        self.run_id = cursor.lastrowid
+
+    def resume_run(self):
+        '''
+        Continue the latest run that did not finish.
+        Return its layout, run folder and sink format, or None if every run finished.
+        '''
+        row = self.connection.execute(
+            'SELECT id, layout, run_folder, sink FROM runs WHERE finished = 0 ORDER BY id DESC LIMIT 1'
+        ).fetchone()
+        if row is None:
+            return None
+        self.run_id = row[0]
+        return {'layout': row[1], 'run_folder': row[2], 'sink': row[3]}
+
+    def completed_files(self):
+        '''
+        Return the set of files of the run that are done and whose outputs
+        still exist. In-progress and failed files are processed again.
+        '''
+        rows = self.connection.execute(
+            'SELECT path, metadata_file, output_file FROM files WHERE run_id = ? AND state = ?',
+            (self.run_id, 'done')
+        )
+        return {
+            path for path, metadata_file, output_file in rows
+            if all(os.path.isfile(output) for output in (metadata_file, output_file) if output)
+        }
+
+    def start_file(self, file_name):
+        self.started.append((self.run_id, file_name, 'in_progress'))
+
+    def finish_file(self, result):
+        '''
+        Record the outcome of a file. It is only written by the next flush,
+        so the caller can save the metadata of the file first.
+        '''
+        state = 'failed' if result['status'] == 'error' else 'done'
+        self.batch.append((state, result['metadata_file'], result['output_file'], result['error'], self.run_id, result['file']))
+
+    def flush(self, outcomes=True):
+        '''
+        Write the files started since the last flush and, unless outcomes
+        is false, the recorded outcomes, in one transaction.
+        '''
+        if not self.started and not (outcomes and self.batch):
+            return
+        # The files are started first, as their outcomes update them
+        self.connection.executemany(
+            'INSERT INTO files (run_id, path, state, attempts) VALUES (?, ?, ?, 1) '
+            'ON CONFLICT (run_id, path) DO UPDATE SET state = excluded.state, attempts = attempts + 1',
+            self.started
+        )
+        self.started = []
+        if outcomes:
+            self.connection.executemany(
+                'UPDATE files SET state = ?, metadata_file = ?, output_file = ?, error = ? WHERE run_id = ? AND path = ?',
+                self.batch
+            )
+            self.batch = []
+        self.connection.commit()
+
+    def finish_run(self):
+        '''
+        Mark the run as finished and forget its files, which are only needed
+        to resume it.
+        '''
+        self.flush()
+        self.connection.execute('UPDATE runs SET finished = 1 WHERE id = ?', (self.run_id,))
+        self.connection.execute('DELETE FROM files WHERE run_id = ?', (self.run_id,))
+        self.connection.commit()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+## QUEUE
+
+QUEUE_LEASE_SECONDS = 600
+QUEUE_MAX_ATTEMPTS = 3
+QUEUE_CLAIM_SIZE = 16
+QUEUE_ENQUEUE_SIZE = 1000
+QUEUE_POLL_SECONDS = 5
+
+def parse_shard(value):
+    '''
+    Parse a shard given as index/count, e.g. 0/4 for the first of four nodes.
+    '''
+    match = re.fullmatch(r'(\d+)/(\d+)', value.strip())
+    if match is None or not int(match.group(1)) < int(match.group(2)):
+        raise argparse.ArgumentTypeError(f'invalid shard {value!r}, expected index/count with index < count')
+    return int(match.group(1)), int(match.group(2))
+
+def item_key(file_name):
+    return hashlib.blake2b(file_name.encode('utf-8', 'surrogateescape'), digest_size=16).hexdigest()
+
+def in_shard(file_name, shard):
+    '''
+    Tell whether a file belongs to the shard (index, count). The shard comes
+    from a hash of the path, so every node agrees without talking to the others.
+    '''
+    index, count = shard
+    return int(item_key(file_name), 16) % count == index
+
+class WorkQueue:
+    '''
+    Queue of files shared by processes on one host or on several hosts.
+    A file is leased to one worker at a time and its lease is renewed while
+    it is processed; the lease of a worker that died expires and the file is
+    handed to another. Failed files go back to the queue until they were
+    tried max_attempts times.
+    '''
+    def __init__(self, lease_seconds=QUEUE_LEASE_SECONDS, max_attempts=QUEUE_MAX_ATTEMPTS):
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.leased = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self.renew_leases, daemon=True)
+        self.heartbeat.start()
+
+    def renew_leases(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            with self.lock:
+                files = list(self.leased)
+                if not files:
+                    continue
+                try:
+                    self.renew(files)
+                except Exception as e:
+                    print(f'Failed to renew the queue leases: {e}')
+
+    def files(self, new_files=()):
+        '''
+        Yield the files claimed from the queue until none is left.
+        The new files are added to the queue a chunk before every claim,
+        so the work starts before the whole tree is listed.
+        None is yielded while the remaining files are leased by other
+        workers, which may die and leave them to this one, or by this one,
+        as they may fail and go back to the queue.
+        '''
+        new_files = iter(new_files)
+        while True:
+            added = list(itertools.islice(new_files, QUEUE_ENQUEUE_SIZE))
+            if added:
+                self.enqueue(added)
+            with self.lock:
+                claimed = self.claim(QUEUE_CLAIM_SIZE)
+                self.leased.update(claimed)
+                drained = not added and not claimed and not self.leased and self.drained()
+            if drained:
+                return
+            yield from claimed or [None]
+
+    def finish_file(self, result):
+        '''
+        Write the outcome of a file right away, so a failed file is back in
+        the queue while the workers are still there to retry it.
+        '''
+        with self.lock:
+            self.finish([(result['file'], result['status'] != 'error', result['error'])])
+            self.leased.discard(result['file'])
+
+    def close(self):
+        '''
+        Stop renewing the leases. The files still leased are handed to
+        other workers when their lease expires.
+        '''
+        self.stopped.set()
+        self.heartbeat.join()
+
+class SqliteQueue(WorkQueue):
+    '''
+    Work queue in a SQLite database, for workers on one host. SQLite locking
+    is not reliable on network filesystems, use a DirectoryQueue across hosts.
+    '''
+    def __init__(self, queue_path, **kwargs):
+        os.makedirs(os.path.dirname(queue_path) or '.', exist_ok=True)
+        # Transactions are explicit so claims can take the write lock up front
+        self.connection = sqlite3.connect(queue_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS items (path TEXT PRIMARY KEY, state TEXT NOT NULL DEFAULT 'pending', "
+            'owner TEXT, lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, error TEXT)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS items_state ON items (state)')
+        super().__init__(**kwargs)
+
+    def enqueue(self, files):
+        '''
+        Add the files that are not queued yet. Every node can enqueue the
+        same files, the ones already queued keep their state.
+        '''
+        files = iter(files)
+        while True:
+            chunk = [(file_name,) for file_name in itertools.islice(files, 1000)]
+            if not chunk:
+                return
+            with self.lock:
+                self.connection.execute('BEGIN IMMEDIATE')
+                self.connection.executemany('INSERT OR IGNORE INTO items (path) VALUES (?)', chunk)
+                self.connection.execute('COMMIT')
+
+    def claim(self, limit):
+        now = time.time()
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            self.connection.execute(
+                "UPDATE items SET state = 'failed', error = 'Lease expired' "
+                "WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts)
+            )
+            files = [row[0] for row in self.connection.execute(
+                "SELECT path FROM items WHERE state = 'pending' OR (state = 'leased' AND lease_expires < ?) LIMIT ?",
+                (now, limit)
+            )]
+            self.connection.executemany(
+                "UPDATE items SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE path = ?",
+                [(self.owner, now + self.lease_seconds, file_name) for file_name in files]
+            )
+            self.connection.execute('COMMIT')
+        except BaseException:
+            self.connection.execute('ROLLBACK')
+            raise
+        return files
+
+    def renew(self, files):
+        self.connection.executemany(
+            "UPDATE items SET lease_expires = ? WHERE path = ? AND owner = ? AND state = 'leased'",
+            [(time.time() + self.lease_seconds, file_name, self.owner) for file_name in files]
+        )
+
+    def finish(self, outcomes):
+        self.connection.execute('BEGIN IMMEDIATE')
+        self.connection.executemany(
+            "UPDATE items SET state = CASE WHEN ? THEN 'done' WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            'error = ?, owner = NULL, lease_expires = NULL '
+            "WHERE path = ? AND owner = ? AND state = 'leased'",
+            [(ok, self.max_attempts, error, file_name, self.owner) for file_name, ok, error in outcomes]
+        )
+        self.connection.execute('COMMIT')
+
+    def drained(self):
+        '''
+        Tell whether no file is left for this worker: none is pending and
+        none is leased by another worker.
+        '''
+        return self.connection.execute(
+            "SELECT 1 FROM items WHERE state = 'pending' OR (state = 'leased' AND owner != ?) LIMIT 1",
+            (self.owner,)
+        ).fetchone() is None
+
+    def counts(self):
+        return dict(self.connection.execute('SELECT state, COUNT(*) FROM items GROUP BY state'))
+
+    def close(self):
+        super().close()
+        self.connection.close()
+
+class DirectoryQueue(WorkQueue):
+    '''
+    Work queue in a directory of small files, for workers on several hosts
+    sharing a filesystem (NFSv3 or later for the exclusive creates).
+    todo/ has one file per queued file with its attempts and path, leases/
+    one file per leased file whose mtime is renewed by its owner, done/ and
+    failed/ the files that left the queue. Leases expire by mtime, so the
+    clocks of the hosts must agree to well within the lease.
+    '''
+    def __init__(self, queue_path, **kwargs):
+        self.folders = {name: os.path.join(queue_path, name) for name in ('todo', 'leases', 'done', 'failed')}
+        for folder in self.folders.values():
+            os.makedirs(folder, exist_ok=True)
+        self.held = set()
+        self.listing = None
+        super().__init__(**kwargs)
+
+    def path(self, folder, key):
+        return os.path.join(self.folders[folder], key)
+
+    def write_new(self, file_path, text):
+        '''
+        Create a file with its whole content, unless it exists. Return whether it was created.
+        '''
+        temporary_path = f'{os.path.dirname(file_path)}/.{os.path.basename(file_path)}.{self.owner}'
+        with open(temporary_path, 'w', encoding='utf-8', errors='surrogateescape') as f:
+            f.write(text)
+        try:
+            os.link(temporary_path, file_path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(temporary_path)
+
+    def write(self, file_path, text):
+        temporary_path = f'{os.path.dirname(file_path)}/.{os.path.basename(file_path)}.{self.owner}'
+        with open(temporary_path, 'w', encoding='utf-8', errors='surrogateescape') as f:
+            f.write(text)
+        os.replace(temporary_path, file_path)
+
+    def read_item(self, key):
+        with open(self.path('todo', key), encoding='utf-8', errors='surrogateescape') as f:
+            attempts, file_name = f.read().split('\n', 1)
+        return int(attempts), file_name
+
+    def enqueue(self, files):
+        '''
+        Add the files that are not queued yet. Every node can enqueue the
+        same files, the ones already queued keep their state.
+        '''
+        for file_name in files:
+            key = item_key(file_name)
+            if os.path.exists(self.path('done', key)) or os.path.exists(self.path('failed', key)):
+                continue
+            self.write_new(self.path('todo', key), f'0\n{file_name}')
+
+    def take_lease(self, key):
+        '''
+        Create the lease of a file, taking it over if it expired. Return whether this worker holds it.
+        '''
+        lease_path = self.path('leases', key)
+        for _ in range(2):
+            try:
+                fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                pass
+            else:
+                os.write(fd, self.owner.encode())
+                os.close(fd)
+                return True
+            try:
+                if os.stat(lease_path).st_mtime + self.lease_seconds > time.time():
+                    return False
+                # Only one worker can rename the expired lease away
+                stale_path = f'{lease_path}.{self.owner}'
+                os.rename(lease_path, stale_path)
+            except FileNotFoundError:
+                return False
+            if os.stat(stale_path).st_mtime + self.lease_seconds > time.time():
+                # Another worker renewed it in between, give it back
+                with contextlib.suppress(FileExistsError):
+                    os.link(stale_path, lease_path)
+                os.remove(stale_path)
+                return False
+            os.remove(stale_path)
+        return False
+
+    def release(self, key):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path('leases', key))
+
+    def claim(self, limit):
+        files = []
+        restarted = False
+        while len(files) < limit:
+            entry = next(self.listing, None) if self.listing is not None else None
+            if entry is None:
+                # Go through todo/ again, once per claim so an empty queue is not spun on
+                if restarted or files:
+                    break
+                if self.listing is not None:
+                    self.listing.close()
+                self.listing = os.scandir(self.folders['todo'])
+                restarted = True
+                continue
+            key = entry.name
+            if key.startswith('.') or key in self.held or not self.take_lease(key):
+                continue
+            try:
+                attempts, file_name = self.read_item(key)
+            except FileNotFoundError:
+                # Finished by another worker after the listing
+                self.release(key)
+                continue
+            if attempts >= self.max_attempts:
+                self.write(self.path('failed', key), f'{attempts}\n{file_name}\nLease expired')
+                os.remove(self.path('todo', key))
+                self.release(key)
+                continue
+            self.write(self.path('todo', key), f'{attempts + 1}\n{file_name}')
+            self.held.add(key)
+            files.append(file_name)
+        return files
+
+    def renew(self, files):
+        for file_name in files:
+            with contextlib.suppress(FileNotFoundError):
+                os.utime(self.path('leases', item_key(file_name)))
+
+    def finish(self, outcomes):
+        for file_name, ok, error in outcomes:
+            key = item_key(file_name)
+            self.held.discard(key)
+            if ok:
+                self.write(self.path('done', key), file_name)
+                os.remove(self.path('todo', key))
+            else:
+                attempts, _ = self.read_item(key)
+                if attempts >= self.max_attempts:
+                    self.write(self.path('failed', key), f'{attempts}\n{file_name}\n{error}')
+                    os.remove(self.path('todo', key))
+            self.release(key)
+
+    def drained(self):
+        '''
+        Tell whether no file is left for this worker: todo/ only has the
+        files it leased.
+        '''
+        with os.scandir(self.folders['todo']) as entries:
+            return all(entry.name.startswith('.') or entry.name in self.held for entry in entries)
+
+    def counts(self):
+        counts = {name: sum(not name.startswith('.') for name in os.listdir(folder)) for name, folder in self.folders.items()}
+        counts['pending'] = counts.pop('todo') - counts['leases']
+        counts['leased'] = counts.pop('leases')
+        return counts
+
+    def close(self):
+        super().close()
+        if self.listing is not None:
+            self.listing.close()
+
+def open_queue(address, lease_seconds=QUEUE_LEASE_SECONDS, max_attempts=QUEUE_MAX_ATTEMPTS):
+    '''
+    Open the work queue at sqlite:<path> or dir:<path>. A bare path is a
+    SQLite database.
+    '''
+    kind, _, queue_path = address.partition(':')
+    if kind == 'dir':
+        return DirectoryQueue(queue_path, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    if kind == 'sqlite':
+        return SqliteQueue(queue_path, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    return SqliteQueue(address, lease_seconds=lease_seconds, max_attempts=max_attempts)
+
+## REPORT
+
+REPORT_FORMATS = ['jsonl', 'prometheus']
+
+class RunReport:
+    '''
+    Summary and report of a run, fed one result at a time so the results of
+    a whole tree are never held in memory. The JSON Lines report is written
+    as the results come, the Prometheus one from the totals at the end.
+    Only the failed and mismatched files, the slowest ones and the results
+    that change the quarantine are kept.
+    '''
+    def __init__(self, report_path=None, report_format='jsonl', quarantined=(), top=5):
+        self.report_path = report_path
+        self.report_format = report_format
+        self.quarantined = quarantined
+        self.top = top
+        self.files = 0
+        self.statuses = collections.Counter()
+        self.format_statuses = collections.Counter()
+        self.stages = {}
+        self.failures = []
+        self.mismatches = []
+        self.duplicates = 0
+        self.saved_bytes = 0
+        self.saved_seconds = 0.0
+        self.slowest = []  # Heap of the (wall, file) of the slowest files
+        self.quarantine_results = []
+        self.report_file = None
+        if report_path is not None and report_format == 'jsonl':
+            try:
+                os.makedirs(os.path.dirname(report_path) or '.', exist_ok=True)
+                self.report_file = open(report_path, 'w')
+            except OSError as e:
+                print(f'Failed to write the run report: {e}')
+
+    def add(self, result):
+        self.files += 1
+        self.statuses[result['status']] += 1
+        self.format_statuses[result['format'], result['status']] += 1
+        if result['status'] in ('error', 'quarantined'):
+            self.failures.append((result['file'], result['error']))
+        if result.get('mismatch'):
+            self.mismatches.append((result['file'], result['mismatch']))
+        if result.get('duplicate_of'):
+            self.duplicates += 1
+            self.saved_bytes += result['saved_bytes']
+            self.saved_seconds += result['saved_seconds']
+        for name, stage in result['stages'].items():
+            total = self.stages.setdefault((result['format'], name), {
+                'wall': 0.0, 'cpu': 0.0, 'bytes_read': 0, 'bytes_written': 0, 'count': 0, 'errors': 0,
+            })
+            for key in ('wall', 'cpu', 'bytes_read', 'bytes_written'):
+                total[key] += stage[key]
+            total['count'] += 1
+            total['errors'] += 1 if stage['error'] else 0
+        if result['stages']:
+            slow = (sum(stage['wall'] for stage in result['stages'].values()), result['file'])
+            if len(self.slowest) < self.top:
+                heapq.heappush(self.slowest, slow)
+            else:
+                heapq.heappushpop(self.slowest, slow)
+        if result['status'] == 'quarantined' or result['file'] in self.quarantined:
+            self.quarantine_results.append(result)
+        if self.report_file is not None:
+            try:
+                self.report_file.write(json.dumps(result) + '\n')
+            except OSError as e:
+                print(f'Failed to write the run report: {e}')
+                self.report_file.close()
+                self.report_file = None
+
+    def close(self):
+        '''
+        Finish the report file.
+        '''
+        if self.report_path is None:
+            return
+        try:
+            if self.report_format == 'prometheus':
+                self.write_prometheus()
+            elif self.report_file is not None:
+                self.report_file.close()
+                self.report_file = None
+            else:
+                return
+            print(f'Run report saved to: {self.report_path}')
+        except Exception as e:
+            print(f'Failed to write the run report: {e}')
+
+    def write_prometheus(self):
+        '''
+        Write the aggregated measurements in the Prometheus text exposition
+        format, ready for the node exporter textfile collector.
+        '''
+        lines = []
+        metrics = [
+            ('wall', 'metadata_cleaner_stage_seconds_total', 'Wall time spent in each stage.'),
+            ('cpu', 'metadata_cleaner_stage_cpu_seconds_total', 'CPU time spent in each stage.'),
+            ('bytes_read', 'metadata_cleaner_stage_read_bytes_total', 'Bytes read by each stage.'),
+            ('bytes_written', 'metadata_cleaner_stage_written_bytes_total', 'Bytes written by each stage.'),
+            ('count', 'metadata_cleaner_stage_runs_total', 'Number of times each stage ran.'),
+            ('errors', 'metadata_cleaner_stage_errors_total', 'Number of failures of each stage.'),
+        ]
+        for key, metric, description in metrics:
+            lines.append(f'# HELP {metric} {description}')
+            lines.append(f'# TYPE {metric} counter')
+            for (file_format, name), total in sorted(self.stages.items()):
+                lines.append(f'{metric}{{format="{file_format}",stage="{name}"}} {total[key]}')
+
+        lines.append('# HELP metadata_cleaner_files_total Number of processed files.')
+        lines.append('# TYPE metadata_cleaner_files_total counter')
+        for (file_format, status), count in sorted(self.format_statuses.items()):
+            lines.append(f'metadata_cleaner_files_total{{format="{file_format}",status="{status}"}} {count}')
+
+        lines.append('# HELP metadata_cleaner_dedup_saved_bytes_total Bytes of duplicate files not processed again.')
+        lines.append('# TYPE metadata_cleaner_dedup_saved_bytes_total counter')
+        lines.append(f'metadata_cleaner_dedup_saved_bytes_total {self.saved_bytes}')
+        lines.append('# HELP metadata_cleaner_dedup_saved_seconds_total Processing time saved on duplicate files.')
+        lines.append('# TYPE metadata_cleaner_dedup_saved_seconds_total counter')
+        lines.append(f'metadata_cleaner_dedup_saved_seconds_total {self.saved_seconds}')
+
+        os.makedirs(os.path.dirname(self.report_path) or '.', exist_ok=True)
+        with open(self.report_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def print_summary(self):
+        '''
+        Print how many files were cleaned, skipped or failed, followed by the
+        formats and files where most of the time went.
+        '''
+        print(f'Processed {self.files} files: ' + ', '.join(f'{status} {count}' for status, count in sorted(self.statuses.items())))
+        for file_name, error in self.failures:
+            print(f'  {file_name}: {error}')
+        if self.mismatches:
+            print(f'Extension and content mismatches: {len(self.mismatches)}')
+            for file_name, mismatch in self.mismatches:
+                print(f'  {file_name}: {mismatch}')
+        if self.duplicates:
+            print(f'Duplicates linked: {self.duplicates}, saving {self.saved_bytes} bytes and {self.saved_seconds:.3f}s of processing')
+
+        formats = {}
+        for (file_format, name), total in self.stages.items():
+            formats.setdefault(file_format, {})[name] = total['wall']
+        if formats:
+            print('Slowest formats:')
+            for file_format, stages in sorted(formats.items(), key=lambda item: -sum(item[1].values()))[:self.top]:
+                details = ', '.join(f'{name} {wall:.3f}s' for name, wall in stages.items())
+                print(f'  {file_format}: {sum(stages.values()):.3f}s ({details})')
+
+        if self.slowest:
+            print('Slowest files:')
+            for wall, file_name in sorted(self.slowest, reverse=True):
+                print(f'  {file_name}: {wall:.3f}s')
+
+## SERVICE
+
+SERVICE_CHUNK_SIZE = 1024 * 1024
+SERVICE_MAX_HEADER_BYTES = 64 * 1024
+SERVICE_MAX_UPLOAD_BYTES = 4 * 1024 * 1024 * 1024
+SERVICE_TIMEOUT = 300
+HTTP_REASONS = {
+    200: 'OK', 400: 'Bad Request', 404: 'Not Found', 411: 'Length Required', 413: 'Payload Too Large',
+    415: 'Unsupported Media Type', 422: 'Unprocessable Entity', 503: 'Service Unavailable', 504: 'Gateway Timeout',
+}
+
+def clean_upload(input_path, output_path, seconds=None):
+    '''
+    Extract the metadata of an uploaded file and write the cleaned file to
+    output_path, within seconds (the time left to the request) if given.
+    Runs in the executors of the service, so it must stay a top-level
+    function.
+    Return a dictionary with the status, the metadata as JSON and the error.
+    '''
+    file_extension = os.path.splitext(input_path)[1].lower()
+    handler, mismatch = resolve_handler(input_path, file_extension)
+    if handler is None:
+        return {'status': 'unsupported', 'metadata_json': None, 'error': mismatch or f'Unsupported file type: {file_extension}'}
+    with time_limit(seconds):
+        metadata_json = serialize_metadata(handler.extract(input_path))
+        if handler.strip is None:
+            return {'status': 'extracted', 'metadata_json': metadata_json, 'error': None}
+        try:
+            handler.strip(input_path, output_path)
+        except Exception as e:
+            remove_partial(output_path)
+            return {'status': 'error', 'metadata_json': metadata_json, 'error': str(e) or type(e).__name__}
+    if not os.path.isfile(output_path):
+        return {'status': 'error', 'metadata_json': metadata_json, 'error': 'No output written'}
+    return {'status': 'ok', 'metadata_json': metadata_json, 'error': None}
+
+async def read_request_head(reader):
+    '''
+    Read the request line and the headers of an HTTP request.
+    Return the method, the path, the query parameters and the headers.
+    '''
+    head = await reader.readuntil(b'\r\n\r\n')
+    lines = head.decode('latin-1').split('\r\n')
+    method, target, _ = lines[0].split(' ', 2)
+    headers = {}
+    for line in lines[1:]:
+        if line:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+    url = urlsplit(target)
+    return method, url.path, parse_qs(url.query), headers
+
+async def receive_upload(reader, file_path, length):
+    '''
+    Write the length bytes of the request body to file_path.
+    '''
+    with open(file_path, 'wb') as f:
+        remaining = length
+        while remaining:
+            chunk = await reader.read(min(remaining, SERVICE_CHUNK_SIZE))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            f.write(chunk)
+            remaining -= len(chunk)
+
+class CleaningService:
+    '''
+    Long-running service cleaning the files posted to /clean over HTTP,
+    on localhost or a Unix socket. The workers keep the format backends
+    imported between requests.
+    At most max_in_flight uploads are read and processed at once and at
+    most max_queued more wait for a slot; further requests get a 503.
+    A request that takes longer than timeout seconds gets a 504 and gives
+    its slot back. Its job is given the same time, so it stops by itself.
+    '''
+    def __init__(self, workers=None, io_workers=None, max_in_flight=None, max_queued=None, timeout=SERVICE_TIMEOUT):
+        workers = workers or os.cpu_count() or 1
+        io_workers = io_workers or workers * 2
+        self.max_in_flight = max_in_flight or workers + io_workers
+        self.max_queued = self.max_in_flight * 4 if max_queued is None else max_queued
+        self.timeout = timeout
+        self.cpu_pool = ProcessPoolExecutor(max_workers=workers, initializer=configure, initargs=(dict(settings),))
+        self.io_pool = ThreadPoolExecutor(max_workers=io_workers)
+        self.slots = asyncio.Semaphore(self.max_in_flight)
+        self.in_flight = 0
+        self.queued = 0
+        self.orphaned = 0
+        self.counts = {}
+
+    async def handle_connection(self, reader, writer):
+        try:
+            await self.handle_request(reader, writer)
+        except (asyncio.TimeoutError, FileTimeout):
+            await self.send_json(writer, 504, {'error': f'Timed out after {self.timeout}s'})
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as e:
+            await self.send_json(writer, 400, {'error': f'Bad request: {e}'})
+        except ConnectionError:
+            pass  # The client went away
+        except Exception as e:
+            print(f'An error occurred while serving a request: {e}')
+        finally:
+            writer.close()
+
+    async def handle_request(self, reader, writer):
+        '''
+        Serve one request. The timeout covers everything until the file is
+        cleaned; sending the response is only paced by the client.
+        '''
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        remaining = lambda: max(deadline - loop.time(), 0)
+
+        method, path, query, headers = await asyncio.wait_for(read_request_head(reader), remaining())
+        if method == 'GET' and path == '/health':
+            await self.send_json(writer, 200, {
+                'in_flight': self.in_flight, 'queued': self.queued, 'orphaned': self.orphaned, 'files': self.counts,
+            })
+            return
+        if method != 'POST' or path != '/clean':
+            await self.send_json(writer, 404, {'error': 'POST files to /clean?name=<file name>'})
+            return
+        if 'content-length' not in headers:
+            await self.send_json(writer, 411, {'error': 'Content-Length is required'})
+            return
+        length = int(headers['content-length'])
+        if length < 0:
+            await self.send_json(writer, 400, {'error': 'Content-Length cannot be negative'})
+            return
+        if length > SERVICE_MAX_UPLOAD_BYTES:
+            await self.send_json(writer, 413, {'error': f'Uploads are limited to {SERVICE_MAX_UPLOAD_BYTES} bytes'})
+            return
+        if self.in_flight >= self.max_in_flight and self.queued >= self.max_queued:
+            await self.send_json(writer, 503, {'error': 'Too many requests in progress'}, {'Retry-After': '1'})
+            return
+
+        # The upload is only read once a slot is free, so clients sending
+        # faster than files are cleaned are held back by TCP
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), remaining())
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+        work_folder = tempfile.mkdtemp(prefix='metadata_cleaner_')
+        file_name = os.path.basename(query.get('name', ['upload'])[0]) or 'upload'
+        root, extension = os.path.splitext(file_name)
+        input_path = os.path.join(work_folder, 'upload' + extension.lower())
+        output_path = os.path.join(work_folder, 'cleaned' + extension.lower())
+        job = None
+        try:
+            await asyncio.wait_for(receive_upload(reader, input_path, length), remaining())
+            pool = self.io_pool if is_io_bound(file_name) else self.cpu_pool
+            # A zero limit would not be set at all
+            job = pool.submit(clean_upload, input_path, output_path, max(remaining(), 0.01))
+            result = await asyncio.wait_for(asyncio.wrap_future(job), remaining())
+        except BaseException:
+            self.slots.release()
+            self.in_flight -= 1
+            if job is not None and not job.cancel() and not job.done():
+                # A job that already started cannot be cancelled: its files
+                # are removed once it is done
+                self.orphan(job, work_folder)
+            else:
+                shutil.rmtree(work_folder, ignore_errors=True)
+            raise
+        self.slots.release()
+        self.in_flight -= 1
+
+        try:
+            self.counts[result['status']] = self.counts.get(result['status'], 0) + 1
+            if result['status'] == 'unsupported':
+                await self.send_json(writer, 415, {'status': result['status'], 'error': result['error']})
+            elif result['status'] == 'error':
+                await self.send_json(writer, 422, {'status': result['status'], 'error': result['error']})
+            else:
+                cleaned_path = output_path if result['status'] == 'ok' else None
+                await self.send_cleaned(writer, result, root + '_no_metadata' + extension, cleaned_path)
+        finally:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+    def orphan(self, job, work_folder):
+        loop = asyncio.get_running_loop()
+        self.orphaned += 1
+
+        def forget():
+            self.orphaned -= 1
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+        def done(_):
+            with contextlib.suppress(RuntimeError):  # The service stopped
+                loop.call_soon_threadsafe(forget)
+
+        job.add_done_callback(done)
+
+    async def send_json(self, writer, status, body, extra_headers=None):
+        content = json.dumps(body).encode('utf-8')
+        headers = {'Content-Type': 'application/json', 'Content-Length': str(len(content))}
+        headers.update(extra_headers or {})
+        await self.send_head(writer, status, headers)
+        writer.write(content)
+        await writer.drain()
+
+    async def send_head(self, writer, status, headers):
+        lines = [f'HTTP/1.1 {status} {HTTP_REASONS[status]}', 'Connection: close']
+        lines += [f'{name}: {value}' for name, value in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+    async def send_cleaned(self, writer, result, file_name, cleaned_path):
+        '''
+        Send the metadata JSON and the cleaned file (when there is one) as
+        the two parts of a multipart/mixed response. The file is streamed in
+        chunks, waiting for the client to keep up.
+        '''
+        boundary = os.urandom(16).hex()
+        metadata_part = (
+            f'--{boundary}\r\nContent-Type: application/json\r\n\r\n'.encode('latin-1')
+            + result['metadata_json'].encode('utf-8') + b'\r\n'
+        )
+        file_part = b''
+        if cleaned_path:
+            file_part = (
+                f'--{boundary}\r\nContent-Type: application/octet-stream\r\n'
+                f'Content-Disposition: attachment; filename="{file_name}"\r\n\r\n'
+            ).encode('utf-8')
+        closing = f'\r\n--{boundary}--\r\n'.encode('latin-1') if cleaned_path else f'--{boundary}--\r\n'.encode('latin-1')
+        length = len(metadata_part) + len(file_part) + len(closing) + file_size(cleaned_path)
+        await self.send_head(writer, 200, {
+            'Content-Type': f'multipart/mixed; boundary={boundary}',
+            'Content-Length': str(length),
+            'X-Status': result['status'],
+        })
+        writer.write(metadata_part + file_part)
+        if cleaned_path:
+            with open(cleaned_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(SERVICE_CHUNK_SIZE), b''):
+                    writer.write(chunk)
+                    await writer.drain()
+        writer.write(closing)
+        await writer.drain()
+
+    def close(self):
+        self.cpu_pool.shutdown(cancel_futures=True)
+        self.io_pool.shutdown(cancel_futures=True)
+
+async def serve(address, workers=None, io_workers=None, max_in_flight=None, timeout=SERVICE_TIMEOUT):
+    '''
+    Run the cleaning service on address, either host:port or unix:<path>,
+    until interrupted.
+    '''
+    service = CleaningService(workers, io_workers, max_in_flight, timeout=timeout)
+    limit = SERVICE_MAX_HEADER_BYTES
+    if address.startswith('unix:'):
+        server = await asyncio.start_unix_server(service.handle_connection, path=address[len('unix:'):], limit=limit)
+    else:
+        host, _, port = address.rpartition(':')
+        server = await asyncio.start_server(service.handle_connection, host or '127.0.0.1', int(port), limit=limit)
+    print(f'Serving on {address}')
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+def parse_arguments(argv=None):
+    '''
+    Parse the command line arguments.
+    '''
+    parser = argparse.ArgumentParser(description='Remove metadata from the files in the clean folder.')
+    parser.add_argument('--include', action='append', default=None, help='Only process the files matching this glob pattern (repeatable), e.g. "*.jpg".')
+    parser.add_argument('--exclude', action='append', default=None, help='Skip the files and folders matching this glob pattern (repeatable), e.g. "tmp/*".')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes (default: CPU count).')
+    parser.add_argument('--io-workers', type=int, default=None, help='Number of threads for ffmpeg/mediainfo work, or for --scan (default: 2 x workers, 4 x CPU count for --scan).')
+    parser.add_argument('--ffmpeg-jobs', type=int, default=None, help='Maximum number of ffmpeg processes running at once (default: CPU count).')
+    parser.add_argument('--max-in-flight', type=int, default=None, help='Maximum number of jobs submitted at the same time.')
+    parser.add_argument('--memory-limit', type=parse_byte_size, default=None,
+                        help='Approximate memory the files in flight may use, e.g. 3G. Large files wait for room, and images too large to decode within it are skipped.')
+    parser.add_argument('--time-limit', type=float, default=DEFAULT_TIME_LIMIT,
+                        help=f'Seconds a file may take before it is quarantined, scaled up for slow formats such as videos (default: {DEFAULT_TIME_LIMIT}, 0 for no limit).')
+    parser.add_argument('--worker-memory', type=parse_byte_size, default=None,
+                        help='Memory (address space) each worker process may use, e.g. 2G. A file needing more is quarantined.')
+    parser.add_argument('--max-tasks-per-child', type=int, default=None, help='Replace the worker processes once they processed this many files each, so leaks do not build up.')
+    parser.add_argument('--retry-quarantined', action='store_true', help=f'Process the files of {QUARANTINE_PATH} again instead of skipping them.')
+    parser.add_argument('--no-cache', action='store_true', help='Process every file even if it did not change since a previous run.')
+    parser.add_argument('--cache-max-bytes', type=int, default=None, help='Delete the least recently used cached results above this size.')
+    parser.add_argument('--no-dedup', action='store_true', help='Process identical files separately instead of linking the outputs of the first one.')
+    parser.add_argument('--policy', type=load_policy, default=[], metavar='FILE',
+                        help='JSON file listing the fields to keep, e.g. {"keep": ["orientation", "color_profile"]}. '
+                             f'Fields: {", ".join(POLICY_FIELDS)}. Everything else is removed.')
+    parser.add_argument('--keep-icc-profile', action='store_true', help='Keep the ICC colour profiles (adds color_profile to the policy).')
+    parser.add_argument('--keep-orientation', action='store_true', help='Keep the EXIF orientation of images (adds orientation to the policy).')
+    parser.add_argument('--compact-metadata', action='store_true', help='Write the metadata JSON files without indentation.')
+    parser.add_argument('--layout', choices=['folders', 'run'], default='folders',
+                        help='folders: one results folder and metadata file per input file; '
+                             'run: one mirrored tree of cleaned files and one metadata sink for the whole run.')
+    parser.add_argument('--sink', choices=SINK_FORMATS, default='jsonl', help='Format of the metadata sink of the run layout.')
+    parser.add_argument('--query', nargs=2, metavar=('SINK', 'PATH_OR_HASH'), default=None,
+                        help='Print the records of a metadata sink matching a path or content hash, then exit.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue the last run that did not finish, skipping the files it already completed.')
+    parser.add_argument('--shard', type=parse_shard, default=None, metavar='INDEX/COUNT',
+                        help='Only process the files of this shard, split by path hash, e.g. 0/4 on the first of four nodes.')
+    parser.add_argument('--queue', default=None, metavar='ADDRESS',
+                        help='Take the files from a work queue shared with other processes, sqlite:<path> on one host '
+                             'or dir:<path> on a filesystem shared by several hosts. Run the same command again to retry what is left.')
+    parser.add_argument('--lease-seconds', type=float, default=QUEUE_LEASE_SECONDS,
+                        help='Seconds after which the files of a queue worker that stopped are handed to another.')
+    parser.add_argument('--max-attempts', type=int, default=QUEUE_MAX_ATTEMPTS, help='Times a queued file is tried before it is marked failed.')
+    parser.add_argument('--scan', action='store_true',
+                        help='Only report which files carry sensitive metadata (GPS, author, device...), reading their headers, without cleaning them.')
+    parser.add_argument('--serve', default=None, metavar='ADDRESS',
+                        help='Run as a service cleaning the files posted to /clean on ADDRESS, host:port (e.g. 127.0.0.1:8080) or unix:<path>.')
+    parser.add_argument('--request-timeout', type=float, default=SERVICE_TIMEOUT, help='Seconds a service request may take before it gets a 504.')
+    parser.add_argument('--report', default=None, help='Path of the run report (default: ./results/run_<datetime>.jsonl or .prom, report.jsonl in the run folder with --layout run).')
+    parser.add_argument('--report-format', choices=REPORT_FORMATS, default='jsonl', help='Format of the run report.')
+    args = parser.parse_args(argv)
+    if args.queue and (args.resume or args.shard):
+        parser.error('--queue keeps its own progress and splits the work itself, it cannot be used with --resume or --shard')
+    return args
 
 def execution_time(func):
     '''
@@ -680,27 +4703,121 @@ def execution_time(func):
     executing the given function, and measures the time taken for execution.
     The datetime format is 'YYYYMMDD_HHMMSS'.
     '''
-    def wrapper():
+    def wrapper(*args, **kwargs):
         current_datetime = datetime.now()
         formatted_datetime = current_datetime.strftime('%Y%m%d_%H%M%S')
         print(f'Program started at {formatted_datetime}')
-        func()
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
         current_datetime = datetime.now()
         formatted_datetime = current_datetime.strftime('%Y%m%d_%H%M%S')
-        print(f'Program ended at {formatted_datetime}')
+        print(f'Program ended at {formatted_datetime} ({time.perf_counter() - start:.3f}s)')
+        return result
     return wrapper
 
 @execution_time
-def main():
-    files = [f for f in os.listdir('./clean') if os.path.isfile(os.path.join('./clean', f))]
-    for file in files:
-        folder_name = results_configurator(file)
-
+def main(argv=None):
+    args = parse_arguments(argv)
+    if args.query:
+        records = list(query_sink(*args.query))
+        for record in records:
+            print(json.dumps(record, indent=4))
+        return records
+    if args.ffmpeg_jobs:
+        set_ffmpeg_concurrency(args.ffmpeg_jobs)
+    configure({
+        'compact_metadata': args.compact_metadata,
+        'memory_limit': args.memory_limit,
+        'keep': sorted(set(args.policy) | ({'color_profile'} if args.keep_icc_profile else set()) | ({'orientation'} if args.keep_orientation else set())),
+        'time_limit': args.time_limit or None,
+        'worker_memory': args.worker_memory,
+    })
+    if args.serve:
         try:
-            process_file(file, folder_name)
-        except Exception as e:
-            print(f'An error occurred: {e}')
+            asyncio.run(serve(args.serve, args.workers, args.io_workers, args.max_in_flight, args.request_timeout))
+        except KeyboardInterrupt:
+            print('Service stopped')
+        return None
+
+    files = discover_files('./clean', args.include, args.exclude)
+    if args.shard:
+        files = (file_name for file_name in files if in_shard(file_name, args.shard))
+    if args.scan:
+        results = run_scan(files, args.io_workers, args.max_in_flight)
+        print_scan_summary(results)
+        report_extension = 'prom' if args.report_format == 'prometheus' else 'jsonl'
+        report = RunReport(args.report or f'./results/scan_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{report_extension}', args.report_format)
+        for result in results:
+            report.add(result)
+        report.close()
+        return results
+    quarantine = {} if args.retry_quarantined else load_quarantine()
+    if quarantine:
+        files = skip_quarantined(files, quarantine)
+    cache_path = None if args.no_cache else policy_cache_path(settings['keep'])
+    queue = journal = resumed = None
+    if args.queue:
+        queue = open_queue(args.queue, args.lease_seconds, args.max_attempts)
+        files = queue.files(files)
+    elif args.shard:
+        # Shards running side by side keep separate journals
+        journal = Journal(JOURNAL_PATH.replace('.sqlite3', f'_{args.shard[0]}of{args.shard[1]}.sqlite3'))
+    else:
+        journal = Journal()
+    if args.resume:
+        resumed = journal.resume_run()
+    run_folder = sink = None
+    if resumed is not None:
+        # The run keeps the layout it was started with
+        args.layout, run_folder, args.sink = resumed['layout'], resumed['run_folder'], resumed['sink']
+        completed = journal.completed_files()
+        print(f'Resuming the run started in {run_folder or "./results"}, skipping {len(completed)} completed files')
+        files = (file_name for file_name in files if file_name not in completed)
+    elif args.resume:
+        print('No unfinished run to resume, starting a new one')
+    if args.layout == 'run':
+        cache_path = None  # Cached results live in the per-file folders
+        run_folder = run_folder or run_folder_configurator()
+        sink_name = 'metadata.sqlite3' if args.sink == 'sqlite' else 'metadata.jsonl'
+        sink = MetadataSink(os.path.join(run_folder, sink_name), args.sink)
+    if journal is not None and resumed is None:
+        journal.start_run(args.layout, run_folder, args.sink if sink else None)
+    report_extension = 'prom' if args.report_format == 'prometheus' else 'jsonl'
+    if args.report:
+        report_path = args.report
+    elif run_folder:
+        report_path = os.path.join(run_folder, f'report.{report_extension}')
+    else:
+        report_path = f'./results/run_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{report_extension}'
+    report = RunReport(report_path, args.report_format, load_quarantine())
+    try:
+        run_batch(files, args.workers, args.io_workers, args.max_in_flight, cache_path, run_folder, sink, journal, not args.no_dedup, queue, args.max_tasks_per_child, report)
+        if sink is not None:
+            sink.flush()
+        if journal is not None:
+            journal.finish_run()
+        if queue is not None:
+            queue_counts = queue.counts()
+    finally:
+        if sink is not None:
+            sink.close()
+            print(f'Metadata saved to: {sink.sink_path}')
+        if journal is not None:
+            journal.close()
+        if queue is not None:
+            queue.close()
+        report.close()
+    report.print_summary()
+    quarantined = update_quarantine(report.quarantine_results)
+    if quarantined:
+        print(f'Quarantined {quarantined} files, listed in {QUARANTINE_PATH} and skipped by the next runs')
+    if queue is not None:
+        print('Queue: ' + ', '.join(f'{count} {state}' for state, count in sorted(queue_counts.items())))
+    if cache_path and args.cache_max_bytes is not None:
+        evicted = evict_cache(cache_path, args.cache_max_bytes)
+        if evicted:
+            print(f'Evicted {evicted} cached results')
+    return report
 
 if __name__ == '__main__':
     main()
-
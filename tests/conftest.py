@@ -0,0 +1,88 @@
+import os
+import sys
+import struct
+import zipfile
+import zlib
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+CORE_PROPERTIES = (
+    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    b'<cp:coreProperties xmlns:cp="http://schemas.openxmlformats.org/package/2006/metadata/core-properties" '
+    b'xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:creator>Secret Author</dc:creator>'
+    b'<dc:title>Secret Title</dc:title></cp:coreProperties>'
+)
+
+def png_chunk(chunk_type, data):
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+@pytest.fixture
+def png_bytes():
+    '''
+    A 1x1 PNG with a tEXt chunk naming its author.
+    '''
+    return (b'\x89PNG\r\n\x1a\n'
+            + png_chunk(b'IHDR', struct.pack('>IIBBBBB', 1, 1, 8, 0, 0, 0, 0))
+            + png_chunk(b'tEXt', b'Author\x00Secret Author')
+            + png_chunk(b'IDAT', zlib.compress(b'\x00\x00'))
+            + png_chunk(b'IEND', b''))
+
+@pytest.fixture
+def docx_bytes(tmp_path):
+    '''
+    A minimal DOCX package with an author in its core properties.
+    '''
+    path = tmp_path / 'document.docx'
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('[Content_Types].xml', '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types"/>')
+        zip_file.writestr('docProps/core.xml', CORE_PROPERTIES)
+        zip_file.writestr('word/document.xml', '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"/>' * 50)
+    return path.read_bytes()
+
+@pytest.fixture
+def broken_docx_bytes(docx_bytes):
+    '''
+    The DOCX package with the local header of its last member corrupted,
+    which only shows once the first members are copied.
+    '''
+    data = bytearray(docx_bytes)
+    offset = data.rindex(b'PK\x03\x04')
+    data[offset:offset + 4] = b'XXXX'
+    return bytes(data)
+
+def pdf_revision(objects, trailer, previous=b''):
+    '''
+    Return a PDF file, or an incremental update appended to previous, made
+    of the given {number: body} objects and trailer entries.
+    '''
+    data = bytearray(previous or b'%PDF-1.4\n')
+    offsets = {}
+    for number, body in sorted(objects.items()):
+        offsets[number] = len(data)
+        data += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref = len(data)
+    data += b'xref\n'
+    if not previous:
+        data += b'0 1\n0000000000 65535 f\r\n'
+    for number, offset in sorted(offsets.items()):
+        data += b'%d 1\n%010d 00000 n\r\n' % (number, offset)
+    if previous:
+        trailer += b' /Prev %d' % int(previous.rsplit(b'startxref', 1)[1].split()[0])
+    data += b'trailer\n<< %s >>\nstartxref\n%d\n%%%%EOF\n' % (trailer, xref)
+    return bytes(data)
+
+@pytest.fixture
+def pdf_bytes():
+    '''
+    A one page PDF with an author in its document information dictionary.
+    '''
+    content = b'BT /F1 12 Tf 72 720 Td (Hello) Tj ET'
+    return pdf_revision({
+        1: b'<< /Type /Catalog /Pages 2 0 R >>',
+        2: b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        3: b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R >>',
+        4: b'<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content),
+        5: b'<< /Author (Secret Author) /Title (Secret Title) >>',
+    }, b'/Size 6 /Root 1 0 R /Info 5 0 R')
@@ -0,0 +1,153 @@
+import io
+import os
+import struct
+import pytest
+import main
+
+AUDIO = bytes(range(256)) * 64
+
+def id3v2_tag(title):
+    text = b'\x00' + title.encode('latin1')
+    frame = b'TIT2' + struct.pack('>I', len(text)) + b'\x00\x00' + text
+    size = len(frame)
+    syncsafe = bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F])
+    return b'ID3\x03\x00\x00' + syncsafe + frame
+
+def ape_tag(items):
+    body = b''.join(struct.pack('<II', len(value), 0) + key + b'\x00' + value for key, value in items)
+    def block(flags):
+        return b'APETAGEX' + struct.pack('<IIII', 2000, len(body) + 32, len(items), flags) + bytes(8)
+    return block(0xA0000000) + body + block(0x80000000)
+
+def id3v1_tag(title, artist):
+    return b'TAG' + title.ljust(30, b'\x00') + artist.ljust(30, b'\x00') + bytes(30) + b'2001' + bytes(31)
+
+def riff_chunk(chunk_id, data):
+    return chunk_id + struct.pack('<I', len(data)) + data + b'\x00' * (len(data) & 1)
+
+def flac_block(block_type, data, last=False):
+    return bytes([(0x80 if last else 0) | block_type]) + len(data).to_bytes(3, 'big') + data
+
+def vorbis_comments(comments, vendor=b'test encoder'):
+    return (struct.pack('<I', len(vendor)) + vendor + struct.pack('<I', len(comments))
+            + b''.join(struct.pack('<I', len(comment)) + comment for comment in comments))
+
+def ogg_stream(headers, audio_pages=3):
+    '''
+    Build an Ogg stream of the header packets, each on its own pages, and of
+    a few audio pages.
+    '''
+    from mutagen.ogg import OggPage
+    pages = []
+    for packet in headers:
+        pages += OggPage.from_packets([packet], len(pages), default_size=1024)
+    pages[0].first = True
+    for index in range(audio_pages):
+        page = OggPage()
+        page.sequence = len(pages)
+        page.position = 1024 * (index + 1)
+        page.packets = [AUDIO[index::3]]
+        page.last = index == audio_pages - 1
+        pages.append(page)
+    for page in pages:
+        page.serial = 1234
+    return b''.join(page.write() for page in pages), pages[len(pages) - audio_pages:]
+
+VORBIS_ID = b'\x01vorbis' + struct.pack('<IBIiii', 0, 1, 44100, 0, 128000, 0) + b'\xb8\x01'
+VORBIS_SETUP = b'\x05vorbis' + bytes(range(200)) * 20
+OPUS_ID = b'OpusHead\x01\x01' + struct.pack('<HIhB', 312, 48000, 0, 0)
+
+def check_ogg_pages(data):
+    '''
+    Check the CRC of every page, return the pages.
+    '''
+    from mutagen.ogg import OggPage
+    f = io.BytesIO(data)
+    pages = []
+    while f.tell() < len(data):
+        start = f.tell()
+        page = OggPage(f)
+        assert page.write() == data[start:f.tell()]
+        pages.append(page)
+    return pages
+
+def strip(tmp_path, name, data):
+    input_path = tmp_path / name
+    input_path.write_bytes(data)
+    output_path = tmp_path / ('clean_' + name)
+    main.remove_audio_file_metadata(str(input_path), str(output_path))
+    return main.extract_audio_metadata(str(input_path)), output_path.read_bytes()
+
+def test_mp3_tags(tmp_path):
+    data = id3v2_tag('Secret Title') + id3v2_tag('Second Tag') + AUDIO + ape_tag([(b'Artist', b'Someone')]) + id3v1_tag(b'Old Title', b'Old Artist')
+    metadata, cleaned = strip(tmp_path, 'song.mp3', data)
+    assert metadata['TIT2'] == 'Second Tag'
+    assert metadata['TPE1'] == 'Old Artist' and metadata['APEv2'] == '1 items'
+    assert cleaned == AUDIO
+
+def test_mp3_without_tags(tmp_path):
+    metadata, cleaned = strip(tmp_path, 'song.mp3', AUDIO)
+    assert metadata == {} and cleaned == AUDIO
+
+def test_wav_chunks(tmp_path):
+    fmt = riff_chunk(b'fmt ', struct.pack('<HHIIHH', 1, 1, 8000, 8000, 1, 8))
+    info = riff_chunk(b'LIST', b'INFO' + riff_chunk(b'INAM', b'Secret Title\x00') + riff_chunk(b'IART', b'Someone'))
+    odd_data = riff_chunk(b'data', AUDIO + b'\x01')
+    body = fmt + info + odd_data + riff_chunk(b'id3 ', id3v2_tag('Tagged')) + riff_chunk(b'bext', bytes(100))
+    metadata, cleaned = strip(tmp_path, 'sound.wav', b'RIFF' + struct.pack('<I', 4 + len(body)) + b'WAVE' + body)
+    assert metadata['INAM'] == 'Secret Title' and metadata['IART'] == 'Someone'
+    assert metadata['TIT2'] == 'Tagged' and metadata['bext'] == '100 bytes'
+    kept = fmt + odd_data
+    assert cleaned == b'RIFF' + struct.pack('<I', 4 + len(kept)) + b'WAVE' + kept
+
+def test_flac_blocks(tmp_path):
+    stream_info = flac_block(0, bytes(range(34)))
+    seek_table = flac_block(3, bytes(18))
+    comments = flac_block(4, vorbis_comments([b'TITLE=Secret Title', b'ARTIST=Someone']))
+    picture = flac_block(6, bytes(500))
+    data = id3v2_tag('Tagged') + b'fLaC' + stream_info + comments + seek_table + picture + flac_block(1, bytes(100), last=True) + AUDIO
+    metadata, cleaned = strip(tmp_path, 'sound.flac', data)
+    assert metadata == {'title': 'Secret Title', 'artist': 'Someone', 'pictures': 1}
+    # The last block kept is flagged as the last one
+    assert cleaned == b'fLaC' + stream_info + flac_block(3, bytes(18), last=True) + AUDIO
+
+@pytest.mark.parametrize('comment_size', [10, 100000])
+@pytest.mark.parametrize('codec', ['vorbis', 'opus'])
+def test_ogg_comment_header(tmp_path, codec, comment_size):
+    comments = [b'TITLE=Secret Title', b'COMMENT=' + b'x' * comment_size]
+    if codec == 'vorbis':
+        headers = [VORBIS_ID, b'\x03vorbis' + vorbis_comments(comments) + b'\x01', VORBIS_SETUP]
+    else:
+        headers = [OPUS_ID, b'OpusTags' + vorbis_comments(comments)]
+    data, audio_pages = ogg_stream(headers)
+    metadata, cleaned = strip(tmp_path, 'sound.ogg', data)
+    assert metadata['title'] == 'Secret Title' and len(metadata['comment']) == comment_size
+    assert b'Secret' not in cleaned
+
+    # The audio pages are copied as they are, after as many header pages as before
+    pages = check_ogg_pages(cleaned)
+    assert len(pages) == len(check_ogg_pages(data))
+    written = b''.join(page.write() for page in audio_pages)
+    assert cleaned.endswith(written)
+    # The comment header keeps the vendor string only
+    from mutagen.ogg import OggPage
+    packets = OggPage.to_packets(pages[1:len(pages) - len(audio_pages)])
+    magic = b'\x03vorbis' if codec == 'vorbis' else b'OpusTags'
+    assert packets[0].startswith(magic + vorbis_comments([]))
+    assert packets[1:] == headers[2:]
+
+@pytest.mark.parametrize('unsupported', [[], ['copy_file_range'], ['copy_file_range', 'sendfile']])
+def test_copy_range_fallbacks(tmp_path, monkeypatch, unsupported):
+    def fail(*args):
+        raise OSError('Not supported')
+    for name in unsupported:
+        monkeypatch.setattr(os, name, fail)
+    monkeypatch.setattr(main, 'COPY_BUFFER_SIZE', 1000)
+    data = AUDIO * 4
+    (tmp_path / 'input').write_bytes(data)
+    with open(tmp_path / 'input', 'rb') as src, open(tmp_path / 'output', 'wb') as dst:
+        os.write(dst.fileno(), b'head')
+        main.copy_range(src.fileno(), dst.fileno(), 100, len(data) - 200)
+        with pytest.raises(ValueError):
+            main.copy_range(src.fileno(), dst.fileno(), len(data) - 10, 20)
+    assert (tmp_path / 'output').read_bytes()[:4 + len(data) - 200] == b'head' + data[100:-100]
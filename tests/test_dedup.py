@@ -0,0 +1,41 @@
+import json
+import pytest
+import main
+from conftest import png_chunk
+
+@pytest.fixture
+def clean_folder(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'clean').mkdir()
+    return tmp_path / 'clean'
+
+def find_duplicate(deduplicator, file_name):
+    size, group = deduplicator.group(file_name)
+    return deduplicator.representative(size, deduplicator.hash_files(group)) if group else None
+
+def test_index_forgets_least_recent(clean_folder):
+    for name, content in [('a', b'1' * 10), ('b', b'2' * 20), ('c', b'3' * 30), ('a2', b'1' * 10), ('c2', b'3' * 30)]:
+        (clean_folder / name).write_bytes(content)
+    deduplicator = main.Deduplicator(index_size=2)
+    for name in ('a', 'b', 'c'):
+        assert find_duplicate(deduplicator, name) is None
+    # The size of a was the least recently seen, it is forgotten
+    assert find_duplicate(deduplicator, 'a2') is None
+    assert find_duplicate(deduplicator, 'c2') == 'c'
+    assert len(deduplicator.by_size) <= 2 and len(deduplicator.by_hash) <= 2
+
+def run(files, **kwargs):
+    report = main.run_batch(files, workers=1, io_workers=1, max_in_flight=1, report=main.RunReport('report.jsonl'), **kwargs)
+    report.close()
+    with open('report.jsonl') as f:
+        return {result['file']: result.get('duplicate_of') for result in map(json.loads, f)}
+
+@pytest.mark.parametrize('remembered, duplicate_of', [(10, 'a.png'), (1, None)])
+def test_old_representative_processed_again(clean_folder, png_bytes, monkeypatch, remembered, duplicate_of):
+    # One file in flight at a time, so b.png is done before c.png, a copy of
+    # a.png, comes: with a single result remembered, a.png was forgotten
+    monkeypatch.setattr(main, 'DEDUP_REMEMBERED_RESULTS', remembered)
+    (clean_folder / 'a.png').write_bytes(png_bytes)
+    (clean_folder / 'b.png').write_bytes(png_bytes[:-12] + png_chunk(b'tEXt', b'Comment\x00b') + png_bytes[-12:])
+    (clean_folder / 'c.png').write_bytes(png_bytes)
+    assert run(['a.png', 'b.png', 'c.png']) == {'a.png': None, 'b.png': None, 'c.png': duplicate_of}
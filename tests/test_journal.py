@@ -0,0 +1,46 @@
+import json
+import pytest
+import main
+from conftest import png_chunk
+
+class Interrupted(Exception):
+    pass
+
+def read_report(report_path):
+    with open(report_path) as f:
+        return {result['file']: result['status'] for result in map(json.loads, f)}
+
+def test_resume(tmp_path, monkeypatch, png_bytes, broken_docx_bytes):
+    monkeypatch.chdir(tmp_path)
+    clean_folder = tmp_path / 'clean'
+    clean_folder.mkdir()
+    for index in range(8):
+        (clean_folder / f'image_{index}.png').write_bytes(png_bytes[:-12] + png_chunk(b'tEXt', b'Comment\x00%d' % index) + png_bytes[-12:])
+    (clean_folder / 'broken.docx').write_bytes(broken_docx_bytes)
+    discover_files = main.discover_files
+    all_files = set(discover_files('./clean'))
+
+    def interrupted_discovery(*args):
+        # The run dies while the files are still being listed
+        files = discover_files(*args)
+        for _ in range(6):
+            yield next(files)
+        raise Interrupted()
+
+    monkeypatch.setattr(main, 'discover_files', interrupted_discovery)
+    with pytest.raises(Interrupted):
+        main.main(['--no-cache', '--workers', '1', '--max-in-flight', '2', '--report', 'first.jsonl'])
+    first = read_report('first.jsonl')
+    assert first and set(first) < all_files
+
+    monkeypatch.setattr(main, 'discover_files', discover_files)
+    main.main(['--no-cache', '--workers', '1', '--resume', '--report', 'second.jsonl'])
+    second = read_report('second.jsonl')
+    # The completed files are skipped, the failed ones and the others processed
+    completed = {file_name for file_name, status in first.items() if status == 'ok'}
+    assert set(second) == all_files - completed
+    assert second['broken.docx'] == 'error'
+
+    # Nothing is left to resume
+    main.main(['--no-cache', '--workers', '1', '--resume', '--report', 'third.jsonl'])
+    assert set(read_report('third.jsonl')) == all_files
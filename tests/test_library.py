@@ -0,0 +1,42 @@
+import io
+import zipfile
+import pytest
+import main
+
+def test_clean_png(png_bytes):
+    cleaned, metadata = main.clean_buffer(memoryview(png_bytes), 'photo.png')
+    assert cleaned.startswith(b'\x89PNG\r\n\x1a\n')
+    assert b'Secret Author' not in cleaned
+
+def test_clean_docx_to_stream(docx_bytes):
+    output = io.BytesIO()
+    assert main.clean_buffer(io.BytesIO(docx_bytes), 'report.docx', dst=output)[0] is output
+    with zipfile.ZipFile(output) as zip_file:
+        assert zip_file.testzip() is None
+        assert b'Secret Author' not in zip_file.read('docProps/core.xml')
+
+def test_clean_pdf(pdf_bytes):
+    cleaned, _ = main.clean_buffer(pdf_bytes, 'report.pdf')
+    assert cleaned.startswith(b'%PDF-') and b'Secret Author' not in cleaned
+
+def test_broken_docx_raises(broken_docx_bytes):
+    output = io.BytesIO()
+    with pytest.raises(ValueError):
+        main.clean_buffer(broken_docx_bytes, 'report.docx', dst=output)
+    assert output.getvalue() == b''  # The members copied before the error are gone
+
+def test_truncated_pdf_raises(pdf_bytes):
+    with pytest.raises(ValueError):
+        main.clean_buffer(pdf_bytes[:len(pdf_bytes) // 2], 'report.pdf')
+
+def test_unsupported_content_raises():
+    with pytest.raises(ValueError):
+        main.clean_buffer(b'\x00' * 64, 'archive.xyz')
+
+@pytest.mark.parametrize('compact', [True, False])
+def test_metadata_json_without_orjson(monkeypatch, compact):
+    pytest.importorskip('orjson')
+    metadata = {'title': 'Report', 'pages': 12, 'thumbnail': b'\x89PNG', 'tracks': [{'id': 1, 'dpi': [72.0, 72.0]}], 3: None}
+    with_orjson = main.dumps_metadata(metadata, compact)
+    monkeypatch.setattr(main, 'orjson', None)
+    assert main.dumps_metadata(metadata, compact) == with_orjson
@@ -0,0 +1,44 @@
+import json
+import time
+import multiprocessing
+import pytest
+import main
+
+# The workers must inherit the fake process_file
+pytestmark = pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason='needs forked workers')
+
+DURATIONS = {}
+
+def slow_process_file(file_path, folder_name, output_file_path=None):
+    try:
+        time.sleep(DURATIONS[file_path])
+    except main.FileTimeout:
+        time.sleep(DURATIONS[file_path])  # A file that does not stop by itself
+    return main.new_result(file_path)
+
+@pytest.fixture
+def time_limited(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, 'process_file', slow_process_file)
+    monkeypatch.setattr(main, 'LIMIT_GRACE_SECONDS', 0.5)
+    main.configure({'time_limit': 1.5})
+    yield DURATIONS
+    main.configure({'time_limit': None})
+    DURATIONS.clear()
+
+def run(files):
+    report = main.run_batch(files, workers=1, io_workers=1, dedup=False, report=main.RunReport('report.jsonl'))
+    report.close()
+    with open('report.jsonl') as f:
+        return {result['file']: result['status'] for result in map(json.loads, f)}
+
+def test_queued_files_are_not_timed(time_limited):
+    # Each file is under its limit, but the second and third wait in the pool behind the first
+    time_limited.update({'f1.png': 1.2, 'f2.png': 1.2, 'f3.png': 1.2})
+    assert run(list(time_limited)) == {'f1.png': 'ok', 'f2.png': 'ok', 'f3.png': 'ok'}
+
+def test_overdue_worker_is_killed(time_limited):
+    time_limited.update({'stuck.png': 30, 'f1.png': 0.1, 'f2.png': 0.1})
+    started = time.monotonic()
+    assert run(list(time_limited)) == {'stuck.png': 'quarantined', 'f1.png': 'ok', 'f2.png': 'ok'}
+    assert time.monotonic() - started < 10
@@ -0,0 +1,100 @@
+import io
+import zlib
+import pytest
+from PyPDF2 import PdfReader
+from conftest import pdf_revision
+import main
+
+def clean_pdf(data):
+    cleaned, _ = main.clean_buffer(data, 'report.pdf')
+    reader = PdfReader(io.BytesIO(cleaned))
+    return cleaned, reader
+
+def test_info_removed(pdf_bytes):
+    cleaned, reader = clean_pdf(pdf_bytes)
+    assert b'Secret Author' not in cleaned
+    assert reader.metadata is None
+    assert b'(Hello)' in reader.pages[0].get_contents().get_data()
+
+def test_incremental_update(pdf_bytes):
+    # The update replaces the information dictionary with another object
+    # and the page contents, leaving the first ones unreachable
+    content = b'BT /F1 12 Tf 72 720 Td (Updated) Tj ET'
+    updated = pdf_revision({
+        3: b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 6 0 R >>',
+        6: b'<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content),
+        7: b'<< /Author (NewSecret) /Producer (Editor) >>',
+    }, b'/Size 8 /Root 1 0 R /Info 7 0 R', pdf_bytes)
+    assert PdfReader(io.BytesIO(updated)).metadata['/Author'] == 'NewSecret'
+
+    cleaned, reader = clean_pdf(updated)
+    for secret in (b'Secret Author', b'NewSecret', b'(Hello)'):
+        assert secret not in cleaned
+    assert b'(Updated)' in reader.pages[0].get_contents().get_data()
+
+def test_object_streams():
+    # Catalog, pages and the information dictionary compressed in an object
+    # stream, with a cross-reference stream
+    content = b'BT /F1 12 Tf 72 720 Td (Hello) Tj ET'
+    members = [
+        (1, b'<< /Type /Catalog /Pages 2 0 R >>'),
+        (2, b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>'),
+        (5, b'<< /Author (Secret Author) >>'),
+    ]
+    header, body = b'', b''
+    for number, value in members:
+        header += b'%d %d ' % (number, len(body))
+        body += value + b' '
+    stream = zlib.compress(header + body)
+    data = bytearray(b'%PDF-1.5\n')
+    offsets = {}
+    for number, value in (
+        (3, b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R >>'),
+        (4, b'<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content)),
+        (6, b'<< /Type /ObjStm /N 3 /First %d /Filter /FlateDecode /Length %d >>\nstream\n%s\nendstream' % (len(header), len(stream), stream)),
+    ):
+        offsets[number] = len(data)
+        data += b'%d 0 obj\n%s\nendobj\n' % (number, value)
+    rows = b'\x00' + bytes(4) + b'\xff\xff'
+    for number in range(1, 8):
+        if number in offsets:
+            rows += b'\x01' + offsets[number].to_bytes(4, 'big') + b'\x00\x00'
+        elif number == 7:
+            rows += b'\x01' + len(data).to_bytes(4, 'big') + b'\x00\x00'
+        else:
+            index = [member[0] for member in members].index(number)
+            rows += b'\x02' + (6).to_bytes(4, 'big') + index.to_bytes(2, 'big')
+    xref = len(data)
+    data += (b'7 0 obj\n<< /Type /XRef /Size 8 /W [1 4 2] /Root 1 0 R /Info 5 0 R /Length %d >>\nstream\n%s\nendstream\nendobj\n'
+             b'startxref\n%d\n%%%%EOF\n' % (len(rows), rows, xref))
+    assert PdfReader(io.BytesIO(bytes(data))).metadata['/Author'] == 'Secret Author'
+
+    cleaned, reader = clean_pdf(bytes(data))
+    assert reader.metadata is None
+    assert b'(Hello)' in reader.pages[0].get_contents().get_data()
+    for stream_object in reader.xref_objStm:
+        assert 'Secret Author' not in str(reader.get_object(stream_object))
+    assert all(b'Secret Author' not in zlib.decompress(chunk.split(b'stream\n', 1)[1])
+               for chunk in cleaned.split(b'/Type /ObjStm')[1:])
+
+def test_strings_are_not_syntax():
+    # Keywords and a reference to an unreachable object in a nested string,
+    # a hexadecimal string ("endobj"), a comment and a name
+    content = b'BT /F1 12 Tf 72 720 Td (Hello) Tj ET'
+    data = pdf_revision({
+        1: b'<< /Type /Catalog /Pages 2 0 R >>',
+        2: b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        3: (b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Contents 4 0 R /See (6 0 R)\n'
+            b'/Note (ends with endobj and stream\n, see (6 0 R\\) ) and more) /Hex <656e646f626a>\n'
+            b'% endobj 6 0 R\n/stream\n/Name >>'),
+        4: b'<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content),
+        5: b'<< /Author (Secret Author) >>',
+        6: b'<< /Leaked (Unreachable Secret) >>',
+    }, b'/Size 7 /Root 1 0 R /Info 5 0 R')
+
+    cleaned, reader = clean_pdf(data)
+    assert b'Unreachable Secret' not in cleaned
+    page = reader.pages[0]
+    assert page['/Note'] == 'ends with endobj and stream\n, see (6 0 R) ) and more'
+    assert page['/stream'] == '/Name'
+    assert b'(Hello)' in page.get_contents().get_data()
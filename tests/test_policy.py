@@ -0,0 +1,43 @@
+import io
+import pytest
+import main
+
+PIL = pytest.importorskip('PIL.Image')
+
+@pytest.fixture
+def keep_orientation():
+    main.configure({'keep': ['orientation']})
+    yield
+    main.configure({'keep': []})
+
+def rotated_image(image_format):
+    '''
+    A small image whose EXIF block holds a rotation and the camera model.
+    '''
+    exif = PIL.Exif()
+    exif[main.EXIF_ORIENTATION] = 6
+    exif[0x010F] = 'Secret Camera'  # Make
+    output = io.BytesIO()
+    PIL.new('RGB', (4, 2), 'red').save(output, image_format, exif=exif.tobytes())
+    return output.getvalue()
+
+def strip(data, image_format):
+    src, dst = io.BytesIO(data), io.BytesIO()
+    main.SEGMENT_STRIPPERS[image_format](src, dst)
+    return dst.getvalue()
+
+@pytest.mark.parametrize('image_format', ['jpeg', 'png', 'webp'])
+def test_orientation_kept(image_format, keep_orientation):
+    cleaned = strip(rotated_image(image_format), image_format)
+    assert b'Secret Camera' not in cleaned
+    with PIL.open(io.BytesIO(cleaned)) as img:
+        assert img.getexif().get(main.EXIF_ORIENTATION) == 6
+        img.load()
+
+@pytest.mark.parametrize('image_format', ['jpeg', 'png', 'webp'])
+def test_orientation_dropped(image_format):
+    cleaned = strip(rotated_image(image_format), image_format)
+    assert b'Secret Camera' not in cleaned
+    with PIL.open(io.BytesIO(cleaned)) as img:
+        assert main.EXIF_ORIENTATION not in img.getexif()
+        img.load()
@@ -0,0 +1,52 @@
+import os
+import sys
+import subprocess
+import pytest
+import main
+from conftest import ROOT, png_chunk
+
+WORKERS = 2
+
+@pytest.mark.parametrize('kind', ['sqlite', 'dir'])
+def test_workers_finish_every_file(kind, tmp_path, png_bytes, broken_docx_bytes):
+    clean_folder = tmp_path / 'clean'
+    clean_folder.mkdir()
+    for index in range(20):
+        # Distinct files, so they are not deduplicated
+        (clean_folder / f'image_{index}.png').write_bytes(png_bytes[:-12] + png_chunk(b'tEXt', b'Comment\x00%d' % index) + png_bytes[-12:])
+    for index in range(2):
+        (clean_folder / f'broken_{index}.docx').write_bytes(broken_docx_bytes)
+
+    address = f'{kind}:{tmp_path / "queue"}'
+    processes = [
+        subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'main.py'), '--queue', address, '--layout', 'run',
+             '--workers', '1', '--io-workers', '1', '--max-attempts', '3'],
+            cwd=tmp_path, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        for _ in range(WORKERS)
+    ]
+    for process in processes:
+        assert process.wait(timeout=120) == 0
+
+    queue = main.open_queue(address)
+    try:
+        counts = {state: count for state, count in queue.counts().items() if count}
+    finally:
+        queue.close()
+    assert counts == {'done': 20, 'failed': 2}
+
+def test_work_starts_before_listing_ends(tmp_path):
+    listed = []
+
+    def discover():
+        for index in range(3 * main.QUEUE_ENQUEUE_SIZE):
+            listed.append(index)
+            yield f'file_{index}.png'
+
+    queue = main.open_queue(f'sqlite:{tmp_path / "queue.sqlite3"}')
+    try:
+        assert next(queue.files(discover())) is not None
+        assert len(listed) <= main.QUEUE_ENQUEUE_SIZE + 1
+    finally:
+        queue.close()
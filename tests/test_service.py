@@ -0,0 +1,134 @@
+import os
+import sys
+import json
+import time
+import email
+import socket
+import signal
+import zipfile
+import subprocess
+import http.client
+import io
+import pytest
+from conftest import ROOT
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path):
+        super().__init__('localhost', timeout=30)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+def run_service(folder, *args):
+    '''
+    Run the service on a Unix socket, with its temporary files in folder,
+    and yield a function sending a request to it.
+    '''
+    socket_path = str(folder / 'service.sock')
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'main.py'), '--serve', 'unix:' + socket_path, '--workers', '1', '--io-workers', '1', *args],
+        cwd=folder, env=dict(os.environ, TMPDIR=str(folder)), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+    def request(method, path, body=None, headers=None):
+        connection = UnixHTTPConnection(socket_path)
+        try:
+            connection.putrequest(method, path)
+            for name, value in (headers or {}).items():
+                connection.putheader(name, value)
+            if body is not None and 'Content-Length' not in (headers or {}):
+                connection.putheader('Content-Length', str(len(body)))
+            connection.endheaders(body)
+            response = connection.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            connection.close()
+
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            request('GET', '/health')
+            break
+        except OSError:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                pytest.fail('The service did not start')
+            time.sleep(0.1)
+    yield request
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+@pytest.fixture(scope='module')
+def service(tmp_path_factory):
+    yield from run_service(tmp_path_factory.mktemp('service'))
+
+def multipart_parts(headers, body):
+    message = email.message_from_bytes(f'Content-Type: {headers["Content-Type"]}\r\n\r\n'.encode('latin-1') + body)
+    return [part.get_payload(decode=True) for part in message.get_payload()]
+
+def test_health(service):
+    status, _, body = service('GET', '/health')
+    assert status == 200
+    assert json.loads(body)['in_flight'] == 0
+
+def test_clean_png(service, png_bytes):
+    status, headers, body = service('POST', '/clean?name=photo.png', png_bytes)
+    assert status == 200
+    assert headers['X-Status'] == 'ok'
+    metadata, cleaned = multipart_parts(headers, body)
+    json.loads(metadata)
+    assert cleaned.startswith(b'\x89PNG\r\n\x1a\n')
+    assert b'Secret Author' not in cleaned and b'IDAT' in cleaned
+
+def test_clean_docx(service, docx_bytes):
+    status, headers, body = service('POST', '/clean?name=report.docx', docx_bytes)
+    assert status == 200
+    assert headers['X-Status'] == 'ok'
+    cleaned = multipart_parts(headers, body)[1]
+    with zipfile.ZipFile(io.BytesIO(cleaned)) as zip_file:
+        assert zip_file.testzip() is None
+        assert b'Secret Author' not in zip_file.read('docProps/core.xml')
+
+def test_broken_file_is_an_error(service, broken_docx_bytes):
+    status, headers, body = service('POST', '/clean?name=report.docx', broken_docx_bytes)
+    assert status == 422
+    assert json.loads(body)['status'] == 'error'
+
+def test_unsupported_file(service):
+    status, _, body = service('POST', '/clean?name=archive.xyz', b'\x00' * 64)
+    assert status == 415
+
+@pytest.mark.parametrize('length', ['-1', 'abc'])
+def test_bad_content_length(service, length):
+    status, _, body = service('POST', '/clean?name=photo.png', b'', {'Content-Length': length})
+    assert status == 400
+
+def test_timed_out_request_frees_its_slot(tmp_path, png_bytes):
+    from PIL import Image
+    noise = Image.effect_noise((1500, 1500), 64)
+    frames = [noise.point(lambda value, index=index: (value + index) % 256) for index in range(30)]
+    gif_file = io.BytesIO()
+    frames[0].save(gif_file, 'GIF', save_all=True, append_images=frames[1:])
+
+    service = run_service(tmp_path, '--request-timeout', '1', '--max-in-flight', '1')
+    request = next(service)
+    try:
+        status, _, _ = request('POST', '/clean?name=animation.gif', gif_file.getvalue())
+        assert status == 504
+        # The only slot is free again at once
+        assert json.loads(request('GET', '/health')[2])['in_flight'] == 0
+        status, _, _ = request('POST', '/clean?name=photo.png', png_bytes)
+        assert status == 200
+        # The timed out file is given up on and its files removed
+        deadline = time.monotonic() + 30
+        while json.loads(request('GET', '/health')[2])['orphaned'] and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert not list(tmp_path.glob('metadata_cleaner_*'))
+    finally:
+        service.close()